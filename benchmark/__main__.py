@@ -0,0 +1,5 @@
+import sys
+
+from benchmark.suite import main, parse_args
+
+sys.exit(main(**vars(parse_args())))
@@ -0,0 +1,78 @@
+"""
+Guards the import time of the modules every DAG imports against regressions.
+
+Each module is imported in a fresh interpreter and the median wall clock time,
+minus the interpreter start up, is compared with its budget. The script exits
+with status 1 if a budget is exceeded. On Python 3.7+ the slowest imports
+reported by `python -X importtime` are listed to help find the culprit.
+
+Run with `python -m benchmark.import_time [--scale 1.5]`.
+"""
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+# Milliseconds, on top of the interpreter start up.
+IMPORT_TIME_BUDGETS_MS = {
+    'spider.constant.google_cloud': 50,
+    'spider.constant.database': 150,
+    'spider.util.iterator': 50,
+    'spider.util.file': 150,
+    'spider.util.database': 1500,
+}
+REPEAT = 5
+IMPORTTIME_LINE_REGEX = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def _time_command(code: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+
+def measure_import_time_ms(module: str, repeat: int = REPEAT) -> float:
+    startup_ms = statistics.median(_time_command('pass') for _ in range(repeat))
+    import_ms = statistics.median(_time_command(f'import {module}') for _ in range(repeat))
+    return max(import_ms - startup_ms, 0.0)
+
+
+def slowest_imports(module: str, count: int = 5) -> List[Tuple[str, float]]:
+    """
+    Returns the imports with the highest self time, in milliseconds.
+    """
+    if sys.version_info < (3, 7):
+        return []
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               universal_newlines=True, check=True)
+    self_times = [(match.group(4), int(match.group(1)) / 1000)
+                  for match in map(IMPORTTIME_LINE_REGEX.match, completed.stderr.splitlines())
+                  if match]
+    return sorted(self_times, key=lambda self_time: self_time[1], reverse=True)[:count]
+
+
+def main(budgets: Dict[str, float] = IMPORT_TIME_BUDGETS_MS, scale: float = 1.0) -> int:
+    exceeded = []
+    for module, budget_ms in budgets.items():
+        import_ms = measure_import_time_ms(module)
+        budget_ms *= scale
+        status = 'ok' if import_ms <= budget_ms else 'OVER BUDGET'
+        print(f'{module:<32} {import_ms:8.1f} ms (budget {budget_ms:7.1f} ms) {status}')
+        if import_ms > budget_ms:
+            exceeded.append(module)
+            for name, self_ms in slowest_imports(module):
+                print(f'    {name:<40} {self_ms:8.1f} ms self')
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies every budget, e.g. for slower machines.')
+    sys.exit(main(scale=parser.parse_args().scale))
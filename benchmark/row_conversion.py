@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of the BigQuery row conversions in `spider.util.database`
+against the previous `row_iterator_to_dict_list` implementation.
+
+Run with `python -m benchmark.row_conversion [row_count]`.
+"""
+
+import sys
+import timeit
+from typing import List
+
+from google.cloud import bigquery
+from more_itertools import always_iterable
+
+from spider.util.database import (
+    row_iterator_to_column_dict, row_iterator_to_dict_list,
+    row_iterator_to_record_list, row_iterator_to_tuple_list
+)
+
+DEFAULT_ROW_COUNT = 1000000
+SCHEMA = [
+    bigquery.SchemaField('ticker', 'STRING'),
+    bigquery.SchemaField('date', 'DATE'),
+    bigquery.SchemaField('open', 'FLOAT'),
+    bigquery.SchemaField('close', 'FLOAT'),
+    bigquery.SchemaField('volume', 'INTEGER'),
+    bigquery.SchemaField('quote', 'RECORD', fields=[
+        bigquery.SchemaField('bid', 'FLOAT'),
+        bigquery.SchemaField('ask', 'FLOAT'),
+    ]),
+    bigquery.SchemaField('tags', 'STRING', mode='REPEATED'),
+]
+
+
+class SyntheticRowIterator:
+    """
+    Stands in for `bigquery.table.RowIterator`, holding prebuilt rows.
+    """
+
+    def __init__(self, rows: List[bigquery.Row]):
+        self.schema = SCHEMA
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def make_rows(row_count: int) -> List[bigquery.Row]:
+    field_to_index = {field.name: index for index, field in enumerate(SCHEMA)}
+    return [bigquery.Row(
+        ('TICKER{}'.format(i % 500), '2019-01-01', 1.0 + i, 2.0 + i, i,
+         {'bid': 1.0, 'ask': 1.1}, ['equity', 'us']),
+        field_to_index) for i in range(row_count)]
+
+
+def legacy_row_iterator_to_dict_list(row_iterator) -> List[dict]:
+    return [{schema.name: row_item for schema, row_item
+             in zip(row_iterator.schema, always_iterable(row.values()))}
+            for row in row_iterator]
+
+
+def main(row_count: int = DEFAULT_ROW_COUNT):
+    rows = make_rows(row_count)
+    conversions = [
+        legacy_row_iterator_to_dict_list,
+        row_iterator_to_dict_list,
+        row_iterator_to_tuple_list,
+        row_iterator_to_record_list,
+        row_iterator_to_column_dict,
+    ]
+    baseline = None
+    for conversion in conversions:
+        seconds = min(timeit.repeat(
+            lambda: conversion(SyntheticRowIterator(rows)), number=1, repeat=3))
+        baseline = baseline or seconds
+        print('{name:<36} {seconds:8.3f}s {rate:12,.0f} rows/s {speedup:6.1f}x'.format(
+            name=conversion.__name__, seconds=seconds,
+            rate=row_count / seconds, speedup=baseline / seconds))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROW_COUNT)
@@ -0,0 +1,286 @@
+"""
+Benchmark suite of the `spider.util` hot paths, run against a local mocked
+BigQuery client.
+
+Every case reports its throughput and peak memory, the latter measured in a
+separate run under `tracemalloc`. The results are stored as JSON in
+`benchmark/results/` and compared with the previous run, so that a change
+can be judged against a baseline. The exit status is 1 if a case got slower
+than `--tolerance` allows.
+
+Run with `python -m benchmark [--scale 0.1] [--case ndjson_serialization] [--no-save]`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from google.cloud import bigquery
+
+from benchmark.import_time import IMPORT_TIME_BUDGETS_MS, measure_import_time_ms
+from benchmark.mock_bigquery import MockBigQueryClient
+from benchmark.row_conversion import SyntheticRowIterator, make_rows
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REPEAT = 3
+DEFAULT_TOLERANCE = 0.1
+SQL_TEMPLATE = '''
+SELECT ticker, date, close
+FROM `{dwh_schema}.{table}`
+WHERE date BETWEEN '{start_date}' AND '{end_date}'
+  AND ticker IN ({tickers})
+'''
+# Only the fields without a default, so that the compiled defaults are measured.
+READ_SQL_PARAM = {'table': 'prices', 'start_date': '2019-01-01', 'end_date': '2019-12-31',
+                  'tickers': "'AAPL', 'MSFT'"}
+
+
+class BenchmarkCase(NamedTuple):
+    name: str
+    unit: str
+    size: int
+    # Builds the input of `run` from the size, outside of the measurement.
+    setup: Callable[[int], Any]
+    # Runs the measured code and returns the number of units processed.
+    run: Callable[[Any], int]
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    unit: str
+    count: int
+    seconds: float
+    throughput: float
+    peak_memory_bytes: Optional[int]
+
+
+def make_dict_rows(row_count: int) -> List[dict]:
+    return [{'ticker': f'TICKER{i % 500}', 'date': '2019-01-01', 'open': 1.0 + i,
+             'close': 2.0 + i, 'volume': i, 'tags': ['equity', 'us']}
+            for i in range(row_count)]
+
+
+def make_wide_schema(field_count: int, description: Optional[str]) -> List[bigquery.SchemaField]:
+    nested = [bigquery.SchemaField(f'nested_{i}', 'FLOAT', description=description)
+              for i in range(10)]
+    return [bigquery.SchemaField(f'field_{i}', 'RECORD', fields=nested, description=description)
+            if i % 10 == 0 else
+            bigquery.SchemaField(f'field_{i}', 'STRING', description=description)
+            for i in range(field_count)]
+
+
+def run_ndjson_serialization(rows: List[dict]) -> int:
+    from spider.util.database import upload_dict_list_to_bigquery
+
+    upload_dict_list_to_bigquery(MockBigQueryClient(), rows, 'benchmark', 'ndjson', [])
+    return len(rows)
+
+
+def run_chunked_upload(rows: List[dict]) -> int:
+    from spider.util.database import upload_dict_iterable_to_bigquery
+
+    results = upload_dict_iterable_to_bigquery(
+        MockBigQueryClient(), iter(rows), 'benchmark', 'chunked', [], chunk_size=10000)
+    return sum(result.row_count for result in results)
+
+
+def setup_dataframe(row_count: int):
+    import pandas
+
+    return pandas.DataFrame(make_dict_rows(row_count)).drop(columns=['tags'])
+
+
+def run_split_dataframe(df) -> int:
+    from spider.util.iterator import split_dataframe_by_chunk
+
+    return sum(chunk.shape[0] for chunk in split_dataframe_by_chunk(df, 1000))
+
+
+def run_iter_dataframe_chunks(df) -> int:
+    from spider.util.iterator import iter_dataframe_chunks
+
+    return sum(chunk.shape[0] for chunk in iter_dataframe_chunks(df, chunk_bytes=2 ** 16))
+
+
+def run_row_conversion(rows: List[bigquery.Row]) -> int:
+    from spider.util.database import row_iterator_to_dict_list
+
+    return len(row_iterator_to_dict_list(SyntheticRowIterator(rows)))
+
+
+def setup_merge_schema(field_count: int):
+    return make_wide_schema(field_count, 'described'), make_wide_schema(field_count, None)
+
+
+def run_merge_schema(schemas) -> int:
+    from spider.util.database import merge_schema
+
+    return len(merge_schema(*schemas))
+
+
+def setup_read_sql(render_count: int):
+    from unittest import mock
+
+    from spider.util.file import read_sql
+
+    file = tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False)
+    with file:
+        file.write(SQL_TEMPLATE)
+    # The defaults are rendered when the template is compiled, here from a stub instead of the secrets.
+    with mock.patch('spider.util.file.get_default_query_parameters', return_value={'dwh_schema': 'dwh'}):
+        rendered = read_sql(file.name, READ_SQL_PARAM, strict=True)
+    assert '`dwh.prices`' in rendered, rendered
+    return file.name, render_count
+
+
+def run_read_sql(arguments) -> int:
+    from spider.util.file import read_sql
+
+    sql_filepath, render_count = arguments
+    for _ in range(render_count):
+        read_sql(sql_filepath, READ_SQL_PARAM, strict=True)
+    return render_count
+
+
+def get_cases(scale: float) -> List[BenchmarkCase]:
+    def size(count: int) -> int:
+        return max(int(count * scale), 1)
+
+    return [
+        BenchmarkCase('ndjson_serialization', 'rows', size(200000), make_dict_rows, run_ndjson_serialization),
+        BenchmarkCase('chunked_upload', 'rows', size(200000), make_dict_rows, run_chunked_upload),
+        BenchmarkCase('split_dataframe_by_chunk', 'rows', size(1000000), setup_dataframe, run_split_dataframe),
+        BenchmarkCase('iter_dataframe_chunks', 'rows', size(1000000), setup_dataframe, run_iter_dataframe_chunks),
+        BenchmarkCase('row_iterator_to_dict_list', 'rows', size(200000), make_rows, run_row_conversion),
+        BenchmarkCase('merge_schema', 'fields', size(5000), setup_merge_schema, run_merge_schema),
+        BenchmarkCase('read_sql', 'renders', size(20000), setup_read_sql, run_read_sql),
+    ]
+
+
+def measure(case: BenchmarkCase, repeat: int = REPEAT) -> BenchmarkResult:
+    """
+    Returns the fastest of `repeat` runs and the peak memory of one more
+    run, traced separately as tracing slows the code down.
+    """
+    arguments = case.setup(case.size)
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = case.run(arguments)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        case.run(arguments)
+        _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchmarkResult(case.name, case.unit, count, seconds, count / seconds, peak_memory_bytes)
+
+
+def measure_import_times() -> List[BenchmarkResult]:
+    results = []
+    for module in IMPORT_TIME_BUDGETS_MS:
+        seconds = max(measure_import_time_ms(module) / 1000, 1e-6)
+        results.append(BenchmarkResult(f'import {module}', 'imports', 1, seconds, 1 / seconds, None))
+    return results
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results: List[BenchmarkResult], scale: float, results_dir: str = RESULTS_DIR) -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    created_at = datetime.utcnow()
+    filepath = os.path.join(results_dir, created_at.strftime('%Y%m%dT%H%M%S') + '.json')
+    with open(filepath, 'w') as file:
+        json.dump({
+            'created_at': created_at.isoformat(),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'scale': scale,
+            'results': [result._asdict() for result in results],
+        }, file, indent=2)
+    return filepath
+
+
+def load_previous_results(scale: float, results_dir: str = RESULTS_DIR) -> Dict[str, dict]:
+    """
+    Returns the results of the latest run with the same scale, by case name.
+    """
+    if not os.path.isdir(results_dir):
+        return {}
+    for filename in sorted(os.listdir(results_dir), reverse=True):
+        with open(os.path.join(results_dir, filename), 'r') as file:
+            run = json.load(file)
+        if run['scale'] == scale:
+            return {result['name']: result for result in run['results']}
+    return {}
+
+
+def _format_bytes(size: Optional[int]) -> str:
+    return '-' if size is None else f'{size / 2 ** 20:,.1f} MiB'
+
+
+def main(scale: float = 1.0, case_names: Optional[List[str]] = None, save: bool = True,
+         include_import_time: bool = True, tolerance: float = DEFAULT_TOLERANCE) -> int:
+    from spider.util.instrument import set_metrics_sinks
+
+    # Metrics of the mocked jobs would only pollute the metrics file.
+    set_metrics_sinks([])
+    previous = load_previous_results(scale)
+    cases = [case for case in get_cases(scale) if not case_names or case.name in case_names]
+    results = [measure(case) for case in cases]
+    if include_import_time and not case_names:
+        results += measure_import_times()
+
+    regressions = []
+    for result in results:
+        line = (f'{result.name:<44} {result.throughput:14,.0f} {result.unit}/s '
+                f'{_format_bytes(result.peak_memory_bytes):>12} peak')
+        baseline = previous.get(result.name)
+        if baseline:
+            change = result.throughput / baseline['throughput'] - 1
+            line += f' {change:+8.1%} vs previous'
+            if change < -tolerance:
+                regressions.append(result.name)
+                line += ' REGRESSION'
+        print(line)
+
+    if save:
+        print(f'Results saved to {save_results(results, scale)}')
+    return 1 if regressions else 0
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the input size of every case.')
+    parser.add_argument('--case', action='append', dest='case_names',
+                        help='Only runs the given case, may be repeated.')
+    parser.add_argument('--no-save', action='store_false', dest='save',
+                        help='Does not store the results.')
+    parser.add_argument('--no-import-time', action='store_false', dest='include_import_time',
+                        help='Skips measuring the import time of the modules.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative throughput loss reported as a regression.')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(**vars(parse_args())))
@@ -3,3 +3,21 @@ import os
 CUR_ENV = os.getenv('ENV', default='staging')
 IS_PRODUCTION = True if CUR_ENV == 'production' else False
 DIR = os.path.dirname(os.path.realpath(__file__))
+
+# The constants of the submodules are re-exported, e.g. `from spider.constant import BIGQUERY_LOCATION`.
+# They are imported last as they import the constants above.
+from spider.constant import airflow, database, file, google_cloud, secret  # noqa: E402
+from spider.util.lazy import make_module_lazy  # noqa: E402
+
+
+def _get_public_names(module) -> list:
+    # Modules without `__all__` only define constants, whose names are upper case.
+    return getattr(module, '__all__', None) or [name for name in vars(module) if name.isupper()]
+
+
+for _module in [airflow, file, secret, google_cloud, database]:
+    for _name in _get_public_names(_module):
+        globals().setdefault(_name, getattr(_module, _name))
+
+# The secrets and the BigQuery client are still only read or built on first access.
+make_module_lazy(__name__, dict(google_cloud._lazy_attributes, **database._lazy_attributes))
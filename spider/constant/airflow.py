@@ -18,12 +18,46 @@ POSTGRES_SCHEMA = 'vaas_production'
 POSTGRES_USER = os.getenv('BACKEND_POSTGRES_USER')
 POSTGRES_PASSWORD = os.getenv('BACKEND_POSTGRES_PASSWORD')
 POSTGRES_PORT = '5431'
+# Rows fetched per round trip from the server-side cursors of the replication.
+POSTGRES_FETCH_SIZE = 10000
+POSTGRES_REPLICATION_MAX_WORKERS = 4
+
+# Records per batch of the PK chunked Salesforce bulk queries, at most 250000.
+SALESFORCE_PK_CHUNK_SIZE = 100000
+SALESFORCE_BULK_POLL_INTERVAL = 10.0
+SALESFORCE_BULK_TIMEOUT = 2 * 60 * 60
+# Result batches downloaded at once per object, and objects extracted at once.
+SALESFORCE_BULK_MAX_WORKERS = 4
+SALESFORCE_EXTRACTION_MAX_WORKERS = 2
 
 DATA_TEAM_EMAIL = 'clevel@chatoyance.org'
 
+# XComs pickled to more bytes than this are stored gzipped under the GCS prefix, which the Celery
+# executor requires, or in `XCOM_OFFLOAD_DIR` on the worker if it is not set, and only referenced.
+# They are deleted by `delete_task_xcom_payloads`; a lifecycle rule on the GCS prefix catches the
+# DAG runs which failed.
+XCOM_OFFLOAD_THRESHOLD = 48 * 1024
+XCOM_OFFLOAD_GCS_PREFIX = os.getenv('XCOM_OFFLOAD_GCS_PREFIX')
+XCOM_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
 DATA_POOL = 'data'
 DATA_POOL_SLOTS = 16
 
+# Pools of the tasks waiting on BigQuery and other services, and of the
+# transforms using the worker CPUs, resized by `spider.util.pool.resize_pools`.
+IO_POOL = 'data_io'
+IO_POOL_MIN_SLOTS = 4
+IO_POOL_MAX_SLOTS = 64
+CPU_POOL = 'data_cpu'
+CPU_POOL_MIN_SLOTS = 1
+# CPUs of all the Celery workers together, as the pool is shared by them. It defaults to the
+# `worker_concurrency` of the single worker of config/airflow.cfg.
+CPU_POOL_MAX_SLOTS = int(os.getenv('CPU_POOL_MAX_SLOTS', '16'))
+# Task instances finished within this window are used to size the pools.
+POOL_SIZING_WINDOW = timedelta(hours=1)
+# Slots given on top of the observed concurrency to absorb bursts.
+POOL_SIZING_HEADROOM = 1.25
+
 DEFAULT_ARGS = {
     'owner': 'airflow',
     'depends_on_past': False,
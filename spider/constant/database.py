@@ -1,32 +1,65 @@
 """
 Constants related to databases shared across 90 Seconds Airflow.
+
+The schema constants are read from secrets lazily, on first access, and
+cached by `spider.util.secret`, so importing this module does no I/O.
 """
 
-from spider.util.secret import get_secret
+from functools import partial
+
+from spider.util.lazy import make_module_lazy
+from spider.util.secret import get_secret, invalidate_secrets, warm_secrets
 
 # Schema refers to `database_id` in BigQuery
-DWH_SCHEMA = get_secret('dwh_schema')
-DWH_CX_SCHEMA = get_secret('dwh_cx_schema')
-DWH_FINANCE_SCHEMA = get_secret('dwh_finance_schema')
-DWH_GENERAL_SCHEMA = get_secret('dwh_general_schema')
-DWH_REVENUE_SCHEMA = get_secret('dwh_revenue_schema')
-DWH_MARKETING_SCHEMA = get_secret('dwh_marketing_schema')
-DWH_PRODUCT_SCHEMA = get_secret('dwh_product_schema')
-DWH_DESCRIPTION_SCHEMA = get_secret('dwh_description_schema')
-DWH_SNAPSHOT_SCHEMA = get_secret('dwh_snapshot_schema')
-BACKEND_SCHEMA = get_secret('backend_schema')
-BACKEND_AUTOMATION_SCHEMA = get_secret('backend_automation_schema')
-EXTERNAL_SCHEMA = get_secret('external_schema')
-EXTERNAL_BACKEND_SCHEMA = get_secret('external_backend_schema')
-SALESFORCE_SCHEMA = get_secret('salesforce_schema')
-GOOGLE_SHEET_SCHEMA = get_secret('google_sheet_schema')
-EMAIL_FIVETRAN_SCHEMA = get_secret('email_fivetran_schema')
-METADATA_SCHEMA = get_secret('metadata_schema')
-GOOGLE_ADS_SCHEMA = get_secret('google_ads_schema')
-BACKEND_AIRFLOW_SCHEMA = get_secret('backend_airflow_schema')
-
-DWH_SCHEMAS = [
-    DWH_SCHEMA, DWH_CX_SCHEMA,
-    DWH_FINANCE_SCHEMA, DWH_REVENUE_SCHEMA,
-    DWH_MARKETING_SCHEMA, DWH_PRODUCT_SCHEMA
+SCHEMA_SECRET_KEYS = {
+    'DWH_SCHEMA': 'dwh_schema',
+    'DWH_CX_SCHEMA': 'dwh_cx_schema',
+    'DWH_FINANCE_SCHEMA': 'dwh_finance_schema',
+    'DWH_GENERAL_SCHEMA': 'dwh_general_schema',
+    'DWH_REVENUE_SCHEMA': 'dwh_revenue_schema',
+    'DWH_MARKETING_SCHEMA': 'dwh_marketing_schema',
+    'DWH_PRODUCT_SCHEMA': 'dwh_product_schema',
+    'DWH_DESCRIPTION_SCHEMA': 'dwh_description_schema',
+    'DWH_SNAPSHOT_SCHEMA': 'dwh_snapshot_schema',
+    'BACKEND_SCHEMA': 'backend_schema',
+    'BACKEND_AUTOMATION_SCHEMA': 'backend_automation_schema',
+    'EXTERNAL_SCHEMA': 'external_schema',
+    'EXTERNAL_BACKEND_SCHEMA': 'external_backend_schema',
+    'SALESFORCE_SCHEMA': 'salesforce_schema',
+    'GOOGLE_SHEET_SCHEMA': 'google_sheet_schema',
+    'EMAIL_FIVETRAN_SCHEMA': 'email_fivetran_schema',
+    'METADATA_SCHEMA': 'metadata_schema',
+    'GOOGLE_ADS_SCHEMA': 'google_ads_schema',
+    'BACKEND_AIRFLOW_SCHEMA': 'backend_airflow_schema',
+}
+
+_DWH_SCHEMA_NAMES = [
+    'DWH_SCHEMA', 'DWH_CX_SCHEMA',
+    'DWH_FINANCE_SCHEMA', 'DWH_REVENUE_SCHEMA',
+    'DWH_MARKETING_SCHEMA', 'DWH_PRODUCT_SCHEMA'
 ]
+
+
+def _get_dwh_schemas() -> list:
+    return [get_secret(SCHEMA_SECRET_KEYS[name]) for name in _DWH_SCHEMA_NAMES]
+
+
+def warm_schema_constants() -> None:
+    warm_secrets(SCHEMA_SECRET_KEYS.values())
+
+
+def invalidate_schema_constants() -> None:
+    # unable to import at the beginning of the file, spider.util.file imports spider.constant
+    from spider.util.file import clear_sql_template_cache
+
+    invalidate_secrets()
+    clear_sql_template_cache()  # Templates are compiled with the schema constants.
+
+
+# The lazy constants are left out, a star import would read every secret. They are listed by `dir()`.
+__all__ = ['SCHEMA_SECRET_KEYS', 'warm_schema_constants', 'invalidate_schema_constants']
+
+make_module_lazy(__name__, dict(
+    {name: partial(get_secret, secret_key) for name, secret_key in SCHEMA_SECRET_KEYS.items()},
+    DWH_SCHEMAS=_get_dwh_schemas
+))
@@ -3,6 +3,35 @@ Constants related to files shared across 90 Seconds Airflow.
 """
 
 import os
+import tempfile
 
 DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DAG_DIR = os.path.join(DIR, 'dag')
+
+# Number of parsed SQL files kept by `spider.util.file.read_sql`.
+SQL_TEMPLATE_CACHE_SIZE = 256
+
+# On-disk cache of query results, shared by the tasks running on a worker. It is private to the
+# user, as loading the pickles of anyone able to write to it would run their code.
+QUERY_CACHE_DIR = os.path.join(tempfile.gettempdir(), f'spider_query_cache_{os.getuid()}')
+QUERY_CACHE_MAX_SIZE = 512 * 1024 * 1024
+QUERY_CACHE_TTL = 15 * 60
+
+# Local metadata kept between DAG runs on a worker.
+METADATA_DIR = os.path.join(os.getenv('AIRFLOW_HOME', tempfile.gettempdir()), 'spider_metadata')
+SCHEMA_SNAPSHOT_FILEPATH = os.path.join(METADATA_DIR, 'schema_snapshot.json')
+JOB_METRICS_FILEPATH = os.path.join(METADATA_DIR, 'job_metrics.ndjson')
+# The job metrics file is rotated at this size, keeping one previous file.
+JOB_METRICS_MAX_SIZE = 64 * 1024 * 1024
+
+# Memory-mapped market data downloaded by `spider.util.market_data`.
+MARKET_DATA_CACHE_DIR = os.path.join(os.getenv('AIRFLOW_HOME', tempfile.gettempdir()), 'spider_market_data')
+# Data newer than this is fetched again, as the latest bars may still change.
+MARKET_DATA_CACHE_FRESHNESS = 24 * 60 * 60
+MARKET_DATA_MAX_WORKERS = 8
+# Requests allowed per period in seconds, across the workers of a process.
+MARKET_DATA_RATE_LIMIT = 5
+MARKET_DATA_RATE_PERIOD = 1.0
+
+# Large XComs offloaded by `spider.util.airflow.push_task_xcom` without a GCS prefix.
+XCOM_OFFLOAD_DIR = os.path.join(METADATA_DIR, 'xcom')
@@ -1,19 +1,31 @@
 """
 Constants related to google cloud shared across 90 Seconds Airflow.
+
+The project ids and `BIGQUERY_CLIENT` are resolved on first access so that
+importing this module neither reads secrets nor imports the BigQuery client.
 """
 
+import importlib
 import os
 import re
+import threading
 from functools import partial
 
-from google.cloud import bigquery
-
 from spider.constant import IS_PRODUCTION
 from spider.constant.secret import SECRET_DIR
+from spider.util.async_file import get_cached_file, read_files
+from spider.util.lazy import make_module_lazy
+
+
+def _read_file_id(id_file):  # Same as get_secret, which would be a circular import, through the same cache.
+    return get_cached_file(_from_secret_dir(id_file)).rstrip()
 
 
-def _read_file_id(id_file):  # Same as get_secret but needs to re-def to prevent circular import.
-    return open(_from_secret_dir(id_file), 'r').read().rstrip()
+def warm_gcp_project_ids() -> None:
+    """
+    Reads the production and staging project ids concurrently.
+    """
+    read_files(map(_from_secret_dir, ['gcp_project_production_id', 'gcp_project_staging_id']))
 
 
 _from_secret_dir = partial(os.path.join, SECRET_DIR)
@@ -21,12 +33,60 @@ GCP_CREDENTIALS_PRODUCTION = _from_secret_dir('data-production.json')
 GCP_CREDENTIALS_STAGING = _from_secret_dir('data-staging.json')
 GCP_CREDENTIALS = GCP_CREDENTIALS_PRODUCTION if IS_PRODUCTION else GCP_CREDENTIALS_STAGING
 
-GCP_PROJECT_PRODUCTION_ID = _read_file_id('gcp_project_production_id')
-GCP_PROJECT_STAGING_ID = _read_file_id('gcp_project_staging_id')
-GCP_PROJECT_ID = GCP_PROJECT_PRODUCTION_ID if IS_PRODUCTION else GCP_PROJECT_STAGING_ID
+
+def get_gcp_project_id(production: bool = IS_PRODUCTION) -> str:
+    return _read_file_id('gcp_project_production_id' if production else 'gcp_project_staging_id')
+
 
 BIGQUERY_LOCATION = 'US'
-BIGQUERY_CLIENT = bigquery.Client.from_service_account_json(GCP_CREDENTIALS)
+# Serialized load chunks larger than this are spilled from memory to disk.
+BIGQUERY_LOAD_MAX_MEMORY_SIZE = 64 * 1024 * 1024
+BIGQUERY_LOAD_COMPRESS_LEVEL = 1
+# Target size of the uncompressed NDJSON chunks of chunked loads, halved down
+# to the minimum whenever a load request is rejected as too large.
+BIGQUERY_LOAD_CHUNK_BYTES = 32 * 1024 * 1024
+BIGQUERY_LOAD_MIN_CHUNK_BYTES = 1024 * 1024
+BIGQUERY_LOAD_MAX_RETRIES = 3
+BIGQUERY_LOAD_RETRY_INITIAL_DELAY = 1.0
+BIGQUERY_LOAD_RETRY_MAX_DELAY = 60.0
+BIGQUERY_LOAD_RETRY_MULTIPLIER = 2.0
+# Table of the metadata dataset holding the watermarks of incremental loads.
+BIGQUERY_WATERMARK_TABLE_ID = 'load_watermark'
+
+_google_cloud_clients = {}
+_google_cloud_clients_lock = threading.Lock()
+
+
+def _get_google_cloud_client(module_name: str, production: bool):
+    key = (os.getpid(), module_name, production)
+    client = _google_cloud_clients.get(key)
+    if client is None:
+        with _google_cloud_clients_lock:
+            client = _google_cloud_clients.get(key)
+            if client is None:
+                module = importlib.import_module(f'google.cloud.{module_name}')
+                client = module.Client.from_service_account_json(
+                    GCP_CREDENTIALS_PRODUCTION if production else GCP_CREDENTIALS_STAGING)
+                _google_cloud_clients[key] = client
+    return client
+
+
+def get_bigquery_client(production: bool = IS_PRODUCTION):
+    """
+    Returns the BigQuery client of the production or staging project.
+    It is built on first use and then shared by all threads of the
+    process; forked processes build their own client.
+    """
+    return _get_google_cloud_client('bigquery', production)
+
+
+def get_storage_client(production: bool = IS_PRODUCTION):
+    """
+    Returns the Cloud Storage client of the production or staging project,
+    shared like `get_bigquery_client`.
+    """
+    return _get_google_cloud_client('storage', production)
+
 
 GCS_BACKEND_STAGING_ID = '90seconds-backend-staging-sync'
 GCS_BACKEND_PRODUCTION_ID = '90seconds-backend-production-sync'
@@ -34,3 +94,22 @@ GCS_BACKEND_DEVELOPMENT_ID = '90seconds-backend-development-sync'
 
 # https://cloud.google.com/storage/docs/naming#requirements
 GCS_REGEX = re.compile(r"^gs://(?!g(o|0){2}g)[a-z\d][a-z\d\-_]{2,62}/\S+\.[a-zA-Z\d]{,3}$")
+
+# The lazy constants are left out, a star import would read the credentials and build the client.
+__all__ = [
+    'GCP_CREDENTIALS_PRODUCTION', 'GCP_CREDENTIALS_STAGING', 'GCP_CREDENTIALS',
+    'get_gcp_project_id', 'warm_gcp_project_ids',
+    'BIGQUERY_LOCATION', 'BIGQUERY_LOAD_MAX_MEMORY_SIZE', 'BIGQUERY_LOAD_COMPRESS_LEVEL',
+    'BIGQUERY_LOAD_CHUNK_BYTES', 'BIGQUERY_LOAD_MIN_CHUNK_BYTES', 'BIGQUERY_LOAD_MAX_RETRIES',
+    'BIGQUERY_LOAD_RETRY_INITIAL_DELAY', 'BIGQUERY_LOAD_RETRY_MAX_DELAY', 'BIGQUERY_LOAD_RETRY_MULTIPLIER',
+    'BIGQUERY_WATERMARK_TABLE_ID',
+    'get_bigquery_client', 'get_storage_client',
+    'GCS_BACKEND_STAGING_ID', 'GCS_BACKEND_PRODUCTION_ID', 'GCS_BACKEND_DEVELOPMENT_ID', 'GCS_REGEX',
+]
+
+make_module_lazy(__name__, {
+    'GCP_PROJECT_PRODUCTION_ID': partial(get_gcp_project_id, production=True),
+    'GCP_PROJECT_STAGING_ID': partial(get_gcp_project_id, production=False),
+    'GCP_PROJECT_ID': get_gcp_project_id,
+    'BIGQUERY_CLIENT': get_bigquery_client,
+})
@@ -0,0 +1,3 @@
+from spider.util.logging import log_exception_and_continue, log_info
+
+__all__ = ['log_exception_and_continue', 'log_info']
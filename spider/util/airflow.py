@@ -1,10 +1,212 @@
-from airflow.api.common.experimental import pool
+import gzip
+import hashlib
+import io
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
 
+from spider.constant import XCOM_CACHE_MAX_SIZE, XCOM_OFFLOAD_DIR, XCOM_OFFLOAD_GCS_PREFIX, XCOM_OFFLOAD_THRESHOLD
+from spider.util import log_info
 
-def create_pool(name: str, slots: int, description: str):
-    return pool.create_pool(name, slots, description)
+# Marks the XCom values which are references to offloaded payloads.
+XCOM_REFERENCE_KEY = '__spider_xcom_reference__'
+# Scheme of the references to payloads in `XCOM_OFFLOAD_DIR`.
+LOCAL_XCOM_SCHEME = 'file://'
+# Executors running all the tasks on one machine, which can share payloads on its disk.
+LOCAL_EXECUTORS = {'SequentialExecutor', 'LocalExecutor', 'DebugExecutor'}
 
+_xcom_payload_cache = OrderedDict()
+_xcom_payload_cache_lock = threading.Lock()
 
-def get_task_xcom(task_id, context):
+
+def create_pool(name: str, slots: int, description: str, session=None):
+    """
+    Creates the pool, or updates the slots and description of an existing one.
+    """
+    from airflow.api.common.experimental import pool
+    if session is None:
+        return pool.create_pool(name, slots, description)
+    return pool.create_pool(name, slots, description, session=session)
+
+
+def get_executor() -> str:
+    executor = os.getenv('AIRFLOW__CORE__EXECUTOR')
+    if executor:
+        return executor
+    from airflow.configuration import conf
+    return conf.get('core', 'executor')
+
+
+def _get_xcom_run_prefix(dag_id: str, ts_nodash: str, gcs_prefix: Optional[str] = None) -> str:
+    """
+    Returns the URI prefix of the payloads offloaded by a DAG run, under
+    the GCS prefix if any and in `XCOM_OFFLOAD_DIR` otherwise.
+    """
+    gcs_prefix = gcs_prefix or XCOM_OFFLOAD_GCS_PREFIX
+    if gcs_prefix:
+        return f'{gcs_prefix.rstrip("/")}/{dag_id}/{ts_nodash}'
+    return f'{LOCAL_XCOM_SCHEME}{os.path.abspath(XCOM_OFFLOAD_DIR)}/{dag_id}/{ts_nodash}'
+
+
+def _get_xcom_storage_client(storage_client=None):
+    if storage_client is not None:
+        return storage_client
+    from spider.constant import get_storage_client
+    return get_storage_client()
+
+
+def _write_xcom_payload(uri: str, payload: bytes, storage_client=None) -> None:
+    if uri.startswith(LOCAL_XCOM_SCHEME):
+        path = uri[len(LOCAL_XCOM_SCHEME):]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(payload)
+        os.replace(temporary_path, path)
+        return
+
+    from spider.util.storage import upload_file_to_gcs
+    upload_file_to_gcs(_get_xcom_storage_client(storage_client), io.BytesIO(payload), uri, 'application/gzip')
+
+
+def _read_xcom_payload(uri: str, storage_client=None) -> bytes:
+    if uri.startswith(LOCAL_XCOM_SCHEME):
+        with open(uri[len(LOCAL_XCOM_SCHEME):], 'rb') as file:
+            return file.read()
+
+    from spider.util.storage import download_file_from_gcs
+    return download_file_from_gcs(_get_xcom_storage_client(storage_client), uri, io.BytesIO()).getvalue()
+
+
+def _delete_xcom_payloads(uri_prefix: str, storage_client=None) -> int:
+    """
+    Deletes the payloads whose URI starts with the prefix and returns
+    their number.
+    """
+    if not uri_prefix.startswith(LOCAL_XCOM_SCHEME):
+        from spider.util.storage import delete_gcs_prefix
+        return delete_gcs_prefix(_get_xcom_storage_client(storage_client), uri_prefix)
+
+    path_prefix = uri_prefix[len(LOCAL_XCOM_SCHEME):]
+    deleted = 0
+    for dirpath, _, filenames in os.walk(os.path.dirname(path_prefix)):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path.startswith(path_prefix):
+                os.remove(path)
+                deleted += 1
+    return deleted
+
+
+class XComReference(NamedTuple):
+    uri: str
+    sha256: str
+    size: int
+
+    @classmethod
+    def from_xcom(cls, value: Any) -> Optional['XComReference']:
+        if isinstance(value, dict) and value.get(XCOM_REFERENCE_KEY):
+            return cls(value['uri'], value['sha256'], value['size'])
+        return None
+
+    def to_xcom(self) -> dict:
+        return {XCOM_REFERENCE_KEY: True, 'uri': self.uri, 'sha256': self.sha256, 'size': self.size}
+
+    def load(self, storage_client=None) -> Any:
+        """
+        Downloads the payload, or takes it from the cache of this process,
+        verifies its checksum and returns the unpickled value.
+        """
+        return pickle.loads(gzip.decompress(_get_xcom_payload(self, storage_client)))
+
+
+def _get_xcom_payload(reference: XComReference, storage_client=None) -> bytes:
+    with _xcom_payload_cache_lock:
+        payload = _xcom_payload_cache.get(reference.sha256)
+        if payload is not None:
+            _xcom_payload_cache.move_to_end(reference.sha256)
+            return payload
+
+    payload = _read_xcom_payload(reference.uri, storage_client)
+    if hashlib.sha256(payload).hexdigest() != reference.sha256:
+        raise ValueError(f'Checksum mismatch of the XCom payload {reference.uri}')
+
+    with _xcom_payload_cache_lock:
+        _xcom_payload_cache[reference.sha256] = payload
+        cache_size = sum(len(cached) for cached in _xcom_payload_cache.values())
+        while cache_size > XCOM_CACHE_MAX_SIZE and len(_xcom_payload_cache) > 1:
+            _, evicted = _xcom_payload_cache.popitem(last=False)
+            cache_size -= len(evicted)
+    return payload
+
+
+def push_task_xcom(value: Any, context: dict, key: str = 'return_value',
+                   threshold: int = XCOM_OFFLOAD_THRESHOLD, storage_client=None,
+                   gcs_prefix: Optional[str] = None) -> Any:
+    """
+    Pushes the value as an XCom of the running task. Values pickled to more
+    than `threshold` bytes are stored gzipped in the XCom store and only a
+    reference with their checksum goes into the Airflow database. Without a
+    GCS prefix the payloads stay on the local disk, which is only allowed
+    with the `LOCAL_EXECUTORS` as the tasks of other executors may run on
+    other workers. The payloads left by a previous try of the task are
+    replaced. Returns what was pushed.
+    """
     task_instance = context['task_instance']
-    return task_instance.xcom_pull(task_ids=task_id)
+    pickled = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(pickled) <= threshold:
+        task_instance.xcom_push(key=key, value=value)
+        return value
+    if not (gcs_prefix or XCOM_OFFLOAD_GCS_PREFIX) and get_executor() not in LOCAL_EXECUTORS:
+        raise ValueError(f'The XCom {key} of {len(pickled)} bytes must be offloaded, which requires '
+                         f'XCOM_OFFLOAD_GCS_PREFIX with the {get_executor()}')
+
+    payload = gzip.compress(pickled)
+    sha256 = hashlib.sha256(payload).hexdigest()
+    key_prefix = (f'{_get_xcom_run_prefix(task_instance.dag_id, context["ts_nodash"], gcs_prefix)}/'
+                  f'{task_instance.task_id}/{key}-')
+    # Airflow clears the XComs of a task when it runs again, but not the payloads.
+    _delete_xcom_payloads(key_prefix, storage_client)
+    uri = f'{key_prefix}{sha256[:16]}.pickle.gz'
+    _write_xcom_payload(uri, payload, storage_client)
+    reference = XComReference(uri, sha256, len(payload))
+    task_instance.xcom_push(key=key, value=reference.to_xcom())
+    log_info(f'Offloaded the XCom {key} of {len(pickled)} bytes to {uri}.')
+    return reference.to_xcom()
+
+
+def pull_task_xcom(task_id: str, context: dict, key: str = 'return_value',
+                   lazy: bool = False, storage_client=None) -> Any:
+    """
+    Pulls an XCom pushed by `push_task_xcom`. Offloaded values are
+    downloaded unless `lazy`, in which case their `XComReference` is
+    returned to be loaded when needed.
+    """
+    task_instance = context['task_instance']
+    value = task_instance.xcom_pull(task_ids=task_id, key=key)
+    reference = XComReference.from_xcom(value)
+    if reference is None or lazy:
+        return reference or value
+    return reference.load(storage_client)
+
+
+def delete_task_xcom_payloads(context: dict, task_id: Optional[str] = None, storage_client=None,
+                              gcs_prefix: Optional[str] = None) -> int:
+    """
+    Deletes the payloads offloaded by the task, or by every task of the DAG
+    run without `task_id`, and returns their number. Meant for the
+    `on_success_callback` of the DAG, once no task pulls them anymore.
+    """
+    dag_run = context['dag_run']
+    uri_prefix = f'{_get_xcom_run_prefix(dag_run.dag_id, context["ts_nodash"], gcs_prefix)}/'
+    if task_id is not None:
+        uri_prefix += f'{task_id}/'
+    deleted = _delete_xcom_payloads(uri_prefix, storage_client)
+    log_info(f'Deleted {deleted} offloaded XCom payloads under {uri_prefix}.')
+    return deleted
+
+
+def get_task_xcom(task_id, context, lazy=False):
+    return pull_task_xcom(task_id, context, lazy=lazy)
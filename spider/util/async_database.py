@@ -0,0 +1,191 @@
+"""
+Asyncio counterparts of the BigQuery helpers in `spider.util.database`.
+
+Jobs are submitted on the event loop's default executor, since the client
+is blocking, and then awaited by polling with exponential backoff, so a
+single task can run many small loads, queries and copies concurrently.
+"""
+
+import asyncio
+import functools
+from typing import IO, Any, Awaitable, Callable, Iterable, List, Union
+
+from google.cloud import bigquery
+
+from spider.util import log_info
+from spider.util.instrument import record_job_metrics
+from spider.util.database import (
+    _csv_load_job_config, _destination_query_job_config, _json_load_job_config, _submit_load_job,
+    dict_iterable_to_ndjson_buffer, get_table_reference, update_bigquery_view
+)
+
+Job = Union[bigquery.LoadJob, bigquery.QueryJob, bigquery.CopyJob]
+
+JOB_POLL_INITIAL_DELAY = 0.5
+JOB_POLL_MAX_DELAY = 16.0
+JOB_POLL_MULTIPLIER = 2.0
+
+
+async def run_blocking(function: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+async def wait_for_job(
+        job: Job,
+        initial_delay: float = JOB_POLL_INITIAL_DELAY,
+        max_delay: float = JOB_POLL_MAX_DELAY,
+        multiplier: float = JOB_POLL_MULTIPLIER) -> Job:
+    """
+    Polls a job until it is done, sleeping `initial_delay` seconds and
+    then `multiplier` times longer between polls, up to `max_delay`.
+    Raises the error of a failed job like `job.result()`.
+    """
+    delay = initial_delay
+    while not await run_blocking(job.done):
+        await asyncio.sleep(delay)
+        delay = min(delay * multiplier, max_delay)
+    await run_blocking(job.result)
+    return job
+
+
+async def async_upload_json_file_to_bigquery(
+    bigquery_client: bigquery.Client,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        source_file: IO,
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE) -> str:
+    table_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+    job_config = _json_load_job_config(schema, write_disposition)
+    with record_job_metrics('load', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        job = await run_blocking(_submit_load_job, bigquery_client, source_file, table_ref, job_config)
+        await wait_for_job(job)
+        metrics.observe_job(job)
+    log_info(
+        f'Loaded {job.output_rows} rows into {destination_dataset_id}:{destination_table_id}.')
+    return job.job_id
+
+
+async def async_upload_json_to_bigquery(
+    bigquery_client: bigquery.Client,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        source_filepath: str,
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE) -> str:
+    with open(source_filepath, 'rb') as source_file:
+        return await async_upload_json_file_to_bigquery(
+            bigquery_client, destination_dataset_id, destination_table_id,
+            source_file, schema, write_disposition)
+
+
+async def async_upload_dict_list_to_bigquery(
+    bigquery_client: bigquery.Client,
+        dict_list: Iterable[dict],
+        destination_dataset_id: str,
+        destination_table_id: str,
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE) -> str:
+    source_file = await run_blocking(dict_iterable_to_ndjson_buffer, dict_list)
+    with source_file:
+        return await async_upload_json_file_to_bigquery(
+            bigquery_client, destination_dataset_id, destination_table_id,
+            source_file, schema, write_disposition)
+
+
+async def async_upload_csv_to_bigquery(
+    bigquery_client: bigquery.Client,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        source_filepath: str,
+        schema: List[bigquery.schema.SchemaField],
+        leading_rows: int = 1,
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE) -> str:
+    table_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+    job_config = _csv_load_job_config(schema, write_disposition, leading_rows)
+    with record_job_metrics('load', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        with open(source_filepath, 'rb') as source_file:
+            job = await run_blocking(_submit_load_job, bigquery_client, source_file, table_ref, job_config)
+        await wait_for_job(job)
+        metrics.observe_job(job)
+    log_info(
+        f'Loaded {job.output_rows} rows into {destination_dataset_id}:{destination_table_id}.')
+    return job.job_id
+
+
+async def async_load_query_to_bigquery_table(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        location: str = 'US',
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
+        create_disposition: str = bigquery.CreateDisposition.CREATE_IF_NEEDED) -> str:
+    table_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+    job_config = _destination_query_job_config(table_ref, write_disposition, create_disposition)
+    with record_job_metrics('query', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        query_job = await run_blocking(bigquery_client.query, sql, location=location, job_config=job_config)
+        await wait_for_job(query_job)
+        metrics.observe_job(query_job)
+    log_info(f'Query results loaded to table {table_ref.path} with job {query_job.job_id}')
+    return query_job.job_id
+
+
+async def async_copy_to_table(
+    bigquery_client: bigquery.Client,
+        source_dataset_id: str,
+        source_table_id: str,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        write_disposition: str = bigquery.WriteDisposition.WRITE_EMPTY) -> str:
+    source_ref = get_table_reference(bigquery_client, source_dataset_id, source_table_id)
+    destination_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+    job_config = bigquery.CopyJobConfig()
+    job_config.write_disposition = write_disposition
+    with record_job_metrics('copy', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        copy_job = await run_blocking(bigquery_client.copy_table, source_ref, destination_ref, job_config=job_config)
+        await wait_for_job(copy_job)
+        metrics.observe_job(copy_job)
+    log_info(f'Copied {source_ref.path} to {destination_ref.path} with job {copy_job.job_id}')
+    return copy_job.job_id
+
+
+async def async_update_bigquery_view(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        dataset_id: str,
+        table_id: str) -> bigquery.Table:
+    return await run_blocking(update_bigquery_view, bigquery_client, sql, dataset_id, table_id)
+
+
+async def gather_with_concurrency(
+        max_concurrency: int,
+        *awaitables: Awaitable,
+        return_exceptions: bool = False) -> List[Any]:
+    """
+    `asyncio.gather` running at most `max_concurrency` awaitables at once.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(awaitable: Awaitable) -> Any:
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*map(run, awaitables), return_exceptions=return_exceptions)
+
+
+def run_concurrently(
+        awaitables: Iterable[Awaitable],
+        max_concurrency: int = 16,
+        return_exceptions: bool = False) -> List[Any]:
+    """
+    Runs the awaitables, e.g. `async_upload_json_to_bigquery(...)` calls,
+    on a new event loop from synchronous code such as an Airflow task.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather_with_concurrency(
+            max_concurrency, *awaitables, return_exceptions=return_exceptions))
+    finally:
+        loop.close()
@@ -0,0 +1,138 @@
+"""
+Concurrent reads of many small files, such as the secrets and project ids
+read at task start up, with an in-process cache.
+
+Every file is read once in binary mode and decoded afterwards, so binary
+content is detected without reading the file a second time. The module only
+depends on the standard library so that `spider.constant` can use it, and
+imports asyncio and the thread pool on first use to keep that import cheap.
+"""
+
+import locale
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+FileContent = Union[str, bytes]
+
+MAX_CONCURRENT_READS = 32
+
+_file_cache: Dict[str, FileContent] = {}
+_file_cache_lock = threading.Lock()
+
+
+def decode_file_content(data: bytes) -> FileContent:
+    """
+    Decodes the content like a file opened with mode 'r' would, or
+    returns the bytes unchanged if they are not valid text.
+    """
+    try:
+        text = data.decode(locale.getpreferredencoding(False))
+    except UnicodeDecodeError:
+        return data
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def read_file_content(filepath: str) -> FileContent:
+    with open(filepath, 'rb') as file:
+        return decode_file_content(file.read())
+
+
+def _cache_key(filepath: str) -> str:
+    return os.path.abspath(filepath)
+
+
+def get_cached_file(filepath: str) -> FileContent:
+    """
+    Reads a file once per process and serves it from memory afterwards,
+    until `invalidate_file_cache` is called.
+    """
+    key = _cache_key(filepath)
+    try:
+        return _file_cache[key]
+    except KeyError:
+        pass
+
+    content = read_file_content(filepath)
+    with _file_cache_lock:
+        return _file_cache.setdefault(key, content)
+
+
+def _get_cached_files(filepaths: List[str], use_cache: bool) -> Tuple[Dict[str, FileContent], List[str]]:
+    """
+    Returns the cached content by path and the paths that must be read.
+    """
+    contents = {}
+    missing = []
+    for filepath in filepaths:
+        content = _file_cache.get(_cache_key(filepath)) if use_cache else None
+        if content is None:
+            missing.append(filepath)
+        else:
+            contents[filepath] = content
+    return contents, missing
+
+
+def _cache_files(contents: Dict[str, FileContent]) -> None:
+    with _file_cache_lock:
+        for filepath, content in contents.items():
+            _file_cache.setdefault(_cache_key(filepath), content)
+
+
+async def async_read_files(
+        filepaths: Iterable[str],
+        max_concurrency: int = MAX_CONCURRENT_READS,
+        use_cache: bool = True) -> Dict[str, FileContent]:
+    """
+    Reads the files concurrently on a thread pool and returns their
+    content by path. With `use_cache`, cached files are not read again and
+    the files read are added to the cache.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    filepaths = list(dict.fromkeys(filepaths))
+    contents, missing = _get_cached_files(filepaths, use_cache)
+    if missing:
+        loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(missing))) as executor:
+            read_contents = dict(zip(missing, await asyncio.gather(
+                *(loop.run_in_executor(executor, read_file_content, filepath) for filepath in missing))))
+        if use_cache:
+            _cache_files(read_contents)
+        contents.update(read_contents)
+    return {filepath: contents[filepath] for filepath in filepaths}
+
+
+def read_files(
+        filepaths: Iterable[str],
+        max_concurrency: int = MAX_CONCURRENT_READS,
+        use_cache: bool = True) -> Dict[str, FileContent]:
+    """
+    Blocking counterpart of `async_read_files`, which also works while an
+    event loop is running in the calling thread.
+    """
+    filepaths = list(dict.fromkeys(filepaths))
+    contents, missing = _get_cached_files(filepaths, use_cache)
+    if missing:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(missing))) as executor:
+            read_contents = dict(zip(missing, executor.map(read_file_content, missing)))
+        if use_cache:
+            _cache_files(read_contents)
+        contents.update(read_contents)
+    return {filepath: contents[filepath] for filepath in filepaths}
+
+
+def invalidate_file_cache(filepaths: Optional[Iterable[str]] = None) -> None:
+    """
+    Drops the given files, or every file, from the cache so that they are
+    read again on next use, e.g. after secrets were rotated.
+    """
+    with _file_cache_lock:
+        if filepaths is None:
+            _file_cache.clear()
+        else:
+            for filepath in filepaths:
+                _file_cache.pop(_cache_key(filepath), None)
@@ -0,0 +1,114 @@
+"""
+On-disk cache for query results, shared by all tasks running on a worker.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+import time
+from typing import Any, Optional
+
+from spider.constant import QUERY_CACHE_DIR, QUERY_CACHE_MAX_SIZE, QUERY_CACHE_TTL
+from spider.util import log_info
+
+# Quoted strings are kept as they are, comments and runs of whitespace become one space.
+_SQL_TOKEN_REGEX = re.compile(
+    r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|(?:--[^\n]*|/\*.*?\*/|\s)+""", re.DOTALL)
+_MISSING = object()
+
+
+def normalize_sql(sql: str) -> str:
+    return _SQL_TOKEN_REGEX.sub(lambda match: match.group(1) or ' ', sql).strip().rstrip(';').rstrip()
+
+
+def make_query_cache_key(sql: str, parameters: Optional[dict] = None) -> str:
+    key_source = json.dumps([normalize_sql(sql), parameters or {}], sort_keys=True, default=str)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """
+    Pickles values into one file per key. Writes are atomic renames, so
+    several processes can share a directory. Entries expire after their
+    TTL and the oldest entries are evicted once the directory grows over
+    `max_size` bytes. The directory is created with 0700 permissions and
+    is not used if others can access it, as unpickling runs code.
+    """
+
+    def __init__(self, directory: str, max_size: int, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _is_private(self) -> bool:
+        try:
+            stat = os.stat(self.directory)
+        except FileNotFoundError:
+            return False
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, key: str, default: Any = None, ttl: Optional[float] = _MISSING) -> Any:
+        ttl = self.ttl if ttl is _MISSING else ttl
+        if not self._is_private():
+            return default
+        path = self._path(key)
+        try:
+            if ttl is not None and time.time() - os.stat(path).st_mtime > ttl:
+                self.delete(key)
+                return default
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+
+    def set(self, key: str, value: Any) -> None:
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not self._is_private():
+            log_info(f'{self.directory} can be accessed by other users, not caching {key}.')
+            return
+        with tempfile.NamedTemporaryFile('wb', dir=self.directory, suffix='.tmp', delete=False) as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, self._path(key))
+        self.evict()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            log_info(f'Evicted {path} from the query cache.')
+
+    def clear(self) -> None:
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.pickle'):
+                    self.delete(entry.name[:-len('.pickle')])
+
+
+QUERY_RESULT_CACHE = DiskCache(QUERY_CACHE_DIR, QUERY_CACHE_MAX_SIZE, QUERY_CACHE_TTL)
@@ -1,15 +1,44 @@
+import functools
+import gzip
+import http.client
+import io
+import itertools
 import json
+import operator
+import os
+import re
+import statistics
 import tempfile
-from typing import Iterable, List
+import time
+import uuid
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from typing import (
+    IO, TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+)
 
-import pandas
-from airflow.contrib.hooks.bigquery_hook import BigQueryHook
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import (
+    Conflict, GoogleAPICallError, NotFound, ServerError, TooManyRequests
+)
 from google.cloud import bigquery
-from more_itertools import first_true, grouper, always_iterable
 
-from spider.constant import BIGQUERY_LOCATION
+from spider.constant import (
+    BIGQUERY_LOCATION, BIGQUERY_LOAD_CHUNK_BYTES, BIGQUERY_LOAD_COMPRESS_LEVEL, BIGQUERY_LOAD_MAX_MEMORY_SIZE,
+    BIGQUERY_LOAD_MAX_RETRIES, BIGQUERY_LOAD_MIN_CHUNK_BYTES, BIGQUERY_LOAD_RETRY_INITIAL_DELAY,
+    BIGQUERY_LOAD_RETRY_MAX_DELAY, BIGQUERY_LOAD_RETRY_MULTIPLIER, SCHEMA_SNAPSHOT_FILEPATH
+)
 from spider.util import log_info
+from spider.util.cache import QUERY_RESULT_CACHE, make_query_cache_key
+from spider.util.instrument import JobMetrics, record_job_metrics
+from spider.util.iterator import imap_unordered, iter_dataframe_chunks, prefetch
+
+# pandas, pyarrow, airflow and more_itertools are imported where they are used,
+# keeping them out of the import time of every DAG that imports this module.
+if TYPE_CHECKING:
+    import pandas
+
+_JSON_ENCODER = json.JSONEncoder()
+_NDJSON_WRITE_BATCH_SIZE = 1000
 
 
 def get_table_reference(
@@ -21,29 +50,75 @@ def get_table_reference(
     return table_ref
 
 
+class SchemaDiff(NamedTuple):
+    """
+    Differences between two schemas. Nested fields are named by their
+    dotted path, changes are (path, old value, new value) tuples.
+    """
+    added: List[str]
+    removed: List[str]
+    retyped: List[Tuple[str, str, str]]
+    remoded: List[Tuple[str, str, str]]
+    redescribed: List[Tuple[str, Optional[str], Optional[str]]]
+
+    @property
+    def has_changes(self) -> bool:
+        return any(self)
+
+
 def merge_schema(
         old_schema: List[bigquery.schema.SchemaField],
         new_schema: List[bigquery.schema.SchemaField]) -> List[bigquery.schema.SchemaField]:
-
+    """
+    Returns `new_schema` with the descriptions of `old_schema`,
+    matching fields by name at every level of nested RECORD fields.
+    """
     if old_schema is None:
         return new_schema
 
+    old_fields_by_name = {old_field.name: old_field for old_field in old_schema}
     merged_schema = []
     for new_field in new_schema:
-        old_field = first_true(old_schema, default=None,
-                               pred=lambda old_field: old_field.name == new_field.name)
+        old_field = old_fields_by_name.get(new_field.name)
         updated_field = bigquery.schema.SchemaField(
             name=new_field.name,
             field_type=new_field.field_type,
             description=old_field.description if old_field is not None else None,
             mode=new_field.mode,
-            fields=new_field.fields
+            fields=tuple(merge_schema(old_field.fields if old_field is not None else (), new_field.fields))
         )
         merged_schema.append(updated_field)
 
     return merged_schema
 
 
+def diff_schema(
+        old_schema: List[bigquery.schema.SchemaField],
+        new_schema: List[bigquery.schema.SchemaField],
+        _prefix: str = '') -> SchemaDiff:
+    diff = SchemaDiff(added=[], removed=[], retyped=[], remoded=[], redescribed=[])
+    old_fields_by_name = {old_field.name: old_field for old_field in old_schema or ()}
+    new_field_names = set()
+    for new_field in new_schema or ():
+        path = _prefix + new_field.name
+        new_field_names.add(new_field.name)
+        old_field = old_fields_by_name.get(new_field.name)
+        if old_field is None:
+            diff.added.append(path)
+            continue
+        if old_field.field_type != new_field.field_type:
+            diff.retyped.append((path, old_field.field_type, new_field.field_type))
+        if old_field.mode != new_field.mode:
+            diff.remoded.append((path, old_field.mode, new_field.mode))
+        if old_field.description != new_field.description:
+            diff.redescribed.append((path, old_field.description, new_field.description))
+        for nested_changes, changes in zip(diff_schema(old_field.fields, new_field.fields, path + '.'), diff):
+            changes.extend(nested_changes)
+
+    diff.removed.extend(_prefix + name for name in old_fields_by_name if name not in new_field_names)
+    return diff
+
+
 def get_table_schema(
     bigquery_client: bigquery.Client,
         dataset_id: str,
@@ -83,6 +158,10 @@ def persist_table_schema(
     new_schema = get_table_schema(bigquery_client, dataset_id, table_id)
     persisted_schema = merge_schema(old_schema, new_schema)
 
+    if not diff_schema(new_schema, persisted_schema).has_changes:
+        log_info(f'Schema of {dataset_id}.{table_id} is up to date.')
+        return new_schema
+
     updated_table = update_table_schema(
         bigquery_client, dataset_id, table_id, persisted_schema)
     return updated_table.schema
@@ -102,44 +181,407 @@ def get_dataset_id_list(bigquery_client: bigquery.Client) -> list:
             list(bigquery_client.list_datasets())]
 
 
+def get_table_modified_times(
+    bigquery_client: bigquery.Client,
+        dataset_id: str) -> Dict[str, int]:
+    """
+    Returns the last modification time, in milliseconds, of every table
+    in a dataset with a single metadata query instead of one API call
+    per table.
+    """
+    rows = bigquery_client.query(
+        f'SELECT table_id, last_modified_time '
+        f'FROM `{bigquery_client.project}.{dataset_id}.__TABLES__`',
+        location=BIGQUERY_LOCATION
+    ).result()
+    return {row.table_id: row.last_modified_time for row in rows}
+
+
+class TableSchemaPersistence(NamedTuple):
+    dataset_id: str
+    table_id: str
+    # updated, unchanged, cached (unchanged since the snapshot), skipped (no schema table) or failed
+    status: str
+    seconds: float
+
+
+class SchemaPersistenceSummary(NamedTuple):
+    tables: List[TableSchemaPersistence]
+    seconds: float
+
+    def count(self, status: str) -> int:
+        return sum(table.status == status for table in self.tables)
+
+
+def _read_schema_snapshot(snapshot_filepath: str) -> dict:
+    try:
+        with open(snapshot_filepath, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_schema_snapshot(snapshot_filepath: str, snapshot: dict) -> None:
+    os.makedirs(os.path.dirname(snapshot_filepath), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(snapshot_filepath), suffix='.tmp', delete=False) as file:
+        json.dump(snapshot, file, sort_keys=True)
+    os.replace(file.name, snapshot_filepath)
+
+
+def persist_dataset_schemas(
+    bigquery_client: bigquery.Client,
+        schema_dataset_id: str,
+        dataset_ids: Iterable[str],
+        max_workers: int = 8,
+        snapshot_filepath: Optional[str] = SCHEMA_SNAPSHOT_FILEPATH) -> SchemaPersistenceSummary:
+    """
+    Persists the descriptions of the tables in `schema_dataset_id` onto
+    the tables of the same name in every dataset of `dataset_ids`, like
+    `persist_table_schema`, on `max_workers` threads.
+
+    The modification times of both tables are kept in a local snapshot
+    file, so tables that did not change since they were last persisted
+    are not fetched again.
+    """
+    start = time.perf_counter()
+    snapshot = _read_schema_snapshot(snapshot_filepath) if snapshot_filepath else {}
+    schema_modified_times = get_table_modified_times(bigquery_client, schema_dataset_id)
+
+    def iter_tables():
+        for dataset_id in dataset_ids:
+            for table_id, modified_time in get_table_modified_times(bigquery_client, dataset_id).items():
+                yield dataset_id, table_id, modified_time
+
+    def persist(table) -> Tuple[TableSchemaPersistence, Optional[list]]:
+        dataset_id, table_id, modified_time = table
+        table_start = time.perf_counter()
+        schema_modified_time = schema_modified_times.get(table_id)
+        versions = [modified_time, schema_modified_time]
+        if schema_modified_time is None:
+            status = 'skipped'
+        elif snapshot.get(f'{dataset_id}.{table_id}') == versions:
+            status = 'cached'
+        else:
+            try:
+                new_schema = get_table_schema(bigquery_client, dataset_id, table_id)
+                persisted_schema = merge_schema(
+                    get_table_schema(bigquery_client, schema_dataset_id, table_id), new_schema)
+                if diff_schema(new_schema, persisted_schema).has_changes:
+                    updated_table = update_table_schema(bigquery_client, dataset_id, table_id, persisted_schema)
+                    versions[0] = int(updated_table.modified.timestamp() * 1000)
+                    status = 'updated'
+                else:
+                    status = 'unchanged'
+            except Exception as e:
+                log_info(f'Failed to persist the schema of {dataset_id}.{table_id}: {e}')
+                status = 'failed'
+        result = TableSchemaPersistence(dataset_id, table_id, status, time.perf_counter() - table_start)
+        return result, versions if status in ('updated', 'unchanged', 'cached') else None
+
+    tables = []
+    for result, versions in imap_unordered(persist, iter_tables(), max_workers):
+        tables.append(result)
+        key = f'{result.dataset_id}.{result.table_id}'
+        if versions is None:
+            snapshot.pop(key, None)
+        else:
+            snapshot[key] = versions
+
+    if snapshot_filepath:
+        _write_schema_snapshot(snapshot_filepath, snapshot)
+
+    summary = SchemaPersistenceSummary(tables, time.perf_counter() - start)
+    fetched_seconds = [table.seconds for table in tables if table.status in ('updated', 'unchanged', 'failed')]
+    log_info(
+        f'Persisted schemas of {len(tables)} tables in {summary.seconds:.1f}s: '
+        + ', '.join(f'{status} {summary.count(status)}'
+                    for status in ('updated', 'unchanged', 'cached', 'skipped', 'failed'))
+        + (f', median {statistics.median(fetched_seconds):.2f}s and max {max(fetched_seconds):.2f}s per fetched table'
+           if fetched_seconds else ''))
+    return summary
+
+
 def copy_to_table(source_dataset_id: str,
                   source_table_id: str,
                   destination_dataset_id: str,
                   destination_table_id: str,
                   bigquery_conn_id: str) -> str:
-    hook = BigQueryHook(bigquery_conn_id)
-    conn = hook.get_conn()
-    cursor = conn.cursor()
-    job_id = cursor.run_copy(
-        source_project_dataset_tables='{dataset_id}.{table_id}'.format(
-            dataset_id=source_dataset_id, table_id=source_table_id
-        ),
-        destination_project_dataset_table='{dataset_id}.{table_id}'.format(
-            dataset_id=destination_dataset_id, table_id=destination_table_id
-        )
+    from airflow.contrib.hooks.bigquery_hook import BigQueryHook
+
+    destination = '{dataset_id}.{table_id}'.format(
+        dataset_id=destination_dataset_id, table_id=destination_table_id
     )
+    with record_job_metrics('copy', destination) as metrics:
+        hook = BigQueryHook(bigquery_conn_id)
+        conn = hook.get_conn()
+        cursor = conn.cursor()
+        job_id = cursor.run_copy(
+            source_project_dataset_tables='{dataset_id}.{table_id}'.format(
+                dataset_id=source_dataset_id, table_id=source_table_id
+            ),
+            destination_project_dataset_table=destination
+        )
+        metrics.set('job_ids', [job_id])
     return job_id
 
 
+class CopySpec(NamedTuple):
+    """
+    Tables are given as `dataset.table` or `project.dataset.table`,
+    optionally with a `$partition` decorator on the table.
+    """
+    sources: List[str]
+    destination: str
+    write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE
+
+
+class CopyResult(NamedTuple):
+    destination: str
+    job_id: str
+    seconds: float
+    queued_seconds: Optional[float]
+    running_seconds: Optional[float]
+
+
+def get_table_reference_from_path(
+    bigquery_client: bigquery.Client,
+        table_path: str) -> bigquery.TableReference:
+    """
+    Parses `[project.]dataset.table[$decorator]`, e.g. a partition
+    `dataset.table$20190101`, or the legacy `project:dataset.table`. The
+    project may be domain scoped and so contain dots, the decorator is
+    kept on the table id.
+    """
+    table_path, separator, decorator = table_path.partition('$')
+    project, colon, dataset_table = table_path.rpartition(':')
+    if colon and dataset_table.count('.') == 1:
+        dataset_id, table_id = dataset_table.split('.')
+        if not (project and dataset_id and table_id):
+            raise ValueError(f'Not a table path: {table_path}{separator}{decorator}')
+        return bigquery.DatasetReference(project, dataset_id).table(table_id + separator + decorator)
+    path_parts = table_path.rsplit('.', 2)
+    if len(path_parts) < 2:
+        raise ValueError(f'Not a table path: {table_path}{separator}{decorator}')
+    table_id = path_parts[-1] + separator + decorator
+    if len(path_parts) == 2:
+        return get_table_reference(bigquery_client, path_parts[0], table_id)
+    return bigquery.DatasetReference(path_parts[0], path_parts[1]).table(table_id)
+
+
+def _seconds_between(start, end) -> Optional[float]:
+    return (end - start).total_seconds() if start and end else None
+
+
+def copy_tables(
+    bigquery_client: bigquery.Client,
+        copy_specs: Iterable[CopySpec],
+        max_workers: int = 8) -> List[CopyResult]:
+    """
+    Runs one copy job per spec, each copying one or more source tables
+    into its destination, with up to `max_workers` jobs at once on the
+    same client. Results are returned in completion order and their
+    timings are logged so that slow copies stand out.
+    """
+    def copy(copy_spec: CopySpec) -> CopyResult:
+        start = time.perf_counter()
+        job_config = bigquery.CopyJobConfig()
+        job_config.write_disposition = copy_spec.write_disposition
+        with record_job_metrics('copy', copy_spec.destination) as metrics:
+            copy_job = bigquery_client.copy_table(
+                [get_table_reference_from_path(bigquery_client, source) for source in copy_spec.sources],
+                get_table_reference_from_path(bigquery_client, copy_spec.destination),
+                location=BIGQUERY_LOCATION,
+                job_config=job_config)
+            copy_job.result()
+            metrics.observe_job(copy_job)
+        result = CopyResult(
+            destination=copy_spec.destination,
+            job_id=copy_job.job_id,
+            seconds=time.perf_counter() - start,
+            queued_seconds=_seconds_between(copy_job.created, copy_job.started),
+            running_seconds=_seconds_between(copy_job.started, copy_job.ended))
+        log_info(
+            f'Copied {", ".join(copy_spec.sources)} to {copy_spec.destination} with job {result.job_id} '
+            f'in {result.seconds:.1f}s (queued {result.queued_seconds}s, ran {result.running_seconds}s).')
+        return result
+
+    return list(imap_unordered(copy, copy_specs, max_workers))
+
+
+def _json_load_job_config(
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: str) -> bigquery.LoadJobConfig:
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+    job_config.schema = schema
+    job_config.write_disposition = write_disposition
+    return job_config
+
+
+def _submit_load_job(
+    bigquery_client: bigquery.Client,
+        source_file: IO,
+        table_ref: bigquery.TableReference,
+        job_config: bigquery.LoadJobConfig,
+        job_id: Optional[str] = None) -> bigquery.LoadJob:
+    source_file.seek(0)
+    try:
+        return bigquery_client.load_table_from_file(
+            source_file,
+            table_ref,
+            job_id=job_id,
+            location=BIGQUERY_LOCATION,
+            job_config=job_config,
+        )
+    except Conflict:
+        if job_id is None:
+            raise
+        # An earlier attempt created the job but its response got lost, reuse it instead of loading twice.
+        log_info(f'Load job {job_id} already exists, waiting for it instead.')
+        return bigquery_client.get_job(job_id, location=BIGQUERY_LOCATION)
+
+
+def _run_load_job(
+    bigquery_client: bigquery.Client,
+        source_file: IO,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        job_config: bigquery.LoadJobConfig,
+        metrics: JobMetrics) -> bigquery.LoadJob:
+    table_ref = get_table_reference(
+        bigquery_client, destination_dataset_id, destination_table_id)
+    job = _submit_load_job(bigquery_client, source_file, table_ref, job_config)
+
+    job.result()
+    metrics.observe_job(job)
+    log_info(
+        f'Loaded {job.output_rows} rows into {destination_dataset_id}:{destination_table_id}.')
+    return job
+
+
+def write_ndjson(
+        dict_iterable: Iterable[dict],
+        file: IO,
+        compress: bool = True,
+        compresslevel: int = BIGQUERY_LOAD_COMPRESS_LEVEL,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None) -> int:
+    """
+    Encodes rows as newline delimited JSON into a binary file, gzipped
+    if `compress` is set, and returns the number of rows written.
+    Rows are encoded and written in batches to avoid one write per row.
+
+    With `max_rows` or `max_bytes` (of uncompressed NDJSON) only as many
+    rows are taken from `dict_iterable` as fit, so that an iterator can be
+    written to several files in turn. Batches are sized from the average
+    row size so far, so a file overshoots `max_bytes` by about one row.
+    """
+    rows_iterator = iter(dict_iterable)
+    stream = gzip.GzipFile(fileobj=file, mode='wb', compresslevel=compresslevel) \
+        if compress else file
+    row_count = 0
+    byte_count = 0
+    try:
+        while max_rows is None or row_count < max_rows:
+            batch_size = _NDJSON_WRITE_BATCH_SIZE
+            if max_rows is not None:
+                batch_size = min(batch_size, max_rows - row_count)
+            if max_bytes is not None:
+                if byte_count >= max_bytes:
+                    break
+                if row_count:
+                    batch_size = min(batch_size, int((max_bytes - byte_count) * row_count / byte_count) + 1)
+                else:
+                    batch_size = 1
+            rows = list(itertools.islice(rows_iterator, batch_size))
+            if not rows:
+                break
+            data = ('\n'.join(map(_JSON_ENCODER.encode, rows)) + '\n').encode('utf-8')
+            stream.write(data)
+            row_count += len(rows)
+            byte_count += len(data)
+    finally:
+        if compress:
+            stream.close()  # Flushes the gzip trailer, leaves `file` open.
+    return row_count
+
+
+def dict_iterable_to_ndjson_buffer(
+        dict_iterable: Iterable[dict],
+        compress: bool = True,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE) -> IO:
+    """
+    Returns a rewound buffer holding the rows as (gzipped) NDJSON.
+    The buffer is kept in memory until it grows over `max_memory_size`
+    bytes, after which it is transparently rolled over to a temp file.
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory_size, mode='w+b')
+    write_ndjson(dict_iterable, buffer, compress=compress)
+    buffer.seek(0)
+    return buffer
+
+
+def _csv_load_job_config(
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: str,
+        leading_rows: int = 1,
+        allow_quoted_newlines: bool = False) -> bigquery.LoadJobConfig:
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = bigquery.SourceFormat.CSV
+    job_config.skip_leading_rows = leading_rows
+    job_config.allow_quoted_newlines = allow_quoted_newlines
+    job_config.schema = schema
+    job_config.write_disposition = write_disposition
+    return job_config
+
+
+def _parquet_load_job_config(
+        schema: Optional[List[bigquery.schema.SchemaField]],
+        write_disposition: str) -> bigquery.LoadJobConfig:
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+    if schema is not None:
+        job_config.schema = schema
+    job_config.write_disposition = write_disposition
+    return job_config
+
+
 def upload_dict_list_to_bigquery(
     bigquery_client: bigquery.Client,
-        dict_list: List[dict],
+        dict_list: Iterable[dict],
         destination_dataset_id: str,
         destination_table_id: str,
         schema: List[bigquery.schema.SchemaField],
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE):
-    with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
-        for dict in dict_list:
-            file.write(json.dumps(dict) + '\n')
-        file.seek(0)
-        upload_json_to_bigquery(
-            bigquery_client=bigquery_client,
-            destination_dataset_id=destination_dataset_id,
-            destination_table_id=destination_table_id,
-            source_filepath=file.name,
-            schema=schema,
-            write_disposition=write_disposition
-        )
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        compress: bool = True,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE) -> str:
+    with record_job_metrics('load', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        with metrics.time_serialization():
+            file = dict_iterable_to_ndjson_buffer(
+                dict_list, compress=compress, max_memory_size=max_memory_size)
+        with file:
+            return _run_load_job(
+                bigquery_client, file, destination_dataset_id, destination_table_id,
+                _json_load_job_config(schema, write_disposition), metrics).job_id
+
+
+def upload_json_file_to_bigquery(
+    bigquery_client: bigquery.Client,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        source_file: IO,
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: bigquery.WriteDisposition = bigquery.WriteDisposition.WRITE_TRUNCATE,
+) -> str:
+    """
+    Loads a binary NDJSON file object, plain or gzipped, without it
+    having to exist on disk.
+    """
+    with record_job_metrics('load', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        return _run_load_job(
+            bigquery_client, source_file, destination_dataset_id, destination_table_id,
+            _json_load_job_config(schema, write_disposition), metrics).job_id
 
 
 def upload_json_to_bigquery(
@@ -152,25 +594,16 @@ def upload_json_to_bigquery(
         write_disposition: bigquery.WriteDisposition = bigquery.WriteDisposition.WRITE_TRUNCATE,
         max_bad_records: int = 0,
 ) -> str:
-    table_ref = get_table_reference(
-        bigquery_client, destination_dataset_id, destination_table_id)
-    job_config = bigquery.LoadJobConfig()
-    job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
-    job_config.schema = schema
-    job_config.write_disposition = write_disposition
     with open(source_filepath, 'rb') as source_file:
-        job = bigquery_client.load_table_from_file(
-            source_file,
-            table_ref,
-            location=BIGQUERY_LOCATION,
-            job_config=job_config,
+        return upload_json_file_to_bigquery(
+            bigquery_client=bigquery_client,
+            destination_dataset_id=destination_dataset_id,
+            destination_table_id=destination_table_id,
+            source_file=source_file,
+            schema=schema,
+            write_disposition=write_disposition
         )
 
-    job.result()
-    log_info(
-        f'Loaded {job.output_rows} rows into {destination_dataset_id}:{destination_table_id}.')
-    return job.job_id
-
 
 def upload_csv_to_bigquery(
     bigquery_client: bigquery.Client,
@@ -183,25 +616,375 @@ def upload_csv_to_bigquery(
         write_disposition: bigquery.WriteDisposition = bigquery.WriteDisposition.WRITE_TRUNCATE,
         max_bad_records: int = 0,
 ) -> str:
+    job_config = _csv_load_job_config(schema, write_disposition, leading_rows)
+    with record_job_metrics('load', f'{destination_dataset_id}.{destination_table_id}') as metrics, \
+            open(source_filepath, 'rb') as source_file:
+        return _run_load_job(
+            bigquery_client, source_file, destination_dataset_id, destination_table_id,
+            job_config, metrics).job_id
+
+
+class ChunkLoadResult(NamedTuple):
+    # A chunk split after a request-size error has one result per part.
+    chunk_index: int
+    job_id: str
+    row_count: int
+    write_disposition: str
+
+
+class _ChunkSizer:
+    """
+    Target size in bytes of the next chunk, halved down to a minimum
+    whenever a chunk was too large for a load request.
+    """
+
+    def __init__(self, chunk_bytes: int, min_chunk_bytes: int = BIGQUERY_LOAD_MIN_CHUNK_BYTES):
+        self.chunk_bytes = chunk_bytes
+        self.min_chunk_bytes = min(min_chunk_bytes, chunk_bytes)
+
+    def shrink(self) -> None:
+        self.chunk_bytes = max(self.chunk_bytes // 2, self.min_chunk_bytes)
+        log_info(f'Chunk size reduced to {self.chunk_bytes} bytes.')
+
+
+class _PendingChunk(NamedTuple):
+    chunk_index: int
+    # Dotted path of the chunk part, e.g. '3' or '3.1' for the second half of chunk 3.
+    part: str
+    source_file: IO
+    job_config: bigquery.LoadJobConfig
+    # None if the load request was rejected as too large, the chunk is then split.
+    job: Optional[bigquery.LoadJob]
+    serialization_seconds: float
+    submit_error: Optional[GoogleAPICallError] = None
+
+
+# Errors after which the same load is tried again.
+_TRANSIENT_ERRORS = (ServerError, TooManyRequests, OSError)
+
+
+def _is_request_too_large(error: GoogleAPICallError) -> bool:
+    message = str(error).lower()
+    return error.code == http.client.REQUEST_ENTITY_TOO_LARGE or \
+        ('too large' in message and 'row' not in message) or 'exceeds the limit' in message
+
+
+def _read_buffer_lines(source_file: IO) -> Tuple[List[bytes], bool]:
+    """
+    Returns the lines of a (gzipped) buffer and whether it was gzipped.
+    """
+    source_file.seek(0)
+    compressed = source_file.read(2) == b'\x1f\x8b'
+    source_file.seek(0)
+    stream = gzip.GzipFile(fileobj=source_file, mode='rb') if compressed else source_file
+    return stream.read().splitlines(keepends=True), compressed
+
+
+def _write_lines_buffer(lines: Iterable[bytes], compressed: bool, max_memory_size: int) -> IO:
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory_size, mode='w+b')
+    with (gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=BIGQUERY_LOAD_COMPRESS_LEVEL)
+          if compressed else _nullcontext(buffer)) as stream:
+        stream.writelines(lines)
+    buffer.seek(0)
+    return buffer
+
+
+def split_ndjson_buffer(
+        source_file: IO,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE) -> Optional[Tuple[IO, IO]]:
+    """
+    Splits a (gzipped) NDJSON buffer into two buffers of half the rows each,
+    compressed like the source, or returns None if it holds a single row.
+    """
+    lines, compressed = _read_buffer_lines(source_file)
+    if len(lines) < 2:
+        return None
+    return (_write_lines_buffer(lines[:len(lines) // 2], compressed, max_memory_size),
+            _write_lines_buffer(lines[len(lines) // 2:], compressed, max_memory_size))
+
+
+def _iter_csv_rows(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Joins the lines into rows. A line break ends a row unless it is inside
+    quotes, i.e. after an odd number of quote characters in the row, as
+    quotes within a quoted value are doubled.
+    """
+    row = []
+    quote_count = 0
+    for line in lines:
+        row.append(line)
+        quote_count += line.count(b'"')
+        if quote_count % 2 == 0:
+            yield b''.join(row)
+            row = []
+            quote_count = 0
+    if row:
+        yield b''.join(row)
+
+
+def split_csv_buffer(
+        source_file: IO,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE,
+        leading_rows: int = 1) -> Optional[Tuple[IO, IO]]:
+    """
+    Splits a (gzipped) CSV buffer like `split_ndjson_buffer`, without
+    cutting quoted values holding line breaks. Both halves start with the
+    `leading_rows` of the source, e.g. its header.
+    """
+    lines, compressed = _read_buffer_lines(source_file)
+    rows = list(_iter_csv_rows(lines))
+    header, rows = rows[:leading_rows], rows[leading_rows:]
+    if len(rows) < 2:
+        return None
+    return (_write_lines_buffer(header + rows[:len(rows) // 2], compressed, max_memory_size),
+            _write_lines_buffer(header + rows[len(rows) // 2:], compressed, max_memory_size))
+
+
+@contextmanager
+def _nullcontext(value):
+    yield value
+
+
+class _ChunkLoader:
+    """
+    Submits and waits for the load jobs of the chunks of one table.
+
+    Transient errors are retried with exponential backoff. A job is only
+    submitted again once it is reloaded and reports that it failed itself;
+    if only polling it failed, the same job is polled again. Every attempt
+    has a deterministic job id, which is reused when only the submission is
+    retried: if the job was created although the request failed, BigQuery
+    answers with a conflict and the existing job is awaited, so a chunk is
+    never appended twice. Chunks rejected as too large are split in halves
+    with `split_chunk_file`, and `chunk_sizer` is shrunk for the next ones.
+    """
+
+    def __init__(
+            self,
+            bigquery_client: bigquery.Client,
+            table_ref: bigquery.TableReference,
+            max_chunk_retries: int,
+            job_id_prefix: str,
+            split_chunk_file: Optional[Callable[[IO], Optional[Tuple[IO, IO]]]] = None,
+            chunk_sizer: Optional[_ChunkSizer] = None):
+        self.bigquery_client = bigquery_client
+        self.table_ref = table_ref
+        self.max_chunk_retries = max_chunk_retries
+        self.job_id_prefix = job_id_prefix
+        self.split_chunk_file = split_chunk_file
+        self.chunk_sizer = chunk_sizer
+
+    def _job_id(self, part: str, attempt: int) -> str:
+        return f'{self.job_id_prefix}_{part.replace(".", "-")}_{attempt}'
+
+    def _sleep_before_retry(self, attempt: int, message: str) -> None:
+        delay = min(BIGQUERY_LOAD_RETRY_INITIAL_DELAY * BIGQUERY_LOAD_RETRY_MULTIPLIER ** attempt,
+                    BIGQUERY_LOAD_RETRY_MAX_DELAY)
+        log_info(f'{message}, retrying in {delay:.1f}s')
+        time.sleep(delay)
+
+    def submit(
+            self,
+            chunk_index: int,
+            part: str,
+            source_file: IO,
+            job_config: bigquery.LoadJobConfig,
+            serialization_seconds: float = 0.0,
+            attempt: int = 0) -> _PendingChunk:
+        job_id = self._job_id(part, attempt)
+        for submit_attempt in itertools.count():
+            try:
+                job = _submit_load_job(self.bigquery_client, source_file, self.table_ref, job_config, job_id)
+                return _PendingChunk(chunk_index, part, source_file, job_config, job, serialization_seconds)
+            except _TRANSIENT_ERRORS as e:
+                if submit_attempt >= self.max_chunk_retries:
+                    source_file.close()
+                    raise
+                self._sleep_before_retry(submit_attempt, f'Submitting load job {job_id} failed: {e}')
+            except GoogleAPICallError as e:
+                if self.split_chunk_file is None or not _is_request_too_large(e):
+                    source_file.close()
+                    raise
+                return _PendingChunk(chunk_index, part, source_file, job_config, None, serialization_seconds, e)
+
+    @staticmethod
+    def _has_failed(job: bigquery.LoadJob) -> bool:
+        """
+        Reloads the job and tells if it finished with an error, as opposed
+        to only the request polling it having failed.
+        """
+        try:
+            job.reload()
+        except _TRANSIENT_ERRORS:
+            return False
+        return job.state == 'DONE' and job.error_result is not None
+
+    def wait(self, pending: _PendingChunk) -> List[ChunkLoadResult]:
+        """
+        Blocks until the chunk is loaded, resubmitting it from its
+        serialized file after transient failures, and returns one result
+        per part it was loaded in.
+        """
+        job = pending.job
+        attempt = 0
+        with record_job_metrics('load', f'{self.table_ref.dataset_id}.{self.table_ref.table_id}') as metrics:
+            metrics.set('chunk_index', pending.chunk_index)
+            metrics.set('serialization_seconds', pending.serialization_seconds)
+            while job is not None:
+                try:
+                    job.result()
+                    break
+                except _TRANSIENT_ERRORS as e:
+                    if attempt >= self.max_chunk_retries:
+                        pending.source_file.close()
+                        raise
+                    self._sleep_before_retry(
+                        attempt, f'Waiting for load job {job.job_id} of chunk {pending.part} failed: {e}')
+                    attempt += 1
+                    if not self._has_failed(job):
+                        # Only the polling request failed, the job may still be running or have succeeded.
+                        continue
+                    job = self.submit(pending.chunk_index, pending.part, pending.source_file,
+                                      pending.job_config, attempt=attempt).job
+                    if job is None:
+                        break
+                except GoogleAPICallError as e:
+                    if self.split_chunk_file is None or not _is_request_too_large(e):
+                        pending.source_file.close()
+                        raise
+                    job = None
+                    break
+            if job is None:
+                # The chunk is split, which is not an error of the load.
+                metrics.set('splits', 1)
+            else:
+                metrics.observe_job(job)
+
+        if job is None:
+            return self._load_split(pending, pending.submit_error)
+        pending.source_file.close()
+        log_info(
+            f'Loaded {job.output_rows} rows into {self.table_ref.dataset_id}:{self.table_ref.table_id} '
+            f'(chunk {pending.part}, job {job.job_id}).')
+        return [ChunkLoadResult(
+            chunk_index=pending.chunk_index,
+            job_id=job.job_id,
+            row_count=job.output_rows,
+            write_disposition=pending.job_config.write_disposition)]
+
+    def _load_split(self, pending: _PendingChunk, error: Optional[GoogleAPICallError]) -> List[ChunkLoadResult]:
+        """
+        Loads the two halves of a chunk that was too large one after the
+        other, the second one appended to the first.
+        """
+        halves = self.split_chunk_file(pending.source_file)
+        pending.source_file.close()
+        if halves is None:
+            raise error or ValueError(f'Chunk {pending.part} holds a single row that is too large to load.')
+        if self.chunk_sizer is not None:
+            self.chunk_sizer.shrink()
+        log_info(f'Chunk {pending.part} is too large for a load request, loading it in two halves.')
+
+        results = []
+        for index, half in enumerate(halves):
+            job_config = bigquery.LoadJobConfig.from_api_repr(pending.job_config.to_api_repr())
+            if index:
+                job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+            results += self.wait(self.submit(pending.chunk_index, f'{pending.part}.{index}', half, job_config))
+        return results
+
+
+def load_chunks_to_bigquery(
+    bigquery_client: bigquery.Client,
+        chunk_files: Iterable[IO],
+        destination_dataset_id: str,
+        destination_table_id: str,
+        job_config_factory: Callable[[str], bigquery.LoadJobConfig],
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
+        max_jobs_in_flight: int = 1,
+        max_chunk_retries: int = BIGQUERY_LOAD_MAX_RETRIES,
+        job_id_prefix: Optional[str] = None,
+        split_chunk_file: Optional[Callable[[IO], Optional[Tuple[IO, IO]]]] = None,
+        chunk_sizer: Optional[_ChunkSizer] = None,
+        empty_chunk_file: Callable[[], IO] = io.BytesIO) -> List[ChunkLoadResult]:
+    """
+    Submits one load job per chunk file while at most `max_jobs_in_flight`
+    jobs are running, so the next chunk is serialized by the (lazy)
+    `chunk_files` iterable while earlier jobs are still being processed.
+    The first chunk is loaded with `write_disposition` and has to finish
+    before any of the remaining chunks is appended. Each chunk file is
+    kept open until its job succeeded and closed afterwards. Without any
+    chunk, a `WRITE_TRUNCATE` still empties the table by loading the file
+    returned by `empty_chunk_file`, which must hold no rows in the format
+    of the job config.
+
+    Failed chunks are retried up to `max_chunk_retries` times as described
+    in `_ChunkLoader`. The job ids start with `job_id_prefix`, a random one
+    by default; passing a prefix that is stable across task retries, e.g.
+    built from the DAG run, makes a retried task reuse the jobs that
+    already succeeded instead of loading their chunks again.
+    """
+    assert max_jobs_in_flight >= 1
     table_ref = get_table_reference(
         bigquery_client, destination_dataset_id, destination_table_id)
-    job_config = bigquery.LoadJobConfig()
-    job_config.source_format = bigquery.SourceFormat.CSV
-    job_config.skip_leading_rows = leading_rows
-    job_config.schema = schema
-    job_config.write_disposition = write_disposition
-    with open(source_filepath, 'rb') as source_file:
-        job = bigquery_client.load_table_from_file(
-            source_file,
-            table_ref,
-            location=BIGQUERY_LOCATION,
-            job_config=job_config,
-        )
+    loader = _ChunkLoader(
+        bigquery_client, table_ref, max_chunk_retries,
+        job_id_prefix or f'spider_load_{destination_table_id}_{uuid.uuid4().hex}',
+        split_chunk_file, chunk_sizer)
+    in_flight = deque()
+    results = []
+    chunk_files = iter(chunk_files)
+    try:
+        for chunk_index in itertools.count():
+            serialization_start = time.perf_counter()
+            chunk_file = next(chunk_files, None)  # Serializes the chunk if `chunk_files` is lazy.
+            if chunk_file is None and chunk_index == 0 \
+                    and write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE:
+                # Otherwise the table would keep the rows of the previous load.
+                log_info(f'No rows to load, emptying {destination_dataset_id}:{destination_table_id}.')
+                chunk_file = empty_chunk_file()
+            if chunk_file is None:
+                break
+            serialization_seconds = time.perf_counter() - serialization_start
 
-    job.result()
-    log_info(
-        f'Loaded {job.output_rows} rows into {destination_dataset_id}:{destination_table_id}.')
-    return job.job_id
+            while in_flight and (chunk_index == 1 or len(in_flight) >= max_jobs_in_flight):
+                results += loader.wait(in_flight.popleft())
+
+            job_config = job_config_factory(
+                write_disposition if chunk_index == 0 else bigquery.WriteDisposition.WRITE_APPEND)
+            in_flight.append(loader.submit(
+                chunk_index, str(chunk_index), chunk_file, job_config, serialization_seconds))
+
+        while in_flight:
+            results += loader.wait(in_flight.popleft())
+    finally:
+        for pending in in_flight:
+            pending.source_file.close()
+
+    return results
+
+
+def _iter_ndjson_chunk_files(
+        dict_iterable: Iterable[dict],
+        chunk_size: Optional[int] = None,
+        compress: bool = True,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE,
+        chunk_sizer: Optional[_ChunkSizer] = None) -> Iterator[IO]:
+    """
+    Yields buffers of at most `chunk_size` rows and of about the current
+    target of `chunk_sizer` in uncompressed bytes.
+    """
+    rows_iterator = iter(dict_iterable)
+    while True:
+        buffer = tempfile.SpooledTemporaryFile(max_size=max_memory_size, mode='w+b')
+        row_count = write_ndjson(
+            rows_iterator, buffer, compress=compress, max_rows=chunk_size,
+            max_bytes=chunk_sizer.chunk_bytes if chunk_sizer else None)
+        if not row_count:
+            buffer.close()
+            return
+        buffer.seek(0)
+        yield buffer
 
 
 def upload_dict_iterable_to_bigquery(
@@ -210,85 +993,341 @@ def upload_dict_iterable_to_bigquery(
         destination_dataset_id: str,
         destination_table_id: str,
         schema: List[bigquery.schema.SchemaField],
-        chunk_size: int = 10000) -> None:
+        chunk_size: Optional[int] = None,
+        max_jobs_in_flight: int = 1,
+        max_chunk_retries: int = BIGQUERY_LOAD_MAX_RETRIES,
+        compress: bool = True,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE,
+        chunk_bytes: int = BIGQUERY_LOAD_CHUNK_BYTES,
+        job_id_prefix: Optional[str] = None) -> List[ChunkLoadResult]:
     """
     The first chunk uploaded will created a new table and the
     remaining chunks will be appended to the existing table.
     This makes sure that each chunk is of a managable size,
     in case the data is too large preventing issues caused by
     network disruptions or the request being too large.
+
+    Chunks are pipelined: the next chunk is serialized while the previous
+    load jobs are running, with at most `max_jobs_in_flight` append jobs
+    running at once. A failed chunk is retried on its own up to
+    `max_chunk_retries` times. Chunks are serialized in memory, see
+    `dict_iterable_to_ndjson_buffer`.
+
+    Chunks hold about `chunk_bytes` of uncompressed NDJSON, and at most
+    `chunk_size` rows if given, so that narrow and wide rows both make
+    chunks of a similar payload. A chunk rejected as too large is split
+    in halves and the following chunks are made smaller. Without any row
+    the table is emptied.
     """
-    chunks = grouper(chunk_size, dict_iterable)
-    first_chunk = first_true(chunks)
-    upload_dict_list_to_bigquery(
+    chunk_sizer = _ChunkSizer(chunk_bytes)
+    return load_chunks_to_bigquery(
         bigquery_client=bigquery_client,
-        dict_list=list(filter(bool, first_chunk)),
+        chunk_files=_iter_ndjson_chunk_files(
+            dict_iterable, chunk_size, compress=compress, max_memory_size=max_memory_size,
+            chunk_sizer=chunk_sizer),
         destination_dataset_id=destination_dataset_id,
         destination_table_id=destination_table_id,
-        schema=schema,
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        job_config_factory=lambda write_disposition: _json_load_job_config(schema, write_disposition),
+        max_jobs_in_flight=max_jobs_in_flight,
+        max_chunk_retries=max_chunk_retries,
+        job_id_prefix=job_id_prefix,
+        split_chunk_file=functools.partial(split_ndjson_buffer, max_memory_size=max_memory_size),
+        chunk_sizer=chunk_sizer)
 
-    for chunk in chunks:
-        upload_dict_list_to_bigquery(
-            bigquery_client=bigquery_client,
-            dict_list=list(filter(bool, chunk)),
-            destination_dataset_id=destination_dataset_id,
-            destination_table_id=destination_table_id,
-            schema=schema,
-            write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
 
+def dataframe_to_parquet_buffer(
+        dataframe: 'pandas.DataFrame',
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE) -> IO:
+    """
+    Returns a rewound buffer holding the frame as a snappy compressed
+    Parquet file. Timestamps are written in microseconds, the finest
+    precision BigQuery accepts.
+    """
+    import pyarrow
+    import pyarrow.parquet
 
-def load_query_to_bigquery_table(
+    table = pyarrow.Table.from_pandas(dataframe, preserve_index=False)
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory_size, mode='w+b')
+    pyarrow.parquet.write_table(
+        table, buffer, compression='snappy',
+        coerce_timestamps='us', allow_truncated_timestamps=True)
+    buffer.seek(0)
+    return buffer
+
+
+def upload_dataframe_to_bigquery(
     bigquery_client: bigquery.Client,
-        sql: str,
+        dataframe: 'pandas.DataFrame',
         destination_dataset_id: str,
         destination_table_id: str,
-        location: str = 'US',
+        schema: Optional[List[bigquery.schema.SchemaField]] = None,
         write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
-        create_disposition: str = bigquery.CreateDisposition.CREATE_IF_NEEDED) -> str:
+        chunk_size: Optional[int] = None,
+        max_jobs_in_flight: int = 1,
+        max_chunk_retries: int = BIGQUERY_LOAD_MAX_RETRIES,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE,
+        chunk_bytes: Optional[int] = None) -> List[ChunkLoadResult]:
+    """
+    Loads a DataFrame as Parquet, which keeps its dtypes and spares the
+    per-row JSON encoding. Without `schema` BigQuery infers it from the
+    Parquet file. Very large frames can be split into chunks of
+    `chunk_size` rows, or of about `chunk_bytes` of in-memory size, that
+    are loaded like `upload_dict_iterable_to_bigquery`.
+    """
+    if chunk_size or chunk_bytes:
+        chunks = iter_dataframe_chunks(dataframe, chunk_size=chunk_size, chunk_bytes=chunk_bytes)
+    else:
+        chunks = [dataframe]
+    return load_chunks_to_bigquery(
+        bigquery_client=bigquery_client,
+        chunk_files=(dataframe_to_parquet_buffer(chunk, max_memory_size) for chunk in chunks),
+        destination_dataset_id=destination_dataset_id,
+        destination_table_id=destination_table_id,
+        job_config_factory=lambda write_disposition: _parquet_load_job_config(schema, write_disposition),
+        write_disposition=write_disposition,
+        max_jobs_in_flight=max_jobs_in_flight,
+        max_chunk_retries=max_chunk_retries,
+        empty_chunk_file=lambda: dataframe_to_parquet_buffer(dataframe.iloc[:0], max_memory_size))
 
-    table_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+
+def _destination_query_job_config(
+        table_ref: bigquery.TableReference,
+        write_disposition: str,
+        create_disposition: str) -> bigquery.QueryJobConfig:
     job_config = bigquery.QueryJobConfig()
     job_config.destination = table_ref
     job_config.write_disposition = write_disposition
     job_config.create_disposition = create_disposition
+    return job_config
 
-    query_job = bigquery_client.query(
-        sql,
-        location=location,
-        job_config=job_config
-    )
 
-    query_job.result()
+def load_query_to_bigquery_table(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        location: str = 'US',
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
+        create_disposition: str = bigquery.CreateDisposition.CREATE_IF_NEEDED,
+        skip_if_unchanged: bool = False) -> str:
+    """
+    With `skip_if_unchanged`, a WRITE_TRUNCATE query is not run again if
+    neither the tables it read nor the destination table changed since
+    it was last materialized, and the job id of that run is returned.
+    Only the modification times of the tables are compared, so the query
+    must be deterministic: the results of CURRENT_DATE(), CURRENT_TIMESTAMP(),
+    RAND() and the like would not be refreshed. Such queries, and queries
+    reading views, external tables or wildcard tables, whose data may
+    change without their modification time, are always run.
+    """
+    table_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+    skip_if_unchanged = skip_if_unchanged and \
+        write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+    materialization_key = make_query_cache_key(sql, {'destination': table_ref.path})
+    with record_job_metrics('query', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        if skip_if_unchanged:
+            materialization = QUERY_RESULT_CACHE.get(materialization_key, ttl=None)
+            if materialization and _is_materialization_current(bigquery_client, materialization):
+                log_info(f'Inputs of {table_ref.path} are unchanged, '
+                         f'skipping query rerun of job {materialization["job_id"]}')
+                metrics.set('skipped_unchanged', True)
+                return materialization['job_id']
+
+        job_config = _destination_query_job_config(table_ref, write_disposition, create_disposition)
+        query_job = bigquery_client.query(
+            sql,
+            location=location,
+            job_config=job_config
+        )
+
+        query_job.result()
+        metrics.observe_job(query_job)
     log_info(f'Query results loaded to table {table_ref.path} with job {query_job.job_id}')
+    if skip_if_unchanged:
+        _record_materialization(bigquery_client, sql, table_ref, query_job, materialization_key)
     return query_job.job_id
 
 
+# Functions whose results differ between runs of the same query.
+_NONDETERMINISTIC_SQL_REGEX = re.compile(
+    r'\b(?:CURRENT_(?:DATE|DATETIME|TIME|TIMESTAMP)|RAND|GENERATE_UUID|SESSION_USER)\b', re.IGNORECASE)
+# Wildcard tables, e.g. `project.dataset.events_*`, which may match tables added since the last run.
+_WILDCARD_TABLE_REGEX = re.compile(r'`[^`]*\*`|\b_TABLE_SUFFIX\b', re.IGNORECASE)
+# Tables whose data may change without their modification time.
+_UNTRACKED_TABLE_TYPES = {'VIEW', 'MATERIALIZED_VIEW', 'EXTERNAL'}
+
+
+def _get_table(
+    bigquery_client: bigquery.Client,
+        table_ref: bigquery.TableReference) -> Optional[bigquery.Table]:
+    try:
+        return bigquery_client.get_table(table_ref)
+    except NotFound:
+        return None
+
+
+def _get_modified_timestamp(
+    bigquery_client: bigquery.Client,
+        table_ref: bigquery.TableReference) -> Optional[float]:
+    table = _get_table(bigquery_client, table_ref)
+    return None if table is None else table.modified.timestamp()
+
+
+def _get_rerun_reason(sql: str, tables: List[Optional[bigquery.Table]]) -> Optional[str]:
+    """
+    Returns why the results of `sql`, which read `tables`, cannot be
+    known to be unchanged from the modification times of the tables.
+    """
+    if _NONDETERMINISTIC_SQL_REGEX.search(sql):
+        return 'it is not deterministic'
+    if _WILDCARD_TABLE_REGEX.search(sql):
+        return 'it reads wildcard tables'
+    for table in tables:
+        if table is None:
+            return 'one of its tables is missing'
+        if table.table_type in _UNTRACKED_TABLE_TYPES:
+            return f'it reads {table.path}, of type {table.table_type}'
+    return None
+
+
+def _is_materialization_current(
+    bigquery_client: bigquery.Client,
+        materialization: dict) -> bool:
+    return all(
+        _get_modified_timestamp(bigquery_client, bigquery.TableReference.from_api_repr(reference)) == modified
+        for reference, modified in materialization['inputs'])
+
+
+def _record_materialization(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        table_ref: bigquery.TableReference,
+        query_job: bigquery.QueryJob,
+        materialization_key: str) -> None:
+    """
+    Records the modification times of the tables a query read and of its
+    destination. Tables modified while the query ran are not recorded,
+    so the next run cannot be skipped based on data the query missed.
+    """
+    tables = [_get_table(bigquery_client, reference) for reference in query_job.referenced_tables]
+    rerun_reason = _get_rerun_reason(sql, tables)
+    if rerun_reason:
+        log_info(f'Not recording the materialization of {table_ref.path} as {rerun_reason}.')
+        return
+
+    started = query_job.started.timestamp()
+    inputs = [(reference.to_api_repr(), table.modified.timestamp())
+              for reference, table in zip(query_job.referenced_tables, tables)]
+    if any(modified > started for _, modified in inputs):
+        log_info(f'Inputs of {table_ref.path} changed while querying, not recording the materialization.')
+        return
+
+    inputs.append((table_ref.to_api_repr(), _get_modified_timestamp(bigquery_client, table_ref)))
+    QUERY_RESULT_CACHE.set(materialization_key, {'job_id': query_job.job_id, 'inputs': inputs})
+
+
 # only use this for small amounts of data to prevent memory issues
-# Use the bigquery_to_gcs operator instead for larger amounts of data
+# Use iter_pages_from_bigquery_table or the bigquery_to_gcs operator instead for larger amounts of data
 def get_dataframe_from_bigquery_table(
     bigquery_client: bigquery.Client,
         dataset_id: str,
-        table_id: str) -> pandas.DataFrame:
+        table_id: str) -> 'pandas.DataFrame':
     table_ref = get_table_reference(bigquery_client, dataset_id, table_id)
     table = bigquery_client.get_table(table_ref)
     return bigquery_client.list_rows(table).to_dataframe()
 
 
+def _iter_row_iterator_pages(
+        row_iterator: bigquery.table.RowIterator,
+        as_dataframe: bool) -> Iterator[Union['pandas.DataFrame', List[dict]]]:
+    import pandas
+
+    field_names = [field.name for field in row_iterator.schema]
+    for page in prefetch(row_iterator.pages):
+        rows = list(page)
+        values = list(map(_get_row_values_getter(rows[0]), rows)) if rows else []
+        if as_dataframe:
+            yield pandas.DataFrame.from_records(values, columns=field_names)
+        else:
+            yield [dict(zip(field_names, row_values)) for row_values in values]
+
+
+def iter_pages_from_bigquery_table(
+    bigquery_client: bigquery.Client,
+        dataset_id: str,
+        table_id: str,
+        page_size: int = 10000,
+        selected_fields: Optional[List[str]] = None,
+        as_dataframe: bool = True) -> Iterator[Union['pandas.DataFrame', List[dict]]]:
+    """
+    Yields a table as DataFrames, or lists of dicts, of at most `page_size`
+    rows, so only about two pages are held in memory at once: the next
+    page is fetched on a background thread while the current one is
+    processed. `selected_fields` limits the columns that are read.
+    """
+    table_ref = get_table_reference(bigquery_client, dataset_id, table_id)
+    table = bigquery_client.get_table(table_ref)
+    if selected_fields is not None:
+        fields_by_name = {field.name: field for field in table.schema}
+        selected_fields = [fields_by_name[name] for name in selected_fields]
+    row_iterator = bigquery_client.list_rows(
+        table, selected_fields=selected_fields, page_size=page_size)
+    return _iter_row_iterator_pages(row_iterator, as_dataframe)
+
+
+def iter_pages_from_bigquery_query(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        page_size: int = 10000,
+        selected_fields: Optional[List[str]] = None,
+        as_dataframe: bool = True,
+        location: str = 'US') -> Iterator[Union['pandas.DataFrame', List[dict]]]:
+    """
+    Runs a query and pages through its destination table,
+    see `iter_pages_from_bigquery_table`.
+    """
+    with record_job_metrics('query') as metrics:
+        query_job = bigquery_client.query(sql, location=location)
+        query_job.result()
+        metrics.observe_job(query_job)
+    log_info(f'Paging query results of job {query_job.job_id}')
+    destination = query_job.destination
+    return iter_pages_from_bigquery_table(
+        bigquery_client, destination.dataset_id, destination.table_id,
+        page_size=page_size, selected_fields=selected_fields, as_dataframe=as_dataframe)
+
+
 def get_list_from_bigquery(
         project_id: str,
         private_key_filepath: str,
-        sql: str) -> list:
+        sql: str,
+        cache_ttl: Optional[float] = None) -> list:
     """
     Returns the first column of a query as a Python list.
+    With `cache_ttl`, results are served from the worker's on-disk query
+    cache for that many seconds.
     """
-    log_info(f'Query:\n{sql}')
-    return pandas.read_gbq(
-        sql,
-        project_id=project_id,
-        private_key=private_key_filepath,
-        dialect='standard'
-    ).iloc[:, 0].tolist()
+    import pandas
+
+    cache_key = make_query_cache_key(sql, {'project_id': project_id})
+    with record_job_metrics('query') as metrics:
+        if cache_ttl is not None:
+            result = QUERY_RESULT_CACHE.get(cache_key, ttl=cache_ttl)
+            if result is not None:
+                log_info(f'Query served from cache:\n{sql}')
+                metrics.set('cache_hit', True)
+                return result
+
+        log_info(f'Query:\n{sql}')
+        result = pandas.read_gbq(
+            sql,
+            project_id=project_id,
+            private_key=private_key_filepath,
+            dialect='standard'
+        ).iloc[:, 0].tolist()
+    if cache_ttl is not None:
+        QUERY_RESULT_CACHE.set(cache_key, result)
+    return result
 
 
 def update_bigquery_view(
@@ -310,7 +1349,59 @@ def update_bigquery_view(
     return view
 
 
+def _get_row_values_getter(row: bigquery.Row) -> Callable[[bigquery.Row], tuple]:
+    # `Row.values()` deep copies the values of every row, read them directly instead.
+    return operator.attrgetter('_xxx_values') if hasattr(row, '_xxx_values') \
+        else operator.methodcaller('values')
+
+
+def _iter_row_values(row_iterator: bigquery.table.RowIterator) -> Tuple[List[str], Iterator[tuple]]:
+    """
+    Returns the field names, resolved once, and an iterator over the
+    value tuples of the rows. The schema of query results is only known
+    once the first page is fetched, hence the peek at the first row.
+    Nested RECORD and REPEATED values are passed through as the dicts and
+    lists the client already built.
+    """
+    rows = iter(row_iterator)
+    first_row = next(rows, None)
+    field_names = [field.name for field in row_iterator.schema]
+    if first_row is None:
+        return field_names, iter(())
+
+    get_values = _get_row_values_getter(first_row)
+    return field_names, map(get_values, itertools.chain([first_row], rows))
+
+
 def row_iterator_to_dict_list(row_iterator: bigquery.table.RowIterator) -> List[dict]:
-    return [{schema.name: row_item for schema, row_item
-             in zip(row_iterator.schema, always_iterable(row.values()))}
-            for row in row_iterator]
+    field_names, values = _iter_row_values(row_iterator)
+    return [dict(zip(field_names, row_values)) for row_values in values]
+
+
+def row_iterator_to_tuple_list(
+        row_iterator: bigquery.table.RowIterator) -> Tuple[List[str], List[tuple]]:
+    """
+    Returns the field names and one plain tuple per row,
+    the most compact row-oriented output.
+    """
+    field_names, values = _iter_row_values(row_iterator)
+    return field_names, list(values)
+
+
+def row_iterator_to_record_list(row_iterator: bigquery.table.RowIterator) -> List[tuple]:
+    """
+    Returns one slotted named tuple per row, whose values can be read
+    both by attribute and by position.
+    """
+    field_names, values = _iter_row_values(row_iterator)
+    record = namedtuple('Record', field_names, rename=True)
+    return list(map(record._make, values))
+
+
+def row_iterator_to_column_dict(row_iterator: bigquery.table.RowIterator) -> Dict[str, List[Any]]:
+    """
+    Returns the rows column-oriented, as one list of values per field name.
+    """
+    field_names, values = _iter_row_values(row_iterator)
+    columns = list(zip(*values)) or [()] * len(field_names)
+    return {field_name: list(column) for field_name, column in zip(field_names, columns)}
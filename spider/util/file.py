@@ -1,13 +1,44 @@
+import asyncio
 import functools
 import os
 import re
-from typing import Union, Callable, Any
+import string
+import threading
+from collections import OrderedDict
+from typing import Union, Callable, Any, FrozenSet, List, NamedTuple, Optional, Tuple
 
-import aiofiles
 import isodate
 
-from spider.constant import GCS_REGEX
+from spider.constant import GCS_REGEX, SQL_TEMPLATE_CACHE_SIZE
 from spider.util import log_info
+from spider.util.async_file import decode_file_content
+
+_FORMATTER = string.Formatter()
+_FIELD_ROOT_REGEX = re.compile(r'[^.\[]*')
+
+
+class SqlTemplate(NamedTuple):
+    query: str
+    mtime_ns: int
+    # (literal text, field name, format spec, conversion, rendered default parameter or None),
+    # the last field name is None.
+    pieces: Optional[List[Tuple[str, Optional[str], str, Optional[str], Optional[str]]]]
+    # Fields without a default, which every call has to pass.
+    field_names: FrozenSet[str]
+    # Fields of the default query parameters, which calls may override.
+    default_field_names: FrozenSet[str]
+
+
+class SqlTemplateCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+_sql_template_cache = OrderedDict()
+_sql_template_cache_lock = threading.Lock()
+_sql_template_cache_stats = {'hits': 0, 'misses': 0}
 
 
 def read_file(filepath: str, method: str = 'r') -> str:
@@ -16,22 +47,22 @@ def read_file(filepath: str, method: str = 'r') -> str:
     return read_data
 
 
-def read_sql(sql_filepath: str, sql_param: dict = {}) -> str:
-    return apply_default_query_parameters(read_file(sql_filepath, 'r'), **sql_param)
+def read_sql(sql_filepath: str, sql_param: dict = {}, strict: bool = False) -> str:
+    return render_sql_template(get_sql_template(sql_filepath), sql_param, strict=strict)
 
 
 def is_gc_path(filepath: str) -> bool:
     return bool(re.match(GCS_REGEX, filepath))
 
 
-def apply_default_query_parameters(query: str, **non_default) -> str:
+def get_default_query_parameters() -> dict:
     # unable to import at the beginning of the file
     from spider.constant import (
         DWH_SCHEMA, DWH_GENERAL_SCHEMA, EXTERNAL_SCHEMA, EXTERNAL_BACKEND_SCHEMA,
         DWH_SNAPSHOT_SCHEMA, SALESFORCE_SCHEMA, GOOGLE_SHEET_SCHEMA, EMAIL_FIVETRAN_SCHEMA,
         GOOGLE_ADS_SCHEMA, BACKEND_AUTOMATION_SCHEMA
     )
-    return query.format(
+    return dict(
         backend_schema=EXTERNAL_BACKEND_SCHEMA,
         backend_automation_schema=BACKEND_AUTOMATION_SCHEMA,
         dwh_schema=DWH_SCHEMA,
@@ -42,10 +73,138 @@ def apply_default_query_parameters(query: str, **non_default) -> str:
         google_sheet_schema=GOOGLE_SHEET_SCHEMA,
         email_fivetran_schema=EMAIL_FIVETRAN_SCHEMA,
         google_ads_schema=GOOGLE_ADS_SCHEMA,
-        **non_default
     )
 
 
+def apply_default_query_parameters(query: str, **non_default) -> str:
+    parameters = get_default_query_parameters()
+    _log_overridden_defaults(set(parameters) & set(non_default))
+    parameters.update(non_default)
+    return query.format(**parameters)
+
+
+def _log_overridden_defaults(field_names) -> None:
+    if field_names:
+        log_info(f'Overriding default SQL parameters: {sorted(field_names)}')
+
+
+def _format_field(field_name: str, format_spec: str, conversion: Optional[str], parameters: dict) -> str:
+    value, _ = _FORMATTER.get_field(field_name, (), parameters)
+    return _FORMATTER.format_field(_FORMATTER.convert_field(value, conversion), format_spec)
+
+
+def compile_sql_template(query: str, mtime_ns: int = 0) -> SqlTemplate:
+    """
+    Parses the format fields of a query once and renders the default
+    query parameters right away, so that calls only render their own
+    fields unless they override a default. Queries with nested format
+    specs are rendered with `str.format`.
+    """
+    default_parameters = get_default_query_parameters()
+    parsed = list(_FORMATTER.parse(query))
+    if any(format_spec and '{' in format_spec for _, _, format_spec, _ in parsed):
+        field_names = {_FIELD_ROOT_REGEX.match(field_name).group()
+                       for _, field_name, _, _ in parsed + [
+                           nested for _, _, format_spec, _ in parsed if format_spec
+                           for nested in _FORMATTER.parse(format_spec)]
+                       if field_name is not None}
+        return SqlTemplate(query, mtime_ns, None, frozenset(field_names - set(default_parameters)),
+                           frozenset(field_names & set(default_parameters)))
+
+    pieces = []
+    literals = []
+    for literal, field_name, format_spec, conversion in parsed:
+        literals.append(literal)
+        if field_name is None:
+            continue
+        default = None
+        if _FIELD_ROOT_REGEX.match(field_name).group() in default_parameters:
+            default = _format_field(field_name, format_spec, conversion, default_parameters)
+        pieces.append((''.join(literals), field_name, format_spec, conversion, default))
+        literals = []
+    pieces.append((''.join(literals), None, '', None, None))
+    field_names = {_FIELD_ROOT_REGEX.match(field_name).group() for _, field_name, _, _, _ in pieces[:-1]}
+    default_field_names = field_names & set(default_parameters)
+    return SqlTemplate(query, mtime_ns, pieces, frozenset(field_names - default_field_names),
+                       frozenset(default_field_names))
+
+
+def render_sql_template(template: SqlTemplate, sql_param: dict = {}, strict: bool = False) -> str:
+    """
+    Renders a compiled query, checking first that every field gets a
+    parameter. Parameters named like a default query parameter override
+    it, which is logged. Unused parameters raise in `strict` mode and are
+    logged otherwise.
+    """
+    missing = template.field_names - set(sql_param)
+    if missing:
+        raise KeyError(f'Missing SQL parameters: {sorted(missing)}')
+    extra = set(sql_param) - template.field_names - template.default_field_names
+    if extra:
+        if strict:
+            raise ValueError(f'Unused SQL parameters: {sorted(extra)}')
+        log_info(f'Ignoring unused SQL parameters: {sorted(extra)}')
+
+    if template.pieces is None:
+        return apply_default_query_parameters(
+            template.query, **{name: value for name, value in sql_param.items() if name not in extra})
+
+    overridden = template.default_field_names & set(sql_param)
+    _log_overridden_defaults(overridden)
+    rendered = []
+    for literal, field_name, format_spec, conversion, default in template.pieces:
+        rendered.append(literal)
+        if field_name is None:
+            continue
+        if default is not None and _FIELD_ROOT_REGEX.match(field_name).group() not in overridden:
+            rendered.append(default)
+        else:
+            rendered.append(_format_field(field_name, format_spec, conversion, sql_param))
+    return ''.join(rendered)
+
+
+def get_sql_template(sql_filepath: str) -> SqlTemplate:
+    """
+    Returns the compiled SQL file from an LRU cache keyed on its path,
+    recompiling it when its modification time changed.
+    """
+    mtime_ns = os.stat(sql_filepath).st_mtime_ns
+    with _sql_template_cache_lock:
+        template = _sql_template_cache.get(sql_filepath)
+        if template is not None and template.mtime_ns == mtime_ns:
+            _sql_template_cache.move_to_end(sql_filepath)
+            _sql_template_cache_stats['hits'] += 1
+            return template
+
+    template = compile_sql_template(read_file(sql_filepath, 'r'), mtime_ns)
+    with _sql_template_cache_lock:
+        _sql_template_cache_stats['misses'] += 1
+        _sql_template_cache[sql_filepath] = template
+        _sql_template_cache.move_to_end(sql_filepath)
+        while len(_sql_template_cache) > SQL_TEMPLATE_CACHE_SIZE:
+            _sql_template_cache.popitem(last=False)
+    log_info(f'Compiled SQL template {sql_filepath}, {sql_template_cache_info()}')
+    return template
+
+
+def sql_template_cache_info() -> SqlTemplateCacheInfo:
+    return SqlTemplateCacheInfo(
+        hits=_sql_template_cache_stats['hits'],
+        misses=_sql_template_cache_stats['misses'],
+        maxsize=SQL_TEMPLATE_CACHE_SIZE,
+        currsize=len(_sql_template_cache))
+
+
+def clear_sql_template_cache() -> None:
+    """
+    Drops every compiled template, e.g. after the schema constants
+    they were rendered with have been invalidated.
+    """
+    with _sql_template_cache_lock:
+        _sql_template_cache.clear()
+        _sql_template_cache_stats.update(hits=0, misses=0)
+
+
 def get_dir_name(path: str) -> str:
     return os.path.basename(os.path.dirname(path))
 
@@ -80,14 +239,12 @@ def include_keys(keys):
 
 
 async def async_read_file(filepath: str, method: str = 'r') -> Union[str, bytes]:
-    async with aiofiles.open(filepath, method) as f:
-        try:
-            return await f.read()
-        except UnicodeDecodeError:
-            if method == 'r':
-                return await async_read_file(filepath, 'rb')
-            else:
-                raise UnicodeDecodeError
+    """
+    Reads the file once in binary mode and decodes it in text mode,
+    returning the bytes if they are not valid text.
+    """
+    data = await asyncio.get_event_loop().run_in_executor(None, read_file, filepath, 'rb')
+    return decode_file_content(data) if method == 'r' else data
 
 
 def replace_if_invalid(to_validate: Any, replacement: Any, validate_with: Callable):
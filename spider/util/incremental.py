@@ -0,0 +1,366 @@
+"""
+Incremental loads into BigQuery tracked by a high-watermark column.
+
+Only the rows that are new or changed since the last load are written to a
+staging table, which is then merged into the target on its key columns. The
+merge is restricted to the date partitions present in the staging table when
+the target is partitioned on a column, so that only those are scanned and
+rewritten.
+
+The watermark of every table is appended to a table of the metadata dataset
+and advanced only after the merge succeeded. A retried run therefore loads
+the same delta again, and merging it again leaves the target unchanged.
+"""
+
+import uuid
+from typing import Iterable, List, NamedTuple, Optional
+
+from google.api_core.exceptions import Conflict, NotFound
+from google.cloud import bigquery
+
+from spider.constant import BIGQUERY_LOCATION, BIGQUERY_WATERMARK_TABLE_ID
+from spider.util import log_info
+from spider.util.database import (
+    _destination_query_job_config, get_table_reference, upload_dict_iterable_to_bigquery
+)
+from spider.util.instrument import record_job_metrics
+
+WATERMARK_SCHEMA = [
+    bigquery.SchemaField('dataset_id', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('table_id', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('watermark_column', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('watermark', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('job_id', 'STRING'),
+    bigquery.SchemaField('updated_at', 'TIMESTAMP', mode='REQUIRED'),
+]
+
+
+class IncrementalLoadResult(NamedTuple):
+    # The job that merged the staging table into the target, None if there was nothing to merge.
+    job_id: Optional[str]
+    row_count: int
+    previous_watermark: Optional[str]
+    watermark: Optional[str]
+
+
+def _get_metadata_dataset_id(metadata_dataset_id: Optional[str]) -> str:
+    if metadata_dataset_id:
+        return metadata_dataset_id
+    # unable to import at the beginning of the file, it reads a secret
+    from spider.constant import METADATA_SCHEMA
+    return METADATA_SCHEMA
+
+
+def _run_query(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        query_parameters: Optional[List[bigquery.ScalarQueryParameter]] = None,
+        job_config: Optional[bigquery.QueryJobConfig] = None) -> bigquery.QueryJob:
+    job_config = job_config or bigquery.QueryJobConfig()
+    job_config.query_parameters = query_parameters or []
+    query_job = bigquery_client.query(sql, location=BIGQUERY_LOCATION, job_config=job_config)
+    query_job.result()
+    return query_job
+
+
+def _quote_table(table_ref: bigquery.TableReference) -> str:
+    return f'`{table_ref.project}.{table_ref.dataset_id}.{table_ref.table_id}`'
+
+
+def _ensure_watermark_table(bigquery_client: bigquery.Client, metadata_dataset_id: str) -> bigquery.TableReference:
+    table_ref = get_table_reference(bigquery_client, metadata_dataset_id, BIGQUERY_WATERMARK_TABLE_ID)
+    try:
+        bigquery_client.create_table(bigquery.Table(table_ref, schema=WATERMARK_SCHEMA))
+    except Conflict:
+        pass
+    return table_ref
+
+
+def get_watermark(
+    bigquery_client: bigquery.Client,
+        dataset_id: str,
+        table_id: str,
+        metadata_dataset_id: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the latest watermark of a table as a string, which can be cast
+    back to the type of the watermark column, or None before the first load.
+    """
+    table_ref = get_table_reference(
+        bigquery_client, _get_metadata_dataset_id(metadata_dataset_id), BIGQUERY_WATERMARK_TABLE_ID)
+    try:
+        rows = list(_run_query(bigquery_client, f'''
+            SELECT watermark
+            FROM {_quote_table(table_ref)}
+            WHERE dataset_id = @dataset_id AND table_id = @table_id
+            ORDER BY updated_at DESC
+            LIMIT 1
+        ''', [
+            bigquery.ScalarQueryParameter('dataset_id', 'STRING', dataset_id),
+            bigquery.ScalarQueryParameter('table_id', 'STRING', table_id),
+        ]).result())
+    except NotFound:
+        return None
+    return rows[0].watermark if rows else None
+
+
+def set_watermark(
+    bigquery_client: bigquery.Client,
+        dataset_id: str,
+        table_id: str,
+        watermark_column: str,
+        watermark: str,
+        job_id: Optional[str] = None,
+        metadata_dataset_id: Optional[str] = None) -> None:
+    """
+    Appends the watermark with a DML insert, which is visible to
+    `get_watermark` right away unlike a streaming insert.
+    """
+    table_ref = _ensure_watermark_table(bigquery_client, _get_metadata_dataset_id(metadata_dataset_id))
+    _run_query(bigquery_client, f'''
+        INSERT INTO {_quote_table(table_ref)} (dataset_id, table_id, watermark_column, watermark, job_id, updated_at)
+        VALUES (@dataset_id, @table_id, @watermark_column, @watermark, @job_id, CURRENT_TIMESTAMP())
+    ''', [
+        bigquery.ScalarQueryParameter('dataset_id', 'STRING', dataset_id),
+        bigquery.ScalarQueryParameter('table_id', 'STRING', table_id),
+        bigquery.ScalarQueryParameter('watermark_column', 'STRING', watermark_column),
+        bigquery.ScalarQueryParameter('watermark', 'STRING', watermark),
+        bigquery.ScalarQueryParameter('job_id', 'STRING', job_id),
+    ])
+    log_info(f'Watermark of {dataset_id}.{table_id} set to {watermark_column} = {watermark}')
+
+
+def _get_field_type(schema: List[bigquery.SchemaField], column: str) -> str:
+    for field in schema:
+        if field.name == column:
+            return field.field_type
+    raise KeyError(f'Column {column} not in schema')
+
+
+def _quote_column(column: str) -> str:
+    return f'`{column}`'
+
+
+def _partition_date_expression(schema: List[bigquery.SchemaField], column: str, alias: str) -> str:
+    if _get_field_type(schema, column) == 'DATE':
+        return f'{alias}.{_quote_column(column)}'
+    return f'DATE({alias}.{_quote_column(column)})'
+
+
+def _get_staging_table_id(table_id: str) -> str:
+    return f'{table_id}__staging_{uuid.uuid4().hex[:12]}'
+
+
+def _get_partition_column(target: bigquery.Table, partition_column: Optional[str]) -> Optional[str]:
+    if partition_column:
+        return partition_column
+    time_partitioning = target.time_partitioning
+    return time_partitioning.field if time_partitioning else None
+
+
+def _latest_staged_rows_sql(
+        staging_ref: bigquery.TableReference,
+        key_columns: List[str],
+        watermark_column: str) -> str:
+    """
+    Selects the staged row with the highest watermark of every key.
+    """
+    return f'''
+          SELECT * EXCEPT(_row_number)
+          FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY {", ".join(map(_quote_column, key_columns))}
+                                         ORDER BY {_quote_column(watermark_column)} DESC) AS _row_number
+            FROM {_quote_table(staging_ref)}
+          )
+          WHERE _row_number = 1
+    '''
+
+
+def _rows_above_watermark_sql(sql: str, watermark_column: str, watermark_type: str) -> str:
+    """
+    Wraps `sql` to select its rows above the `@watermark` parameter. The
+    trailing semicolon of `sql` is dropped and its trailing comment is
+    ended by the line break.
+    """
+    return f'''
+          SELECT *
+          FROM (
+            {sql.strip().rstrip(';')}
+          )
+          WHERE {_quote_column(watermark_column)} > CAST(@watermark AS {watermark_type})
+    '''
+
+
+def _create_table_from_staging(
+    bigquery_client: bigquery.Client,
+        staging_ref: bigquery.TableReference,
+        target_ref: bigquery.TableReference,
+        key_columns: List[str],
+        watermark_column: str,
+        partition_column: Optional[str]) -> bigquery.QueryJob:
+    job_config = _destination_query_job_config(
+        target_ref, bigquery.WriteDisposition.WRITE_EMPTY, bigquery.CreateDisposition.CREATE_IF_NEEDED)
+    if partition_column:
+        job_config.time_partitioning = bigquery.TimePartitioning(field=partition_column)
+    return _run_query(bigquery_client, _latest_staged_rows_sql(staging_ref, key_columns, watermark_column),
+                      job_config=job_config)
+
+
+def _merge_sql(
+        staging: bigquery.Table,
+        target_ref: bigquery.TableReference,
+        key_columns: List[str],
+        watermark_column: str,
+        partition_column: Optional[str]) -> str:
+    columns = [_quote_column(field.name) for field in staging.schema]
+    conditions = [f'T.{column} = S.{column}' for column in map(_quote_column, key_columns)]
+    if partition_column:
+        # Assumes that the partition column of a key never changes. Rows without a partition
+        # date are in their own partition, which is always scanned.
+        conditions.append(f'({_partition_date_expression(staging.schema, partition_column, "T")} '
+                          f'IN UNNEST(@partition_dates) OR T.{_quote_column(partition_column)} IS NULL)')
+    return f'''
+        MERGE {_quote_table(target_ref)} AS T
+        USING ({_latest_staged_rows_sql(staging.reference, key_columns, watermark_column)}) AS S
+        ON {" AND ".join(conditions)}
+        WHEN MATCHED THEN
+          UPDATE SET {", ".join(f"{column} = S.{column}" for column in columns)}
+        WHEN NOT MATCHED THEN
+          INSERT ({", ".join(columns)}) VALUES ({", ".join(f"S.{column}" for column in columns)})
+    '''
+
+
+def merge_staging_table(
+    bigquery_client: bigquery.Client,
+        staging_table_id: str,
+        dataset_id: str,
+        table_id: str,
+        key_columns: List[str],
+        watermark_column: str,
+        partition_column: Optional[str] = None,
+        previous_watermark: Optional[str] = None,
+        metadata_dataset_id: Optional[str] = None) -> IncrementalLoadResult:
+    """
+    Merges the staging table into the target on `key_columns`, keeping the
+    row with the highest watermark per key, then advances the watermark.
+    A missing target is created from the staging table, partitioned by day
+    on `partition_column`. The target is pruned to the partitions of the
+    staged rows on `partition_column`, by default its partitioning column.
+    """
+    staging_ref = get_table_reference(bigquery_client, dataset_id, staging_table_id)
+    target_ref = get_table_reference(bigquery_client, dataset_id, table_id)
+    staging = bigquery_client.get_table(staging_ref)
+    try:
+        target = bigquery_client.get_table(target_ref)
+    except NotFound:
+        target = None
+    if target is not None:
+        partition_column = _get_partition_column(target, partition_column)
+
+    watermark_type = _get_field_type(staging.schema, watermark_column)
+    partition_dates = ''
+    if target is not None and partition_column:
+        partition_dates = (f', ARRAY_AGG(DISTINCT {_partition_date_expression(staging.schema, partition_column, "S")} '
+                           f'IGNORE NULLS) AS partition_dates')
+    stats = list(_run_query(bigquery_client, f'''
+        SELECT
+          COUNT(*) AS row_count,
+          CAST(IF(@previous_watermark IS NULL, MAX(S.{_quote_column(watermark_column)}),
+                  GREATEST(MAX(S.{_quote_column(watermark_column)}),
+                           CAST(@previous_watermark AS {watermark_type}))) AS STRING)
+            AS watermark
+          {partition_dates}
+        FROM {_quote_table(staging_ref)} AS S
+    ''', [bigquery.ScalarQueryParameter('previous_watermark', 'STRING', previous_watermark)]).result())[0]
+    if not stats.row_count:
+        log_info(f'No new rows to merge into {dataset_id}.{table_id}')
+        return IncrementalLoadResult(None, 0, previous_watermark, previous_watermark)
+
+    with record_job_metrics('merge', f'{dataset_id}.{table_id}') as metrics:
+        if target is None:
+            merge_job = _create_table_from_staging(
+                bigquery_client, staging_ref, target_ref, key_columns, watermark_column, partition_column)
+        else:
+            merge_job = _run_query(
+                bigquery_client,
+                _merge_sql(staging, target_ref, key_columns, watermark_column,
+                           partition_column if partition_dates else None),
+                [bigquery.ArrayQueryParameter('partition_dates', 'DATE', stats.partition_dates)]
+                if partition_dates else None)
+        metrics.set('row_count', stats.row_count)
+        metrics.observe_job(merge_job)
+    log_info(f'Merged {stats.row_count} rows into {dataset_id}.{table_id} with job {merge_job.job_id}')
+
+    set_watermark(bigquery_client, dataset_id, table_id, watermark_column, stats.watermark,
+                  job_id=merge_job.job_id, metadata_dataset_id=metadata_dataset_id)
+    return IncrementalLoadResult(merge_job.job_id, stats.row_count, previous_watermark, stats.watermark)
+
+
+def _delete_staging_table(bigquery_client: bigquery.Client, dataset_id: str, staging_table_id: str) -> None:
+    try:
+        bigquery_client.delete_table(get_table_reference(bigquery_client, dataset_id, staging_table_id))
+    except NotFound:
+        pass
+
+
+def load_query_incrementally(
+    bigquery_client: bigquery.Client,
+        sql: str,
+        dataset_id: str,
+        table_id: str,
+        key_columns: List[str],
+        watermark_column: str,
+        partition_column: Optional[str] = None,
+        metadata_dataset_id: Optional[str] = None) -> IncrementalLoadResult:
+    """
+    Incremental counterpart of `load_query_to_bigquery_table`: only the
+    rows of `sql` above the stored watermark are staged and merged.
+    """
+    previous_watermark = get_watermark(bigquery_client, dataset_id, table_id, metadata_dataset_id)
+    query_parameters = None
+    if previous_watermark is not None:
+        target = bigquery_client.get_table(get_table_reference(bigquery_client, dataset_id, table_id))
+        watermark_type = _get_field_type(target.schema, watermark_column)
+        sql = _rows_above_watermark_sql(sql, watermark_column, watermark_type)
+        query_parameters = [bigquery.ScalarQueryParameter('watermark', 'STRING', previous_watermark)]
+
+    staging_table_id = _get_staging_table_id(table_id)
+    staging_ref = get_table_reference(bigquery_client, dataset_id, staging_table_id)
+    try:
+        _run_query(bigquery_client, sql, query_parameters, _destination_query_job_config(
+            staging_ref, bigquery.WriteDisposition.WRITE_TRUNCATE, bigquery.CreateDisposition.CREATE_IF_NEEDED))
+        return merge_staging_table(
+            bigquery_client, staging_table_id, dataset_id, table_id, key_columns, watermark_column,
+            partition_column, previous_watermark, metadata_dataset_id)
+    finally:
+        _delete_staging_table(bigquery_client, dataset_id, staging_table_id)
+
+
+def upload_dict_iterable_incrementally(
+    bigquery_client: bigquery.Client,
+        dict_iterable: Iterable[dict],
+        dataset_id: str,
+        table_id: str,
+        schema: List[bigquery.schema.SchemaField],
+        key_columns: List[str],
+        watermark_column: str,
+        partition_column: Optional[str] = None,
+        previous_watermark: Optional[str] = None,
+        chunk_size: Optional[int] = None,
+        metadata_dataset_id: Optional[str] = None) -> IncrementalLoadResult:
+    """
+    Stages the dicts, which should be the rows of the source changed since
+    `get_watermark`, and merges them into the target. Pass the watermark
+    the source was read from as `previous_watermark`.
+    """
+    staging_table_id = _get_staging_table_id(table_id)
+    try:
+        chunks = upload_dict_iterable_to_bigquery(
+            bigquery_client, dict_iterable, dataset_id, staging_table_id, schema, chunk_size=chunk_size)
+        if not chunks:
+            log_info(f'No new rows to merge into {dataset_id}.{table_id}')
+            return IncrementalLoadResult(None, 0, previous_watermark, previous_watermark)
+        return merge_staging_table(
+            bigquery_client, staging_table_id, dataset_id, table_id, key_columns, watermark_column,
+            partition_column, previous_watermark, metadata_dataset_id)
+    finally:
+        _delete_staging_table(bigquery_client, dataset_id, staging_table_id)
@@ -0,0 +1,181 @@
+"""
+Structured cost and latency metrics of the BigQuery jobs run by the
+helpers in `spider.util.database`.
+
+Every helper records its jobs with `record_job_metrics`, which hands one
+dict per call to the registered sinks. By default the records are appended
+as NDJSON to `JOB_METRICS_FILEPATH`, rotated at `JOB_METRICS_MAX_SIZE`, and
+can be summed up per DAG run with `aggregate_job_metrics`.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional
+
+from spider.constant import JOB_METRICS_FILEPATH, JOB_METRICS_MAX_SIZE
+from spider.util import log_info
+
+MetricsSink = Callable[[dict], None]
+
+# Job statistics that are summed up by `aggregate_job_metrics`.
+SUMMED_METRICS = [
+    'total_bytes_processed', 'total_bytes_billed', 'slot_millis', 'input_file_bytes',
+    'output_rows', 'output_bytes', 'queued_seconds', 'running_seconds',
+    'serialization_seconds', 'wall_seconds', 'splits',
+]
+
+
+def _seconds_between(start: Optional[datetime], end: Optional[datetime]) -> Optional[float]:
+    return (end - start).total_seconds() if start and end else None
+
+
+class JobMetrics:
+    """
+    Metrics of one helper call, filled in by the helper while it runs.
+    """
+
+    def __init__(self, operation: str, destination: Optional[str] = None):
+        self.record = {
+            'operation': operation,
+            'destination': destination,
+            'dag_id': os.getenv('AIRFLOW_CTX_DAG_ID'),
+            'task_id': os.getenv('AIRFLOW_CTX_TASK_ID'),
+            'execution_date': os.getenv('AIRFLOW_CTX_EXECUTION_DATE'),
+            'recorded_at': datetime.utcnow().isoformat(),
+            'job_ids': [],
+            'serialization_seconds': 0.0,
+        }
+
+    def observe_job(self, job) -> None:
+        """
+        Reads the statistics of a finished load, query or copy job.
+        Statistics of several jobs are added up.
+        """
+        self.record['job_ids'].append(job.job_id)
+        self.record['job_type'] = getattr(job, 'job_type', type(job).__name__)
+        statistics = {
+            'total_bytes_processed': getattr(job, 'total_bytes_processed', None),
+            'total_bytes_billed': getattr(job, 'total_bytes_billed', None),
+            'slot_millis': getattr(job, 'slot_millis', None),
+            'input_file_bytes': getattr(job, 'input_file_bytes', None),
+            'output_rows': getattr(job, 'output_rows', None),
+            'output_bytes': getattr(job, 'output_bytes', None),
+            'queued_seconds': _seconds_between(job.created, job.started),
+            'running_seconds': _seconds_between(job.started, job.ended),
+        }
+        for name, value in statistics.items():
+            if value is not None:
+                self.record[name] = (self.record.get(name) or 0) + value
+        cache_hit = getattr(job, 'cache_hit', None)
+        if cache_hit is not None:
+            self.record['cache_hit'] = bool(cache_hit) and self.record.get('cache_hit', True)
+
+    def set(self, name: str, value) -> None:
+        self.record[name] = value
+
+    @contextmanager
+    def time_serialization(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record['serialization_seconds'] += time.perf_counter() - start
+
+
+def _get_rotated_filepath(filepath: str) -> str:
+    return f'{filepath}.1'
+
+
+class NdjsonMetricsSink:
+    """
+    Appends every record as one JSON line to a local file. Once the file
+    reaches `max_size` bytes it replaces the previous rotated file, so at
+    most twice `max_size` bytes are kept.
+    """
+
+    def __init__(self, filepath: str, max_size: int = JOB_METRICS_MAX_SIZE):
+        self.filepath = filepath
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _rotate(self) -> None:
+        try:
+            if os.stat(self.filepath).st_size >= self.max_size:
+                os.replace(self.filepath, _get_rotated_filepath(self.filepath))
+        except FileNotFoundError:
+            pass
+
+    def __call__(self, record: dict) -> None:
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            self._rotate()
+            with open(self.filepath, 'a') as file:
+                file.write(line)
+
+
+_metrics_sinks: List[MetricsSink] = [NdjsonMetricsSink(JOB_METRICS_FILEPATH)]
+
+
+def set_metrics_sinks(sinks: List[MetricsSink]) -> None:
+    _metrics_sinks[:] = sinks
+
+
+def add_metrics_sink(sink: MetricsSink) -> None:
+    _metrics_sinks.append(sink)
+
+
+@contextmanager
+def record_job_metrics(operation: str, destination: Optional[str] = None) -> Iterator[JobMetrics]:
+    """
+    Times the enclosed block and hands its metrics to every sink, also
+    when the block raised. A failing sink is logged and never fails the job.
+    """
+    metrics = JobMetrics(operation, destination)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    except Exception as e:
+        metrics.set('error', repr(e))
+        raise
+    finally:
+        metrics.set('wall_seconds', time.perf_counter() - start)
+        for sink in list(_metrics_sinks):
+            try:
+                sink(metrics.record)
+            except Exception as e:
+                log_info(f'Metrics sink {sink} failed: {e}')
+
+
+def aggregate_job_metrics(
+        dag_id: str,
+        execution_date: Optional[str] = None,
+        filepath: str = JOB_METRICS_FILEPATH) -> Dict[str, dict]:
+    """
+    Sums up the NDJSON records of a DAG, or of one of its runs, per
+    operation and over all operations under 'total'. The rotated file is
+    read too.
+    """
+    aggregates = defaultdict(lambda: dict({name: 0 for name in SUMMED_METRICS}, calls=0, errors=0, cache_hits=0))
+    for path in [_get_rotated_filepath(filepath), filepath]:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as file:
+            for line in file:
+                record = json.loads(line)
+                if record.get('dag_id') != dag_id or \
+                        (execution_date is not None and record.get('execution_date') != execution_date):
+                    continue
+                for key in (record['operation'], 'total'):
+                    aggregate = aggregates[key]
+                    aggregate['calls'] += 1
+                    aggregate['errors'] += 'error' in record
+                    aggregate['cache_hits'] += bool(record.get('cache_hit'))
+                    for name in SUMMED_METRICS:
+                        aggregate[name] += record.get(name) or 0
+    return dict(aggregates)
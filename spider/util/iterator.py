@@ -1,10 +1,82 @@
-from typing import Union, List
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional, TypeVar, Union
 
-import pandas
+if TYPE_CHECKING:
+    import numpy
+    import pandas
 
+T = TypeVar('T')
+R = TypeVar('R')
 
-def split_dataframe_by_chunk(data: Union[pandas.DataFrame, pandas.Series], chunk_size: int) -> List[
-    Union[pandas.DataFrame,
-          pandas.Series]]:
-    return [data.iloc[i:i + chunk_size]
-            for i in range(0, data.shape[0], chunk_size)]
+
+def _estimate_row_bytes(data: Union['pandas.DataFrame', 'pandas.Series', 'numpy.ndarray']) -> float:
+    if hasattr(data, 'memory_usage'):
+        memory_usage = data.memory_usage(index=False, deep=True)
+        total_bytes = memory_usage.sum() if hasattr(memory_usage, 'sum') else memory_usage
+    else:
+        total_bytes = data.nbytes
+    return total_bytes / max(len(data), 1)
+
+
+def iter_dataframe_chunks(
+        data: Union['pandas.DataFrame', 'pandas.Series', 'numpy.ndarray'],
+        chunk_size: Optional[int] = None,
+        chunk_bytes: Optional[int] = None) -> Iterator[Union['pandas.DataFrame', 'pandas.Series', 'numpy.ndarray']]:
+    """
+    Lazily yields consecutive row slices of a DataFrame, Series or NumPy
+    array, of `chunk_size` rows or of about `chunk_bytes` of in-memory
+    size each. The slices are positional and share the memory of `data`
+    where pandas and NumPy allow, so no chunk is copied before it is used.
+    """
+    if (chunk_size is None) == (chunk_bytes is None):
+        raise ValueError('Exactly one of chunk_size and chunk_bytes must be given')
+    if chunk_size is None:
+        chunk_size = int(chunk_bytes // max(_estimate_row_bytes(data), 1))
+    chunk_size = max(chunk_size, 1)
+
+    slicer = data.iloc if hasattr(data, 'iloc') else data
+    for i in range(0, len(data), chunk_size):
+        yield slicer[i:i + chunk_size]
+
+
+def split_dataframe_by_chunk(data: Union['pandas.DataFrame', 'pandas.Series'], chunk_size: int) -> List[
+    Union['pandas.DataFrame',
+          'pandas.Series']]:
+    return list(iter_dataframe_chunks(data, chunk_size))
+
+
+def prefetch(iterable: Iterable[T]) -> Iterator[T]:
+    """
+    Yields the items of `iterable` while the next item is already being
+    produced on a background thread, e.g. to fetch the next page of a
+    paged API while the current one is processed.
+    """
+    iterator = iter(iterable)
+    exhausted = object()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, exhausted)
+        while True:
+            item = future.result()
+            if item is exhausted:
+                return
+            future = executor.submit(next, iterator, exhausted)
+            yield item
+
+
+def imap_unordered(function: Callable[[T], R], iterable: Iterable[T], max_workers: int) -> Iterator[R]:
+    """
+    Like `ThreadPoolExecutor.map`, but `iterable` is consumed lazily,
+    at most `max_workers` calls are pending at once and results are
+    yielded as soon as they are done.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for item in iterable:
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(function, item))
+
+        for future in as_completed(pending):
+            yield future.result()
@@ -0,0 +1,30 @@
+import sys
+import types
+from typing import Any, Callable, Dict
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module whose attributes listed in `_lazy_attributes` are only
+    computed when they are accessed, e.g. by `from module import NAME`.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        lazy_attributes = self.__dict__.get('_lazy_attributes', {})
+        if name in lazy_attributes:
+            return lazy_attributes[name]()
+        raise AttributeError(f'module {self.__name__!r} has no attribute {name!r}')
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self.__dict__.get('_lazy_attributes', {})))
+
+
+def make_module_lazy(module_name: str, lazy_attributes: Dict[str, Callable[[], Any]]) -> None:
+    """
+    Turns an imported module into a `LazyModule` resolving each name in
+    `lazy_attributes` by calling its function on every access. Caching is
+    left to those functions so that they can be invalidated.
+    """
+    module = sys.modules[module_name]
+    module._lazy_attributes = lazy_attributes
+    module.__class__ = LazyModule
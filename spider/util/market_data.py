@@ -0,0 +1,351 @@
+"""
+Market data downloads through findatapy, cached locally in a columnar format.
+
+Every (frequency, ticker, field) series is kept in one NumPy file of
+(timestamp, value) records next to a JSON file of the date ranges already
+downloaded, which may legitimately hold no data, e.g. over holidays. Reads
+memory-map the file and slice it, so cached data is never parsed again, and
+downloads only request the ranges missing from the cache.
+
+The data source is any callable with the signature of `FindatapyDataSource`,
+so that the cache can be used with a stub and no network.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+from spider.constant import MARKET_DATA_CACHE_DIR, MARKET_DATA_CACHE_FRESHNESS, MARKET_DATA_MAX_WORKERS, \
+    MARKET_DATA_RATE_LIMIT, MARKET_DATA_RATE_PERIOD
+from spider.util import log_info
+from spider.util.iterator import imap_unordered
+
+if TYPE_CHECKING:
+    import pandas
+
+DateLike = Union[str, 'pandas.Timestamp']
+DateRange = Tuple['pandas.Timestamp', 'pandas.Timestamp']
+# Called with the ticker, fields, frequency, start and end, both inclusive, and
+# returns a DataFrame indexed by time with one column per field.
+MarketDataSource = Callable[[str, List[str], str, 'pandas.Timestamp', 'pandas.Timestamp'], 'pandas.DataFrame']
+
+# Ranges closer than one step are merged, so that e.g. two consecutive days
+# downloaded separately do not leave a gap to download again.
+FREQUENCY_STEPS = {
+    'daily': 24 * 60 * 60,
+    'intraday': 60,
+    'tick': 0,
+}
+
+
+class RateLimiter:
+    """
+    Allows at most `max_calls` calls of `acquire` per `period` seconds
+    across threads, blocking the callers over the limit.
+    """
+
+    def __init__(self, max_calls: int = MARKET_DATA_RATE_LIMIT, period: float = MARKET_DATA_RATE_PERIOD):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                delay = self._calls[0] + self.period - now
+            time.sleep(delay)
+
+    def __enter__(self) -> 'RateLimiter':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+class FindatapyDataSource:
+    """
+    Downloads one ticker at a time with `findatapy.market.Market`. The
+    keyword arguments, e.g. `vendor_tickers`, are passed on to every
+    `MarketDataRequest`.
+    """
+
+    def __init__(self, data_source: str = 'yahoo', **request_kwargs):
+        self.data_source = data_source
+        self.request_kwargs = request_kwargs
+
+    def __call__(self, ticker: str, fields: List[str], freq: str,
+                 start: 'pandas.Timestamp', end: 'pandas.Timestamp') -> 'pandas.DataFrame':
+        import pandas
+        from findatapy.market import Market, MarketDataGenerator, MarketDataRequest
+
+        request = MarketDataRequest(
+            start_date=start, finish_date=end, freq=freq, data_source=self.data_source,
+            tickers=[ticker], fields=fields, **self.request_kwargs)
+        # A market per call, as findatapy does not document them as thread-safe.
+        df = Market(market_data_generator=MarketDataGenerator()).fetch_market(request)
+        if df is None:
+            return pandas.DataFrame(columns=fields)
+        # findatapy names the columns '<ticker>.<field>'.
+        df.columns = [column.split('.', 1)[-1] for column in df.columns]
+        return df
+
+
+def to_timestamp(value: DateLike) -> 'pandas.Timestamp':
+    """
+    Returns the time as a naive UTC timestamp, the way it is cached.
+    """
+    import pandas
+
+    timestamp = pandas.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp
+
+
+def merge_ranges(ranges: Iterable[DateRange], step: float = 0) -> List[DateRange]:
+    """
+    Sorts the ranges and merges those overlapping or less than `step`
+    seconds apart.
+    """
+    import pandas
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + pandas.Timedelta(seconds=step):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_missing_ranges(covered_ranges: List[DateRange], start: 'pandas.Timestamp', end: 'pandas.Timestamp',
+                       step: float = 0) -> List[DateRange]:
+    """
+    Returns the parts of [start, end] outside the merged `covered_ranges`.
+    """
+    import pandas
+
+    step = pandas.Timedelta(seconds=step)
+    missing = []
+    # The first time that may be missing and whether it is itself covered,
+    # which only happens without a step.
+    cursor, is_covered = start, False
+    for covered_start, covered_end in covered_ranges:
+        if covered_end < cursor:
+            continue
+        if covered_start > end:
+            break
+        gap_end = covered_start - step if step else covered_start
+        if covered_start > cursor and gap_end >= cursor:
+            missing.append((cursor, min(gap_end, end)))
+        if covered_end + step >= cursor:
+            cursor, is_covered = covered_end + step, not step
+    if cursor < end or (cursor == end and not is_covered):
+        missing.append((cursor, end))
+    return missing
+
+
+class MarketDataCache:
+    """
+    Keeps every series in `<directory>/<freq>/<ticker>/<field>.npy` and its
+    downloaded ranges in `<field>.json`. Writes hold an exclusive lock on
+    the series and replace the files atomically, so several processes can
+    share a directory and readers never see a partial file.
+    """
+
+    DTYPE = [('time', '<i8'), ('value', '<f8')]
+
+    def __init__(self, directory: str = MARKET_DATA_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, ticker: str, field: str, freq: str) -> str:
+        return os.path.join(self.directory, quote(freq, safe=''), quote(ticker, safe=''), quote(field, safe=''))
+
+    @contextmanager
+    def _lock(self, path: str) -> Iterator[None]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_covered_ranges(self, ticker: str, field: str, freq: str) -> List[DateRange]:
+        import pandas
+
+        try:
+            with open(self._path(ticker, field, freq) + '.json', 'r') as file:
+                ranges = json.load(file)['ranges']
+        except (FileNotFoundError, ValueError, KeyError):
+            return []
+        return [(pandas.Timestamp(start), pandas.Timestamp(end)) for start, end in ranges]
+
+    def get_missing_ranges(self, ticker: str, field: str, freq: str,
+                           start: DateLike, end: DateLike) -> List[DateRange]:
+        return get_missing_ranges(self.get_covered_ranges(ticker, field, freq),
+                                  to_timestamp(start), to_timestamp(end), FREQUENCY_STEPS.get(freq, 0))
+
+    def _load_records(self, path: str, mmap: bool = True):
+        import numpy
+
+        try:
+            return numpy.load(path + '.npy', mmap_mode='r' if mmap else None)
+        except (FileNotFoundError, ValueError):
+            return numpy.empty(0, dtype=self.DTYPE)
+
+    def read(self, ticker: str, field: str, freq: str,
+             start: Optional[DateLike] = None, end: Optional[DateLike] = None) -> 'pandas.Series':
+        """
+        Returns the cached series between `start` and `end`, both inclusive.
+        The values are a view of the memory-mapped file.
+        """
+        import numpy
+        import pandas
+
+        records = self._load_records(self._path(ticker, field, freq))
+        times = records['time']
+        lower = 0 if start is None else numpy.searchsorted(times, to_timestamp(start).value, side='left')
+        upper = len(times) if end is None else numpy.searchsorted(times, to_timestamp(end).value, side='right')
+        records = records[lower:upper]
+        return pandas.Series(records['value'], index=pandas.DatetimeIndex(records['time'].view('datetime64[ns]')),
+                             name=f'{ticker}.{field}')
+
+    def write(self, ticker: str, field: str, freq: str, series: 'pandas.Series',
+              start: DateLike, end: DateLike, covered_until: Optional[DateLike] = None) -> None:
+        """
+        Merges the series downloaded for [start, end] into the cache, the new
+        values replacing cached ones at the same time. The range is only
+        recorded as downloaded up to `covered_until`, so that later data is
+        downloaded again.
+        """
+        import numpy
+        import pandas
+
+        start, end = to_timestamp(start), to_timestamp(end)
+        covered_end = end if covered_until is None else min(end, to_timestamp(covered_until))
+        index = pandas.DatetimeIndex(series.index)
+        if index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        new_records = numpy.empty(len(series), dtype=self.DTYPE)
+        new_records['time'] = index.values.astype('datetime64[ns]').view('<i8')
+        new_records['value'] = pandas.to_numeric(pandas.Series(series.values), errors='coerce').values
+        new_records = new_records[(new_records['time'] >= start.value) & (new_records['time'] <= end.value)]
+
+        path = self._path(ticker, field, freq)
+        with self._lock(path):
+            records = self._load_records(path, mmap=False)
+            # The stable sort keeps the new records after cached ones at the same time.
+            records = numpy.concatenate([records, new_records])
+            records = records[numpy.argsort(records['time'], kind='mergesort')]
+            is_last = numpy.append(records['time'][1:] != records['time'][:-1], True)
+            records = records[is_last]
+
+            ranges = self.get_covered_ranges(ticker, field, freq)
+            if start <= covered_end:
+                ranges = merge_ranges(ranges + [(start, covered_end)], FREQUENCY_STEPS.get(freq, 0))
+            self._replace(path + '.npy', lambda file: numpy.save(file, records))
+            coverage = {'ranges': [[range_start.isoformat(), range_end.isoformat()]
+                                   for range_start, range_end in ranges]}
+            self._replace(path + '.json', lambda file: file.write(json.dumps(coverage).encode('utf-8')))
+
+    @staticmethod
+    def _replace(path: str, write: Callable) -> None:
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix='.tmp', delete=False) as file:
+            write(file)
+        os.replace(file.name, path)
+
+    def clear(self, ticker: Optional[str] = None, freq: Optional[str] = None) -> None:
+        import shutil
+
+        if freq is None:
+            directory = self.directory
+        elif ticker is None:
+            directory = os.path.join(self.directory, quote(freq, safe=''))
+        else:
+            directory = os.path.dirname(self._path(ticker, '', freq))
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _fetch_ticker(
+    ticker: str,
+        fields: List[str],
+        start: 'pandas.Timestamp',
+        end: 'pandas.Timestamp',
+        freq: str,
+        data_source: MarketDataSource,
+        cache: MarketDataCache,
+        rate_limiter: RateLimiter,
+        covered_until: 'pandas.Timestamp') -> Dict[str, 'pandas.Series']:
+    import pandas
+
+    missing_ranges = merge_ranges(
+        (missing_range for field in fields
+         for missing_range in cache.get_missing_ranges(ticker, field, freq, start, end)),
+        FREQUENCY_STEPS.get(freq, 0))
+    for missing_start, missing_end in missing_ranges:
+        with rate_limiter:
+            df = data_source(ticker, fields, freq, missing_start, missing_end)
+        log_info(f'Downloaded {len(df)} {freq} rows of {ticker} from {missing_start} to {missing_end}.')
+        for field in fields:
+            if field in df.columns:
+                series = df[field]
+            else:
+                series = pandas.Series([], index=pandas.DatetimeIndex([]), dtype=float)
+            # Recent data may still change, so it is not recorded as downloaded.
+            cache.write(ticker, field, freq, series, missing_start, missing_end, covered_until)
+
+    return {f'{ticker}.{field}': cache.read(ticker, field, freq, start, end) for field in fields}
+
+
+def get_market_data(
+    tickers: Iterable[str],
+        fields: Iterable[str],
+        start: DateLike,
+        end: DateLike,
+        freq: str = 'daily',
+        data_source: Optional[MarketDataSource] = None,
+        cache: Optional[MarketDataCache] = None,
+        max_workers: int = MARKET_DATA_MAX_WORKERS,
+        rate_limiter: Optional[RateLimiter] = None) -> 'pandas.DataFrame':
+    """
+    Returns the fields of the tickers between `start` and `end` as a
+    DataFrame with findatapy's '<ticker>.<field>' columns. Only the ranges
+    missing from the cache are downloaded, up to `max_workers` tickers at
+    once and within the rate limit.
+    """
+    import pandas
+
+    tickers, fields = list(dict.fromkeys(tickers)), list(dict.fromkeys(fields))
+    start, end = to_timestamp(start), to_timestamp(end)
+    data_source = data_source or FindatapyDataSource()
+    cache = cache or MarketDataCache()
+    rate_limiter = rate_limiter or RateLimiter()
+    covered_until = to_timestamp(pandas.Timestamp.now(tz='UTC')) - pandas.Timedelta(seconds=MARKET_DATA_CACHE_FRESHNESS)
+    if freq == 'daily':
+        covered_until = covered_until.normalize()
+
+    columns = {}
+    for ticker_columns in imap_unordered(
+            lambda ticker: _fetch_ticker(ticker, fields, start, end, freq, data_source, cache, rate_limiter,
+                                         covered_until),
+            tickers, max(min(max_workers, len(tickers)), 1)):
+        columns.update(ticker_columns)
+    if not columns:
+        return pandas.DataFrame()
+    return pandas.concat([columns[f'{ticker}.{field}'] for ticker in tickers for field in fields], axis=1)
@@ -0,0 +1,121 @@
+"""
+Sizing of the I/O and CPU pools from the recent task instances.
+
+The slots a pool needs follow Little's law: the rate at which its tasks
+finish times their mean duration, at least the tasks running now, plus the
+tasks waiting for a slot. The pools are shared by all the workers, so the
+CPU pool is capped by their configured CPUs, `CPU_POOL_MAX_SLOTS`, rather
+than by the CPUs or the load of the host which happens to resize it.
+"""
+
+import math
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, NamedTuple, Optional
+
+from spider.constant import CPU_POOL, CPU_POOL_MAX_SLOTS, CPU_POOL_MIN_SLOTS, IO_POOL, IO_POOL_MAX_SLOTS, \
+    IO_POOL_MIN_SLOTS, POOL_SIZING_HEADROOM, POOL_SIZING_WINDOW
+from spider.util import log_info
+from spider.util.airflow import create_pool
+
+
+class PoolStats(NamedTuple):
+    finished: int
+    mean_duration: float
+    running: int
+    queued: int
+
+
+class PoolSizing(NamedTuple):
+    pool: str
+    slots: int
+    previous_slots: Optional[int]
+    # Slots wanted from the task instances.
+    demand: float
+    stats: PoolStats
+
+
+@contextmanager
+def _session_scope(session=None) -> Iterator:
+    if session is not None:
+        yield session
+        return
+    from airflow.utils.db import create_session
+    with create_session() as session:
+        yield session
+
+
+def get_pool_stats(pool: str, since: datetime, session) -> PoolStats:
+    from airflow.models import TaskInstance
+    from airflow.utils.state import State
+    from sqlalchemy import func
+
+    finished, mean_duration = session.query(func.count(TaskInstance.task_id), func.avg(TaskInstance.duration)) \
+        .filter(TaskInstance.pool == pool,
+                TaskInstance.end_date >= since,
+                TaskInstance.state.in_([State.SUCCESS, State.FAILED, State.UP_FOR_RETRY]),
+                TaskInstance.duration.isnot(None)) \
+        .one()
+
+    def count(*states: str) -> int:
+        return session.query(func.count(TaskInstance.task_id)) \
+            .filter(TaskInstance.pool == pool, TaskInstance.state.in_(states)) \
+            .scalar()
+
+    # Tasks held back by a full pool stay scheduled instead of being queued.
+    return PoolStats(finished, float(mean_duration or 0), count(State.RUNNING), count(State.SCHEDULED, State.QUEUED))
+
+
+def get_pool_demand(stats: PoolStats, window: timedelta, headroom: float = POOL_SIZING_HEADROOM) -> float:
+    concurrency = stats.finished / window.total_seconds() * stats.mean_duration
+    return max(concurrency * headroom, stats.running) + stats.queued
+
+
+def get_pool_slots(demand: float, min_slots: int, max_slots: int) -> int:
+    return max(min_slots, min(max_slots, math.ceil(demand)))
+
+
+def _get_pool_slots(pool: str, session) -> Optional[int]:
+    from airflow.models import Pool
+
+    pool = session.query(Pool).filter(Pool.pool == pool).first()
+    return None if pool is None else pool.slots
+
+
+def _emit_sizing(sizing: PoolSizing) -> None:
+    from airflow.settings import Stats
+
+    Stats.gauge(f'spider_pool.{sizing.pool}.slots', sizing.slots)
+    Stats.gauge(f'spider_pool.{sizing.pool}.demand', sizing.demand)
+    log_info(f'Pool {sizing.pool}: {sizing.previous_slots} -> {sizing.slots} slots '
+             f'(demand {sizing.demand:.1f}, {sizing.stats.finished} finished '
+             f'in {sizing.stats.mean_duration:.0f}s on average, {sizing.stats.running} running, '
+             f'{sizing.stats.queued} queued).')
+
+
+def resize_pools(
+    window: timedelta = POOL_SIZING_WINDOW,
+        headroom: float = POOL_SIZING_HEADROOM,
+        dry_run: bool = False,
+        session=None) -> List[PoolSizing]:
+    """
+    Sizes `IO_POOL` and `CPU_POOL` from the task instances of the last
+    `window`, creating the pools if needed.
+    The decisions are sent as StatsD gauges and logged; with `dry_run`
+    they are not applied.
+    """
+    since = datetime.now(timezone.utc) - window
+    sizings = []
+    with _session_scope(session) as session:
+        for pool, min_slots, max_slots, description in [
+                (IO_POOL, IO_POOL_MIN_SLOTS, IO_POOL_MAX_SLOTS, 'Tasks waiting on BigQuery and other services'),
+                (CPU_POOL, CPU_POOL_MIN_SLOTS, CPU_POOL_MAX_SLOTS, 'Tasks transforming data on the worker')]:
+            stats = get_pool_stats(pool, since, session)
+            demand = get_pool_demand(stats, window, headroom)
+            sizing = PoolSizing(pool, get_pool_slots(demand, min_slots, max_slots), _get_pool_slots(pool, session),
+                                demand, stats)
+            _emit_sizing(sizing)
+            if not dry_run and sizing.slots != sizing.previous_slots:
+                create_pool(pool, sizing.slots, description, session=session)
+            sizings.append(sizing)
+    return sizings
@@ -0,0 +1,459 @@
+"""
+Replication of backend Postgres tables into BigQuery.
+
+Rows are streamed from a named server-side cursor, `fetch_size` rows per round
+trip, straight into the chunked BigQuery loaders, so a table of any size is
+replicated in bounded memory. Alternatively `COPY ... TO STDOUT` streams the
+table as CSV into chunks loaded the same way, which is faster for wide
+tables without array columns. Tables with an updated-at column are replicated incrementally
+through `spider.util.incremental`.
+
+Connections come from a `connection_factory`, each worker opening its own, so
+that tests and local runs can point the helpers at a local Postgres.
+"""
+
+import base64
+import datetime
+import decimal
+import gzip
+import json
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from typing import IO, TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from google.cloud import bigquery
+
+from spider.constant import (
+    BIGQUERY_LOAD_CHUNK_BYTES, BIGQUERY_LOAD_COMPRESS_LEVEL, BIGQUERY_LOAD_MAX_MEMORY_SIZE, POSTGRES_FETCH_SIZE,
+    POSTGRES_HOST, POSTGRES_PASSWORD, POSTGRES_PORT, POSTGRES_REPLICATION_MAX_WORKERS, POSTGRES_SCHEMA, POSTGRES_USER
+)
+from spider.util import log_info
+from spider.util.database import (
+    _ChunkSizer, _csv_load_job_config, load_chunks_to_bigquery, split_csv_buffer, upload_dict_iterable_to_bigquery
+)
+from spider.util.incremental import (
+    _delete_staging_table, _get_staging_table_id, get_watermark, merge_staging_table
+)
+from spider.util.iterator import imap_unordered
+
+# psycopg2 is imported where it is used, it is only installed on the workers.
+if TYPE_CHECKING:
+    import psycopg2.extensions
+
+ConnectionFactory = Callable[[], 'psycopg2.extensions.connection']
+
+REPLICATION_METHOD_CURSOR = 'cursor'
+REPLICATION_METHOD_COPY = 'copy'
+
+# https://www.postgresql.org/docs/current/datatype.html by `udt_name`
+POSTGRES_TO_BIGQUERY_TYPES = {
+    'int2': 'INTEGER', 'int4': 'INTEGER', 'int8': 'INTEGER', 'oid': 'INTEGER',
+    'float4': 'FLOAT', 'float8': 'FLOAT', 'numeric': 'NUMERIC', 'money': 'STRING',
+    'bool': 'BOOLEAN',
+    'date': 'DATE', 'time': 'TIME', 'timetz': 'STRING',
+    'timestamp': 'DATETIME', 'timestamptz': 'TIMESTAMP', 'interval': 'STRING',
+    'bytea': 'BYTES',
+}
+# Types whose values psycopg2 already returns JSON serializable.
+_JSON_NATIVE_TYPES = {'int2', 'int4', 'int8', 'oid', 'float4', 'float8', 'bool', 'text', 'varchar', 'bpchar', 'name'}
+
+
+class PostgresColumn(NamedTuple):
+    name: str
+    # Name of the type, e.g. 'int4' or '_int4' for an array of int4.
+    udt_name: str
+    is_nullable: bool
+
+    @property
+    def is_array(self) -> bool:
+        return self.udt_name.startswith('_')
+
+    @property
+    def element_type(self) -> str:
+        return self.udt_name[1:] if self.is_array else self.udt_name
+
+
+class PostgresTable(NamedTuple):
+    table_name: str
+    destination_table_id: Optional[str] = None
+    # Replicates incrementally on this column if set, merging on `key_columns`.
+    updated_at_column: Optional[str] = None
+    # Defaults to the primary key of the table.
+    key_columns: Optional[List[str]] = None
+
+
+class ReplicationResult(NamedTuple):
+    table_name: str
+    destination_table_id: str
+    row_count: int
+    seconds: float
+    watermark: Optional[str]
+
+
+def get_postgres_connection() -> 'psycopg2.extensions.connection':
+    import psycopg2
+
+    return psycopg2.connect(
+        host=POSTGRES_HOST, port=POSTGRES_PORT, dbname=POSTGRES_SCHEMA,
+        user=POSTGRES_USER, password=POSTGRES_PASSWORD)
+
+
+def get_postgres_columns(
+    connection: 'psycopg2.extensions.connection',
+        table_name: str,
+        schema_name: str = 'public') -> List[PostgresColumn]:
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            SELECT column_name, udt_name, is_nullable = 'YES'
+            FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s
+            ORDER BY ordinal_position
+        ''', (schema_name, table_name))
+        columns = [PostgresColumn(*row) for row in cursor.fetchall()]
+    if not columns:
+        raise ValueError(f'Table {schema_name}.{table_name} not found or without columns')
+    return columns
+
+
+def get_primary_key_columns(
+    connection: 'psycopg2.extensions.connection',
+        table_name: str,
+        schema_name: str = 'public') -> List[str]:
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            SELECT kcu.column_name
+            FROM information_schema.table_constraints AS tc
+            JOIN information_schema.key_column_usage AS kcu
+              ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+            WHERE tc.constraint_type = 'PRIMARY KEY' AND tc.table_schema = %s AND tc.table_name = %s
+            ORDER BY kcu.ordinal_position
+        ''', (schema_name, table_name))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def postgres_columns_to_bigquery_schema(columns: List[PostgresColumn]) -> List[bigquery.SchemaField]:
+    """
+    Maps Postgres types to BigQuery types, arrays to REPEATED fields and
+    every type without an equivalent, e.g. json, uuid or text, to STRING.
+    """
+    return [bigquery.SchemaField(
+        column.name,
+        POSTGRES_TO_BIGQUERY_TYPES.get(column.element_type, 'STRING'),
+        mode='REPEATED' if column.is_array else 'NULLABLE' if column.is_nullable else 'REQUIRED')
+        for column in columns]
+
+
+def to_json_value(value: Any) -> Any:
+    """
+    Converts a value fetched by psycopg2 to what BigQuery loads from JSON
+    for the type mapped by `postgres_columns_to_bigquery_schema`.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, (bytes, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+    return value
+
+
+def _get_value_converters(columns: List[PostgresColumn]) -> Dict[str, Callable[[Any], Any]]:
+    """
+    Returns the conversion of the columns whose values are not already
+    JSON serializable, the other columns are passed through untouched.
+    """
+    converters = {}
+    for column in columns:
+        if column.element_type in ('json', 'jsonb'):
+            converters[column.name] = json.dumps if not column.is_array else \
+                (lambda values: [json.dumps(value) for value in values])
+        elif column.element_type not in _JSON_NATIVE_TYPES:
+            converters[column.name] = to_json_value
+    return converters
+
+
+def _quote_identifier(identifier: str) -> str:
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _select_sql(
+        columns: List[PostgresColumn],
+        table_name: str,
+        schema_name: str,
+        updated_at_column: Optional[str],
+        for_copy: bool = False) -> str:
+    expressions = []
+    for column in columns:
+        expression = _quote_identifier(column.name)
+        if for_copy and column.is_array:
+            raise ValueError(f'Column {column.name} is an array, which cannot be loaded from CSV; '
+                             f'use the cursor replication method.')
+        if for_copy and column.udt_name == 'bytea':
+            expression = f"encode({expression}, 'base64') AS {expression}"
+        if for_copy and column.udt_name == 'timestamptz':
+            # BigQuery reads a timestamp without offset as UTC.
+            expression = f"to_char({expression} AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS.US') AS {expression}"
+        expressions.append(expression)
+    sql = f'SELECT {", ".join(expressions)} FROM {_quote_identifier(schema_name)}.{_quote_identifier(table_name)}'
+    if updated_at_column:
+        sql += f' WHERE %(watermark)s IS NULL OR {_quote_identifier(updated_at_column)} > %(watermark)s'
+    return sql
+
+
+def iter_postgres_rows(
+    connection: 'psycopg2.extensions.connection',
+        sql: str,
+        parameters: Optional[dict],
+        columns: List[PostgresColumn],
+        fetch_size: int = POSTGRES_FETCH_SIZE) -> Iterator[dict]:
+    """
+    Yields the rows of a query as JSON serializable dicts from a named
+    server-side cursor, holding at most `fetch_size` rows in memory.
+    """
+    names = [column.name for column in columns]
+    converters = list(_get_value_converters(columns).items())
+    with connection.cursor(name=f'spider_{uuid.uuid4().hex}') as cursor:
+        cursor.itersize = fetch_size
+        cursor.execute(sql, parameters)
+        for values in cursor:
+            row = dict(zip(names, values))
+            for name, converter in converters:
+                if row[name] is not None:
+                    row[name] = converter(row[name])
+            yield row
+
+
+class _CsvChunkWriter:
+    """
+    Target of `COPY ... TO STDOUT` cutting the CSV into gzipped buffers of
+    about the target size of `chunk_sizer` in uncompressed bytes, each
+    starting with the header. psycopg2 writes one whole row per call,
+    quoted line breaks included, so a row is never cut in two.
+    """
+
+    def __init__(self, chunk_sizer: _ChunkSizer, put_chunk: Callable[[IO], None], max_memory_size: int):
+        self.chunk_sizer = chunk_sizer
+        self.put_chunk = put_chunk
+        self.max_memory_size = max_memory_size
+        self.header = None
+        self.buffer = None
+        self.stream = None
+        self.byte_count = 0
+
+    def write(self, data: bytes) -> None:
+        if self.header is None:
+            self.header = data
+            return
+        if self.buffer is None:
+            self.buffer = tempfile.SpooledTemporaryFile(max_size=self.max_memory_size, mode='w+b')
+            self.stream = gzip.GzipFile(fileobj=self.buffer, mode='wb', compresslevel=BIGQUERY_LOAD_COMPRESS_LEVEL)
+            self.stream.write(self.header)
+            self.byte_count = len(self.header)
+        self.stream.write(data)
+        self.byte_count += len(data)
+        if self.byte_count >= self.chunk_sizer.chunk_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Hands the current chunk over, if it holds any row.
+        """
+        if self.buffer is None:
+            return
+        buffer, self.buffer = self.buffer, None
+        self.stream.close()  # Flushes the gzip trailer, leaves `buffer` open.
+        buffer.seek(0)
+        self.put_chunk(buffer)
+
+    def close(self) -> None:
+        if self.buffer is not None:
+            self.stream.close()
+            self.buffer.close()
+            self.buffer = None
+
+
+class _CopyCancelled(Exception):
+    pass
+
+
+def iter_postgres_csv_chunks(
+    connection: 'psycopg2.extensions.connection',
+        sql: str,
+        parameters: Optional[dict] = None,
+        chunk_sizer: Optional[_ChunkSizer] = None,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE) -> Iterator[IO]:
+    """
+    Yields the result of the query as gzipped CSV buffers with a header,
+    see `_CsvChunkWriter`, while `COPY ... TO STDOUT` runs in a background
+    thread. At most one finished chunk waits for the consumer, so the copy
+    is paced by the loads, and it is cancelled if the consumer stops.
+    """
+    chunk_sizer = chunk_sizer or _ChunkSizer(BIGQUERY_LOAD_CHUNK_BYTES)
+    chunks = queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    def put(item: Any) -> None:
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        if item is not None and not isinstance(item, BaseException):
+            item.close()
+        raise _CopyCancelled()
+
+    def copy() -> None:
+        writer = _CsvChunkWriter(chunk_sizer, put, max_memory_size)
+        try:
+            with connection.cursor() as cursor:
+                query = cursor.mogrify(sql, parameters).decode('utf-8') if parameters else sql
+                cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)', writer)
+            writer.flush()
+            put(None)
+        except _CopyCancelled:
+            pass
+        except BaseException as e:
+            try:
+                put(e)
+            except _CopyCancelled:
+                pass
+        finally:
+            writer.close()
+
+    thread = threading.Thread(target=copy, name='spider_postgres_copy', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        stopped.set()
+        thread.join()
+        while not chunks.empty():
+            chunk = chunks.get_nowait()
+            if chunk is not None and not isinstance(chunk, BaseException):
+                chunk.close()
+
+
+def _load_postgres_query(
+    bigquery_client: bigquery.Client,
+        connection: 'psycopg2.extensions.connection',
+        sql: str,
+        parameters: Optional[dict],
+        columns: List[PostgresColumn],
+        destination_dataset_id: str,
+        destination_table_id: str,
+        method: str,
+        fetch_size: int,
+        chunk_bytes: int) -> int:
+    schema = postgres_columns_to_bigquery_schema(columns)
+    if method == REPLICATION_METHOD_COPY:
+        chunk_sizer = _ChunkSizer(chunk_bytes)
+        results = load_chunks_to_bigquery(
+            bigquery_client=bigquery_client,
+            chunk_files=iter_postgres_csv_chunks(connection, sql, parameters, chunk_sizer),
+            destination_dataset_id=destination_dataset_id,
+            destination_table_id=destination_table_id,
+            job_config_factory=lambda write_disposition: _csv_load_job_config(
+                schema, write_disposition, allow_quoted_newlines=True),
+            split_chunk_file=split_csv_buffer,
+            chunk_sizer=chunk_sizer)
+    elif method == REPLICATION_METHOD_CURSOR:
+        results = upload_dict_iterable_to_bigquery(
+            bigquery_client, iter_postgres_rows(connection, sql, parameters, columns, fetch_size),
+            destination_dataset_id, destination_table_id, schema, chunk_bytes=chunk_bytes)
+    else:
+        raise ValueError(f'Unknown replication method {method}')
+    return sum(result.row_count for result in results)
+
+
+def replicate_postgres_table(
+    bigquery_client: bigquery.Client,
+        table: PostgresTable,
+        destination_dataset_id: str,
+        connection_factory: ConnectionFactory = get_postgres_connection,
+        source_schema_name: str = 'public',
+        method: str = REPLICATION_METHOD_CURSOR,
+        fetch_size: int = POSTGRES_FETCH_SIZE,
+        chunk_bytes: int = BIGQUERY_LOAD_CHUNK_BYTES) -> ReplicationResult:
+    """
+    Replaces the BigQuery table with the Postgres table or, with an
+    `updated_at_column`, stages the rows updated since the last watermark
+    and merges them into it. The whole table is read in one repeatable
+    read transaction, i.e. from a consistent snapshot.
+    """
+    start = time.perf_counter()
+    destination_table_id = table.destination_table_id or table.table_name
+    connection = connection_factory()
+    try:
+        connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with connection.cursor() as cursor:
+            cursor.execute("SET TIME ZONE 'UTC'")
+        columns = get_postgres_columns(connection, table.table_name, source_schema_name)
+        sql = _select_sql(columns, table.table_name, source_schema_name, table.updated_at_column,
+                          for_copy=method == REPLICATION_METHOD_COPY)
+
+        if not table.updated_at_column:
+            row_count = _load_postgres_query(
+                bigquery_client, connection, sql, None, columns, destination_dataset_id,
+                destination_table_id, method, fetch_size, chunk_bytes)
+            watermark = None
+        else:
+            key_columns = table.key_columns or get_primary_key_columns(
+                connection, table.table_name, source_schema_name)
+            if not key_columns:
+                raise ValueError(f'Table {table.table_name} has no primary key, pass its key_columns')
+            previous_watermark = get_watermark(bigquery_client, destination_dataset_id, destination_table_id)
+            staging_table_id = _get_staging_table_id(destination_table_id)
+            try:
+                row_count = _load_postgres_query(
+                    bigquery_client, connection, sql, {'watermark': previous_watermark}, columns,
+                    destination_dataset_id, staging_table_id, method, fetch_size, chunk_bytes)
+                watermark = previous_watermark
+                if row_count:
+                    watermark = merge_staging_table(
+                        bigquery_client, staging_table_id, destination_dataset_id, destination_table_id,
+                        key_columns, table.updated_at_column,
+                        previous_watermark=previous_watermark).watermark
+            finally:
+                _delete_staging_table(bigquery_client, destination_dataset_id, staging_table_id)
+        connection.commit()
+    finally:
+        connection.close()
+
+    result = ReplicationResult(
+        table.table_name, destination_table_id, row_count, time.perf_counter() - start, watermark)
+    log_info(f'Replicated {row_count} rows of {source_schema_name}.{table.table_name} '
+             f'into {destination_dataset_id}.{destination_table_id} in {result.seconds:.1f}s')
+    return result
+
+
+def replicate_postgres_tables(
+    bigquery_client: bigquery.Client,
+        tables: Iterable[PostgresTable],
+        destination_dataset_id: str,
+        connection_factory: ConnectionFactory = get_postgres_connection,
+        max_workers: int = POSTGRES_REPLICATION_MAX_WORKERS,
+        **kwargs) -> List[ReplicationResult]:
+    """
+    Replicates the tables with up to `max_workers` tables at once, each on
+    its own connection, and returns the results in completion order. The
+    keyword arguments are passed on to `replicate_postgres_table`.
+    """
+    def replicate(table: PostgresTable) -> ReplicationResult:
+        return replicate_postgres_table(
+            bigquery_client, table, destination_dataset_id, connection_factory, **kwargs)
+
+    return list(imap_unordered(replicate, tables, max_workers))
@@ -0,0 +1,320 @@
+"""
+Extraction of Salesforce objects into BigQuery through the Bulk API.
+
+Every object is read by a bulk query job with PK chunking, so that Salesforce
+splits large objects into batches of `chunk_size` records by id. The results
+of the batches are downloaded concurrently as soon as they complete, one
+result file per worker, and their records are streamed into the chunked
+BigQuery loaders, so no full result set is held in memory. Objects with a
+SystemModstamp are pulled incrementally through `spider.util.incremental`.
+
+Only the `session`, `session_id` and `bulk_url` of a simple-salesforce client
+and the `describe` of its objects are used, so that the endpoint can be mocked
+with requests-mock in tests.
+"""
+
+import datetime
+import re
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from google.cloud import bigquery
+
+from spider.constant import (
+    BIGQUERY_LOAD_CHUNK_BYTES, SALESFORCE_BULK_MAX_WORKERS, SALESFORCE_BULK_POLL_INTERVAL, SALESFORCE_BULK_TIMEOUT,
+    SALESFORCE_EXTRACTION_MAX_WORKERS, SALESFORCE_PK_CHUNK_SIZE
+)
+from spider.util import log_info
+from spider.util.database import upload_dict_iterable_to_bigquery
+from spider.util.incremental import get_watermark, upload_dict_iterable_incrementally
+from spider.util.iterator import imap_unordered
+
+# simple-salesforce is imported by the callers, it is only installed on the workers.
+if TYPE_CHECKING:
+    import simple_salesforce
+
+KEY_FIELD = 'Id'
+WATERMARK_FIELD = 'SystemModstamp'
+
+# https://developer.salesforce.com/docs/atlas.en-us.api.meta/api/field_types.htm
+SALESFORCE_TO_BIGQUERY_TYPES = {
+    'boolean': 'BOOLEAN',
+    'int': 'INTEGER',
+    'double': 'FLOAT', 'currency': 'FLOAT', 'percent': 'FLOAT',
+    'date': 'DATE', 'datetime': 'TIMESTAMP',
+}
+# Compound and binary fields, which bulk queries cannot select.
+_UNSUPPORTED_TYPES = {'address', 'location', 'base64', 'complexvalue'}
+_FINISHED_BATCH_STATES = {'Completed', 'Failed', 'NotProcessed'}
+_EPOCH = datetime.datetime(1970, 1, 1)
+_WATERMARK_REGEX = re.compile(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})')
+
+
+class SalesforceField(NamedTuple):
+    name: str
+    type: str
+    nillable: bool
+
+
+class SalesforceObject(NamedTuple):
+    object_name: str
+    destination_table_id: Optional[str] = None
+    # Defaults to every field the Bulk API can query.
+    fields: Optional[List[str]] = None
+    # Merges the records modified since the last watermark instead of replacing the table.
+    incremental: bool = True
+
+
+class ExtractionResult(NamedTuple):
+    object_name: str
+    destination_table_id: str
+    row_count: int
+    seconds: float
+    watermark: Optional[str]
+
+
+def get_salesforce_fields(
+    sf: 'simple_salesforce.Salesforce',
+        object_name: str,
+        field_names: Optional[List[str]] = None) -> List[SalesforceField]:
+    fields = [SalesforceField(field['name'], field['type'], field['nillable'])
+              for field in getattr(sf, object_name).describe()['fields']
+              if field['type'] not in _UNSUPPORTED_TYPES]
+    if field_names:
+        field_names = set(field_names)
+        fields = [field for field in fields if field.name in field_names]
+    if not fields:
+        raise ValueError(f'Object {object_name} has no field to extract')
+    return fields
+
+
+def salesforce_fields_to_bigquery_schema(fields: List[SalesforceField]) -> List[bigquery.SchemaField]:
+    return [bigquery.SchemaField(
+        field.name, SALESFORCE_TO_BIGQUERY_TYPES.get(field.type, 'STRING'),
+        mode='NULLABLE' if field.nillable else 'REQUIRED')
+        for field in fields]
+
+
+def milliseconds_to_datetime_string(value: Any) -> Any:
+    """
+    Converts the milliseconds since the epoch that bulk queries return for
+    datetime fields to a UTC timestamp BigQuery loads from JSON.
+    """
+    if isinstance(value, (int, float)):
+        return (_EPOCH + datetime.timedelta(milliseconds=value)).isoformat(sep=' ', timespec='milliseconds')
+    return value
+
+
+def milliseconds_to_date_string(value: Any) -> Any:
+    if isinstance(value, (int, float)):
+        return (_EPOCH + datetime.timedelta(milliseconds=value)).date().isoformat()
+    return value
+
+
+def _get_value_converters(fields: List[SalesforceField]) -> Dict[str, Callable[[Any], Any]]:
+    converters = {}
+    for field in fields:
+        if field.type == 'datetime':
+            converters[field.name] = milliseconds_to_datetime_string
+        elif field.type == 'date':
+            converters[field.name] = milliseconds_to_date_string
+    return converters
+
+
+def _to_soql_datetime(watermark: str) -> str:
+    """
+    Converts a watermark cast to a string by BigQuery, e.g.
+    '2019-01-01 12:00:00.123+00', to a SOQL datetime literal. The fraction of
+    a second is dropped, so the records of the last second are pulled again.
+    """
+    match = _WATERMARK_REGEX.match(watermark)
+    if not match:
+        raise ValueError(f'Not a timestamp watermark: {watermark}')
+    return f'{match.group(1)}T{match.group(2)}Z'
+
+
+def _soql(object_name: str, fields: List[SalesforceField], watermark: Optional[str]) -> str:
+    soql = f'SELECT {", ".join(field.name for field in fields)} FROM {object_name}'
+    if watermark:
+        soql += f' WHERE {WATERMARK_FIELD} > {_to_soql_datetime(watermark)}'
+    return soql
+
+
+def _bulk_request(sf: 'simple_salesforce.Salesforce', method: str, path: str,
+                  headers: Optional[dict] = None, **kwargs) -> Any:
+    response = sf.session.request(
+        method, f'{sf.bulk_url}{path}',
+        headers={'X-SFDC-Session': sf.session_id, 'Content-Type': 'application/json; charset=UTF-8',
+                 **(headers or {})},
+        **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def create_bulk_query_job(
+    sf: 'simple_salesforce.Salesforce',
+        object_name: str,
+        soql: str,
+        chunk_size: Optional[int] = SALESFORCE_PK_CHUNK_SIZE) -> str:
+    """
+    Creates a JSON bulk query job with a single query batch, which
+    Salesforce splits into batches of `chunk_size` records by id if PK
+    chunking is enabled. Returns the job id.
+    """
+    headers = {'Sforce-Enable-PKChunking': f'chunkSize={chunk_size}'} if chunk_size else None
+    job = _bulk_request(sf, 'POST', 'job', headers=headers,
+                        json={'operation': 'query', 'object': object_name, 'contentType': 'JSON'})
+    _bulk_request(sf, 'POST', f'job/{job["id"]}/batch', data=soql.encode('utf-8'))
+    return job['id']
+
+
+def close_bulk_job(sf: 'simple_salesforce.Salesforce', job_id: str) -> None:
+    _bulk_request(sf, 'POST', f'job/{job_id}', json={'state': 'Closed'})
+
+
+def get_completed_batches(sf: 'simple_salesforce.Salesforce', job_id: str) -> Tuple[List[str], bool]:
+    """
+    Returns the ids of the completed batches of the job and whether others
+    are still being processed. With PK chunking the original batch ends up
+    not processed once it was split into the others.
+    """
+    completed = []
+    is_running = False
+    for batch in _bulk_request(sf, 'GET', f'job/{job_id}/batch')['batchInfo']:
+        if batch['state'] == 'Failed':
+            raise RuntimeError(f'Batch {batch["id"]} of the bulk job {job_id} failed: '
+                               f'{batch.get("stateMessage")}')
+        if batch['state'] == 'Completed':
+            completed.append(batch['id'])
+        elif batch['state'] not in _FINISHED_BATCH_STATES:
+            is_running = True
+    return completed, is_running
+
+
+def get_batch_result_ids(sf: 'simple_salesforce.Salesforce', job_id: str, batch_id: str) -> List[str]:
+    return _bulk_request(sf, 'GET', f'job/{job_id}/batch/{batch_id}/result')
+
+
+def download_batch_result(sf: 'simple_salesforce.Salesforce', job_id: str, batch_id: str,
+                          result_id: str) -> List[dict]:
+    return _bulk_request(sf, 'GET', f'job/{job_id}/batch/{batch_id}/result/{result_id}')
+
+
+def iter_salesforce_records(
+    sf: 'simple_salesforce.Salesforce',
+        object_name: str,
+        soql: str,
+        fields: List[SalesforceField],
+        chunk_size: Optional[int] = SALESFORCE_PK_CHUNK_SIZE,
+        max_workers: int = SALESFORCE_BULK_MAX_WORKERS,
+        poll_interval: float = SALESFORCE_BULK_POLL_INTERVAL,
+        timeout: float = SALESFORCE_BULK_TIMEOUT) -> Iterator[dict]:
+    """
+    Runs the query as a bulk job and yields its records as JSON serializable
+    dicts. The results of the batches are downloaded as soon as the batches
+    complete, up to `max_workers` at once while the job is still polled, and
+    the records of each result are yielded as soon as it is downloaded.
+    """
+    converters = list(_get_value_converters(fields).items())
+    job_id = create_bulk_query_job(sf, object_name, soql, chunk_size)
+    completed = set()
+    # Results of the completed batches waiting for a worker, as (batch id, result id).
+    results = deque()
+    pending = set()
+    is_running = True
+    deadline = time.monotonic() + timeout
+    next_poll = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while is_running or results or pending:
+                if is_running and time.monotonic() >= next_poll:
+                    batch_ids, is_running = get_completed_batches(sf, job_id)
+                    for batch_id in batch_ids:
+                        if batch_id not in completed:
+                            completed.add(batch_id)
+                            results.extend((batch_id, result_id)
+                                           for result_id in get_batch_result_ids(sf, job_id, batch_id))
+                    if is_running and time.monotonic() > deadline:
+                        raise TimeoutError(f'Bulk job {job_id} did not finish within {timeout}s')
+                    next_poll = time.monotonic() + poll_interval
+
+                while results and len(pending) < max_workers:
+                    pending.add(executor.submit(download_batch_result, sf, job_id, *results.popleft()))
+                # Downloads are only waited for until the job has to be polled again.
+                wait_timeout = max(next_poll - time.monotonic(), 0) if is_running else None
+                if not pending:
+                    time.sleep(wait_timeout or 0)
+                    continue
+
+                done, pending = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for record in future.result():
+                        record.pop('attributes', None)
+                        for name, converter in converters:
+                            if record.get(name) is not None:
+                                record[name] = converter(record[name])
+                        yield record
+    finally:
+        close_bulk_job(sf, job_id)
+
+
+def extract_salesforce_object(
+    bigquery_client: bigquery.Client,
+        sf: 'simple_salesforce.Salesforce',
+        sf_object: SalesforceObject,
+        destination_dataset_id: str,
+        chunk_size: Optional[int] = SALESFORCE_PK_CHUNK_SIZE,
+        max_workers: int = SALESFORCE_BULK_MAX_WORKERS,
+        poll_interval: float = SALESFORCE_BULK_POLL_INTERVAL,
+        chunk_bytes: int = BIGQUERY_LOAD_CHUNK_BYTES) -> ExtractionResult:
+    """
+    Replaces the BigQuery table with the object or, if it is incremental and
+    has a SystemModstamp, stages the records modified since the last
+    watermark and merges them into the table on their id.
+    """
+    start = time.perf_counter()
+    object_name = sf_object.object_name
+    destination_table_id = sf_object.destination_table_id or object_name
+    field_names = sf_object.fields and list({KEY_FIELD, WATERMARK_FIELD} | set(sf_object.fields))
+    fields = get_salesforce_fields(sf, object_name, field_names)
+    schema = salesforce_fields_to_bigquery_schema(fields)
+
+    if sf_object.incremental and WATERMARK_FIELD in {field.name for field in fields}:
+        previous_watermark = get_watermark(bigquery_client, destination_dataset_id, destination_table_id)
+        records = iter_salesforce_records(sf, object_name, _soql(object_name, fields, previous_watermark), fields,
+                                          chunk_size, max_workers, poll_interval)
+        result = upload_dict_iterable_incrementally(
+            bigquery_client, records, destination_dataset_id, destination_table_id, schema,
+            [KEY_FIELD], WATERMARK_FIELD, previous_watermark=previous_watermark)
+        row_count, watermark = result.row_count, result.watermark
+    else:
+        records = iter_salesforce_records(sf, object_name, _soql(object_name, fields, None), fields,
+                                          chunk_size, max_workers, poll_interval)
+        results = upload_dict_iterable_to_bigquery(
+            bigquery_client, records, destination_dataset_id, destination_table_id, schema, chunk_bytes=chunk_bytes)
+        row_count, watermark = sum(result.row_count for result in results), None
+
+    result = ExtractionResult(object_name, destination_table_id, row_count, time.perf_counter() - start, watermark)
+    log_info(f'Extracted {row_count} {object_name} records '
+             f'into {destination_dataset_id}.{destination_table_id} in {result.seconds:.1f}s')
+    return result
+
+
+def extract_salesforce_objects(
+    bigquery_client: bigquery.Client,
+        sf: 'simple_salesforce.Salesforce',
+        sf_objects: Iterable[SalesforceObject],
+        destination_dataset_id: str,
+        max_workers: int = SALESFORCE_EXTRACTION_MAX_WORKERS,
+        **kwargs) -> List[ExtractionResult]:
+    """
+    Extracts up to `max_workers` objects at once and returns the results in
+    completion order. The keyword arguments are passed on to
+    `extract_salesforce_object`.
+    """
+    def extract(sf_object: SalesforceObject) -> ExtractionResult:
+        return extract_salesforce_object(bigquery_client, sf, sf_object, destination_dataset_id, **kwargs)
+
+    return list(imap_unordered(extract, sf_objects, max_workers))
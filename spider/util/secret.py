@@ -1,8 +1,40 @@
 import os
+from typing import Dict, Iterable, Optional
+
 from spider.constant.secret import SECRET_DIR
-from spider.util.file import read_file
+from spider.util.async_file import async_read_files, get_cached_file, invalidate_file_cache, read_files
+
+
+def _get_secret_filepath(secret_key: str) -> str:
+    return os.path.join(SECRET_DIR, secret_key)
 
 
 def get_secret(secret_key: str) -> str:
-    return read_file(os.path.join(
-        SECRET_DIR, secret_key)).rstrip()
+    """
+    Reads a secret from `SECRET_DIR` once per process and serves it
+    from memory afterwards, until `invalidate_secrets` is called.
+    """
+    return get_cached_file(_get_secret_filepath(secret_key)).rstrip()
+
+
+def warm_secrets(secret_keys: Iterable[str]) -> None:
+    """
+    Reads all missing secrets concurrently, e.g. at task start up.
+    """
+    read_files(map(_get_secret_filepath, secret_keys))
+
+
+async def async_get_secrets(secret_keys: Iterable[str]) -> Dict[str, str]:
+    """
+    Reads the secrets concurrently, through the same cache as `get_secret`.
+    """
+    secret_keys = list(secret_keys)
+    contents = await async_read_files(map(_get_secret_filepath, secret_keys))
+    return {secret_key: contents[_get_secret_filepath(secret_key)].rstrip() for secret_key in secret_keys}
+
+
+def invalidate_secrets(secret_keys: Optional[Iterable[str]] = None) -> None:
+    """
+    Drops the given secrets, or every cached file, from the cache.
+    """
+    invalidate_file_cache(None if secret_keys is None else map(_get_secret_filepath, secret_keys))
@@ -0,0 +1,218 @@
+"""
+Bulk loads into BigQuery staged through Google Cloud Storage.
+
+The rows are written as sharded NDJSON files to a GCS prefix in parallel and
+loaded with a single load job on a wildcard URI, which is much faster for
+large uploads than many sequential appends from local files.
+
+The helpers only use the `bucket`, `blob`, `list_blobs`, `upload_from_file`,
+`download_to_file` and `delete` methods of `google.cloud.storage`, so that
+`FilesystemStorageClient` can stand in for it in tests and local runs.
+"""
+
+import gzip
+import io
+import os
+import re
+import shutil
+import uuid
+from typing import IO, Iterable, Iterator, List, Optional, Tuple
+
+from google.cloud import bigquery
+
+from spider.constant import BIGQUERY_LOCATION, BIGQUERY_LOAD_MAX_MEMORY_SIZE
+from spider.util import log_info
+from spider.util.database import _iter_ndjson_chunk_files, _json_load_job_config, get_table_reference
+from spider.util.instrument import record_job_metrics
+from spider.util.iterator import imap_unordered
+
+GCS_URI_REGEX = re.compile(r'^gs://([^/]+)/(.*)$')
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+class FilesystemBlob:
+    def __init__(self, bucket: 'FilesystemBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.path, *self.name.split('/'))
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def upload_from_file(self, file_obj: IO, rewind: bool = False, content_type: Optional[str] = None) -> None:
+        if rewind:
+            file_obj.seek(0)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as file:
+            shutil.copyfileobj(file_obj, file)
+
+    def download_to_file(self, file_obj: IO) -> None:
+        with open(self.path, 'rb') as file:
+            shutil.copyfileobj(file, file_obj)
+
+    def delete(self) -> None:
+        os.remove(self.path)
+
+
+class FilesystemBucket:
+    def __init__(self, client: 'FilesystemStorageClient', name: str):
+        self.client = client
+        self.name = name
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.client.root_dir, self.name)
+
+    def blob(self, blob_name: str) -> FilesystemBlob:
+        return FilesystemBlob(self, blob_name)
+
+    def list_blobs(self, prefix: str = '') -> Iterator[FilesystemBlob]:
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in sorted(filenames):
+                blob_name = os.path.relpath(os.path.join(dirpath, filename), self.path).replace(os.sep, '/')
+                if blob_name.startswith(prefix):
+                    yield FilesystemBlob(self, blob_name)
+
+
+class FilesystemStorageClient:
+    """
+    Stands in for `google.cloud.storage.Client`, keeping the blob
+    `gs://<bucket>/<name>` in the file `<root_dir>/<bucket>/<name>`.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def bucket(self, bucket_name: str) -> FilesystemBucket:
+        return FilesystemBucket(self, bucket_name)
+
+
+def parse_gcs_uri(gcs_uri: str) -> Tuple[str, str]:
+    """
+    Returns the bucket name and the blob name of `gs://<bucket>/<name>`.
+    """
+    match = GCS_URI_REGEX.match(gcs_uri)
+    if not match:
+        raise ValueError(f'Not a GCS URI: {gcs_uri}')
+    return match.group(1), match.group(2)
+
+
+def upload_file_to_gcs(storage_client, source_file: IO, gcs_uri: str,
+                       content_type: Optional[str] = None) -> str:
+    bucket_name, blob_name = parse_gcs_uri(gcs_uri)
+    storage_client.bucket(bucket_name).blob(blob_name).upload_from_file(
+        source_file, rewind=True, content_type=content_type)
+    return gcs_uri
+
+
+def download_file_from_gcs(storage_client, gcs_uri: str, file_obj: IO) -> IO:
+    bucket_name, blob_name = parse_gcs_uri(gcs_uri)
+    storage_client.bucket(bucket_name).blob(blob_name).download_to_file(file_obj)
+    file_obj.seek(0)
+    return file_obj
+
+
+def delete_gcs_prefix(storage_client, gcs_prefix: str) -> int:
+    """
+    Deletes every blob under the prefix and returns their number.
+    """
+    bucket_name, prefix = parse_gcs_uri(gcs_prefix)
+    blobs = list(storage_client.bucket(bucket_name).list_blobs(prefix=prefix))
+    for blob in blobs:
+        blob.delete()
+    return len(blobs)
+
+
+def upload_dict_iterable_to_gcs(
+    storage_client,
+        dict_iterable: Iterable[dict],
+        gcs_prefix: str,
+        chunk_size: int = 100000,
+        max_workers: int = 8,
+        compress: bool = True,
+        max_memory_size: int = BIGQUERY_LOAD_MAX_MEMORY_SIZE) -> List[str]:
+    """
+    Writes the dicts as NDJSON shards of `chunk_size` rows named
+    `<gcs_prefix>/shard-<index>.json[.gz]`, serializing the next shards
+    while up to `max_workers` are being uploaded. Returns the shard URIs.
+    """
+    extension = '.json.gz' if compress else '.json'
+    shards = ((f'{gcs_prefix.rstrip("/")}/shard-{index:06d}{extension}', file)
+              for index, file in enumerate(_iter_ndjson_chunk_files(
+                  dict_iterable, chunk_size, compress=compress, max_memory_size=max_memory_size)))
+
+    def upload(shard: Tuple[str, IO]) -> str:
+        gcs_uri, file = shard
+        with file:
+            return upload_file_to_gcs(storage_client, file, gcs_uri, NDJSON_CONTENT_TYPE)
+
+    gcs_uris = sorted(imap_unordered(upload, shards, max_workers))
+    log_info(f'Uploaded {len(gcs_uris)} shards to {gcs_prefix}')
+    return gcs_uris
+
+
+def load_gcs_to_bigquery(
+    bigquery_client: bigquery.Client,
+        source_uris: List[str],
+        destination_dataset_id: str,
+        destination_table_id: str,
+        job_config: bigquery.LoadJobConfig) -> str:
+    """
+    Loads the files, which may be wildcard URIs, with a single load job.
+    """
+    for source_uri in source_uris:
+        parse_gcs_uri(source_uri)
+    table_ref = get_table_reference(bigquery_client, destination_dataset_id, destination_table_id)
+    with record_job_metrics('load', f'{destination_dataset_id}.{destination_table_id}') as metrics:
+        job = bigquery_client.load_table_from_uri(
+            source_uris, table_ref, location=BIGQUERY_LOCATION, job_config=job_config)
+        job.result()
+        metrics.observe_job(job)
+    log_info(f'Loaded {job.output_rows} rows from {", ".join(source_uris)} '
+             f'into {destination_dataset_id}:{destination_table_id}.')
+    return job.job_id
+
+
+def upload_dict_iterable_to_bigquery_via_gcs(
+    bigquery_client: bigquery.Client,
+        storage_client,
+        dict_iterable: Iterable[dict],
+        gcs_staging_prefix: str,
+        destination_dataset_id: str,
+        destination_table_id: str,
+        schema: List[bigquery.schema.SchemaField],
+        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
+        chunk_size: int = 100000,
+        max_workers: int = 8,
+        compress: bool = True,
+        keep_staged_files: bool = False) -> Optional[str]:
+    """
+    Stages the dicts as parallel NDJSON shards under a unique directory of
+    `gcs_staging_prefix` and loads them all with one wildcard load job, so
+    the table is replaced or appended to atomically. The shards are
+    deleted afterwards unless `keep_staged_files`.
+    """
+    staging_prefix = f'{gcs_staging_prefix.rstrip("/")}/{destination_table_id}-{uuid.uuid4().hex}'
+    try:
+        gcs_uris = upload_dict_iterable_to_gcs(
+            storage_client, dict_iterable, staging_prefix,
+            chunk_size=chunk_size, max_workers=max_workers, compress=compress)
+        extension = '.json.gz' if compress else '.json'
+        if not gcs_uris:
+            if write_disposition != bigquery.WriteDisposition.WRITE_TRUNCATE:
+                log_info(f'Nothing to load into {destination_dataset_id}:{destination_table_id}.')
+                return None
+            # Otherwise the table would keep the rows of the previous load.
+            log_info(f'No rows to load, emptying {destination_dataset_id}:{destination_table_id}.')
+            upload_file_to_gcs(storage_client, io.BytesIO(gzip.compress(b'') if compress else b''),
+                               f'{staging_prefix}/shard-000000{extension}', NDJSON_CONTENT_TYPE)
+        return load_gcs_to_bigquery(
+            bigquery_client, [f'{staging_prefix}/shard-*{extension}'],
+            destination_dataset_id, destination_table_id,
+            _json_load_job_config(schema, write_disposition))
+    finally:
+        if not keep_staged_files:
+            delete_gcs_prefix(storage_client, staging_prefix + '/')
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def no_job_metrics_sinks(monkeypatch):
+    # Metrics of the mocked jobs would only pollute the metrics file.
+    monkeypatch.setattr('spider.util.instrument._metrics_sinks', [])
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from spider.util import airflow
+from spider.util.airflow import XComReference, delete_task_xcom_payloads, get_task_xcom, push_task_xcom
+from spider.util.storage import FilesystemStorageClient
+
+LARGE_VALUE = [{'ticker': f'TICKER{i}', 'close': float(i)} for i in range(10000)]
+
+
+class MockTaskInstance:
+    def __init__(self, dag_id: str, task_id: str, xcoms: dict):
+        self.dag_id = dag_id
+        self.task_id = task_id
+        self.xcoms = xcoms
+
+    def xcom_push(self, key: str, value) -> None:
+        self.xcoms[self.task_id, key] = value
+
+    def xcom_pull(self, task_ids: str, key: str):
+        return self.xcoms.get((task_ids, key))
+
+
+class MockDagRun:
+    def __init__(self, dag_id: str):
+        self.dag_id = dag_id
+
+
+def make_context(task_id: str, xcoms: dict) -> dict:
+    return {'task_instance': MockTaskInstance('dag', task_id, xcoms), 'dag_run': MockDagRun('dag'),
+            'ts_nodash': '20190101T000000'}
+
+
+@pytest.fixture(autouse=True)
+def xcom_store(monkeypatch, tmpdir):
+    monkeypatch.setattr(airflow, 'XCOM_OFFLOAD_DIR', str(tmpdir.join('xcom')))
+    monkeypatch.setattr(airflow, 'XCOM_OFFLOAD_GCS_PREFIX', None)
+    monkeypatch.setenv('AIRFLOW__CORE__EXECUTOR', 'LocalExecutor')
+    monkeypatch.setattr(airflow, '_xcom_payload_cache', airflow.OrderedDict())
+    return tmpdir
+
+
+def test_small_value_is_not_offloaded():
+    xcoms = {}
+    push_task_xcom({'rows': 1}, make_context('extract', xcoms))
+
+    assert get_task_xcom('extract', make_context('load', xcoms)) == {'rows': 1}
+
+
+def test_large_value_is_offloaded_to_local_file():
+    xcoms = {}
+    push_task_xcom(LARGE_VALUE, make_context('extract', xcoms))
+
+    reference = get_task_xcom('extract', make_context('load', xcoms), lazy=True)
+    assert isinstance(reference, XComReference)
+    assert reference.uri.startswith('file://')
+    assert os.path.isfile(reference.uri[len('file://'):])
+    assert reference.load() == LARGE_VALUE
+    assert get_task_xcom('extract', make_context('load', xcoms)) == LARGE_VALUE
+
+
+def test_local_offload_is_refused_with_celery(monkeypatch):
+    monkeypatch.setenv('AIRFLOW__CORE__EXECUTOR', 'CeleryExecutor')
+    xcoms = {}
+
+    with pytest.raises(ValueError, match='XCOM_OFFLOAD_GCS_PREFIX'):
+        push_task_xcom(LARGE_VALUE, make_context('extract', xcoms))
+    assert xcoms == {}
+
+
+def test_payloads_of_previous_try_are_replaced():
+    xcoms = {}
+    push_task_xcom(LARGE_VALUE, make_context('extract', xcoms))
+    first = get_task_xcom('extract', make_context('load', xcoms), lazy=True)
+    push_task_xcom(LARGE_VALUE[1:], make_context('extract', xcoms))
+    second = get_task_xcom('extract', make_context('load', xcoms), lazy=True)
+
+    assert first.uri != second.uri
+    assert not os.path.exists(first.uri[len('file://'):])
+    assert second.load() == LARGE_VALUE[1:]
+
+
+def test_delete_payloads_of_dag_run_from_gcs(monkeypatch, tmpdir):
+    monkeypatch.setenv('AIRFLOW__CORE__EXECUTOR', 'CeleryExecutor')
+    storage_client = FilesystemStorageClient(str(tmpdir.join('gcs')))
+    xcoms = {}
+    for task_id in ['extract', 'transform']:
+        push_task_xcom(LARGE_VALUE, make_context(task_id, xcoms), storage_client=storage_client,
+                       gcs_prefix='gs://bucket/xcom')
+    reference = get_task_xcom('extract', make_context('load', xcoms), lazy=True)
+    assert reference.uri.startswith('gs://bucket/xcom/dag/20190101T000000/extract/')
+
+    assert delete_task_xcom_payloads(make_context('load', xcoms), 'extract', storage_client,
+                                     gcs_prefix='gs://bucket/xcom') == 1
+    assert delete_task_xcom_payloads(make_context('load', xcoms), storage_client=storage_client,
+                                     gcs_prefix='gs://bucket/xcom') == 1
+    assert list(storage_client.bucket('bucket').list_blobs()) == []
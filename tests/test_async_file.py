@@ -0,0 +1,33 @@
+import asyncio
+import subprocess
+import sys
+
+from spider.util.async_file import async_read_files, get_cached_file, invalidate_file_cache, read_files
+
+
+def test_constants_do_not_import_asyncio():
+    code = ('import sys, spider.constant.google_cloud; '
+            'print(sorted({"asyncio", "concurrent.futures"} & set(sys.modules)))')
+    completed = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True,
+                               check=True)
+
+    assert completed.stdout.strip() == '[]'
+
+
+def test_read_files_fills_the_cache(tmpdir):
+    text, binary = tmpdir.join('text'), tmpdir.join('binary')
+    text.write('secret\r\n')
+    binary.write_binary(b'\xff\xfe\x00')
+
+    try:
+        assert read_files([str(text), str(binary)]) == {str(text): 'secret\n', str(binary): b'\xff\xfe\x00'}
+        text.write('rotated\n')
+        assert get_cached_file(str(text)) == 'secret\n'
+        invalidate_file_cache([str(text)])
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(async_read_files([str(text)])) == {str(text): 'rotated\n'}
+        finally:
+            loop.close()
+    finally:
+        invalidate_file_cache([str(text), str(binary)])
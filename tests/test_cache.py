@@ -0,0 +1,22 @@
+import os
+
+from spider.util.cache import DiskCache
+
+
+def test_cache_directory_is_private(tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')), 1024 * 1024)
+
+    cache.set('key', {'rows': 1})
+
+    assert os.stat(cache.directory).st_mode & 0o777 == 0o700
+    assert cache.get('key') == {'rows': 1}
+
+
+def test_shared_cache_directory_is_not_used(tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')), 1024 * 1024)
+    cache.set('key', {'rows': 1})
+    os.chmod(cache.directory, 0o777)
+
+    assert cache.get('key') is None
+    cache.set('other', {'rows': 2})
+    assert not os.path.exists(os.path.join(cache.directory, 'other.pickle'))
@@ -0,0 +1,237 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from google.api_core.exceptions import BadRequest, InternalServerError, NotFound, ServiceUnavailable
+from google.cloud import bigquery
+
+from benchmark.mock_bigquery import MockBigQueryClient, MockLoadJob
+from spider.util import database, instrument
+from spider.util.cache import DiskCache
+from spider.util.database import CopySpec, _json_load_job_config, copy_tables, get_table_reference_from_path, \
+    load_chunks_to_bigquery, load_query_to_bigquery_table, upload_dict_iterable_to_bigquery
+
+
+class FlakyLoadJob(MockLoadJob):
+    """
+    Load job whose first `result` call raises `error`. The job itself
+    failed if `failed`, otherwise only polling it failed.
+    """
+
+    def __init__(self, job_id: str, data: bytes, error: Exception = None, failed: bool = False):
+        super().__init__(job_id, data)
+        self.error = error
+        self.state = 'DONE'
+        self.error_result = {'reason': 'backendError'} if failed else None
+        self.reload_count = 0
+
+    def reload(self) -> None:
+        self.reload_count += 1
+
+    def result(self) -> 'FlakyLoadJob':
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return self
+
+
+class FlakyBigQueryClient(MockBigQueryClient):
+    def __init__(self, error: Exception, failed: bool = False):
+        super().__init__()
+        self.error = error
+        self.failed = failed
+
+    def load_table_from_file(self, file_obj, destination, job_id=None, **kwargs) -> FlakyLoadJob:
+        job = FlakyLoadJob(job_id, file_obj.read(), self.error, self.failed)
+        # Only the first job is flaky.
+        self.error = None
+        self.jobs.append(job)
+        return job
+
+
+class MockCopyJob:
+    created = started = ended = None
+
+    def __init__(self, job_id: str, sources: list, destination):
+        self.job_id = job_id
+        self.sources = sources
+        self.destination = destination
+
+    def result(self) -> 'MockCopyJob':
+        return self
+
+
+class CopyBigQueryClient(MockBigQueryClient):
+    def copy_table(self, sources, destination, **kwargs) -> MockCopyJob:
+        job = MockCopyJob(f'copy_{len(self.jobs)}', sources, destination)
+        self.jobs.append(job)
+        return job
+
+
+class MockTable:
+    def __init__(self, table_ref: bigquery.TableReference, table_type: str = 'TABLE'):
+        self.path = table_ref.path
+        self.table_type = table_type
+        self.modified = datetime.now(timezone.utc) - timedelta(days=1)
+
+
+class MockQueryJob:
+    job_type = 'query'
+
+    def __init__(self, job_id: str, referenced_tables: list):
+        self.job_id = job_id
+        self.referenced_tables = referenced_tables
+        self.created = self.started = self.ended = datetime.now(timezone.utc)
+
+    def result(self) -> 'MockQueryJob':
+        return self
+
+
+class QueryBigQueryClient(MockBigQueryClient):
+    """
+    Runs every query as reading the tables of `table_types`, by table id.
+    """
+
+    def __init__(self, table_types: dict):
+        super().__init__()
+        self.sources = [self.dataset('source').table(table_id) for table_id in table_types]
+        self.tables = {source.path: MockTable(source, table_type)
+                       for source, table_type in zip(self.sources, table_types.values())}
+
+    def get_table(self, table_ref: bigquery.TableReference) -> MockTable:
+        if table_ref.path not in self.tables:
+            raise NotFound(table_ref.path)
+        return self.tables[table_ref.path]
+
+    def query(self, sql: str, job_config: bigquery.QueryJobConfig = None, **kwargs) -> MockQueryJob:
+        job = MockQueryJob(f'query_{next(self._job_ids)}', self.sources)
+        destination = MockTable(job_config.destination)
+        destination.modified = job.ended
+        self.tables[destination.path] = destination
+        self.jobs.append(job)
+        return job
+
+
+def make_rows(row_count: int):
+    return ({'id': i, 'name': f'row {i}'} for i in range(row_count))
+
+
+def test_polling_error_does_not_resubmit_succeeded_job(monkeypatch):
+    monkeypatch.setattr(database, 'BIGQUERY_LOAD_RETRY_INITIAL_DELAY', 0)
+    client = FlakyBigQueryClient(ServiceUnavailable('polling failed'))
+
+    results = upload_dict_iterable_to_bigquery(client, make_rows(1000), 'dataset', 'table', [])
+
+    assert len(client.jobs) == 1
+    assert client.jobs[0].reload_count == 1
+    assert sum(result.row_count for result in results) == 1000
+
+
+def test_failed_job_is_resubmitted(monkeypatch):
+    monkeypatch.setattr(database, 'BIGQUERY_LOAD_RETRY_INITIAL_DELAY', 0)
+    client = FlakyBigQueryClient(InternalServerError('job failed'), failed=True)
+
+    results = upload_dict_iterable_to_bigquery(client, make_rows(1000), 'dataset', 'table', [])
+
+    assert len(client.jobs) == 2
+    assert client.jobs[0].job_id != client.jobs[1].job_id
+    assert [result.job_id for result in results] == [client.jobs[1].job_id]
+    assert sum(result.row_count for result in results) == 1000
+
+
+def test_split_chunk_is_not_recorded_as_error(monkeypatch):
+    records = []
+    monkeypatch.setattr(instrument, '_metrics_sinks', [records.append])
+    client = FlakyBigQueryClient(BadRequest('Request payload size exceeds the limit'))
+
+    results = upload_dict_iterable_to_bigquery(client, make_rows(1000), 'dataset', 'table', [])
+
+    assert len(client.jobs) == 3
+    assert sum(result.row_count for result in results) == 1000
+    assert [record.get('splits') for record in records] == [1, None, None]
+    assert not any('error' in record for record in records)
+
+
+def test_copy_tables_keeps_partition_decorators():
+    client = CopyBigQueryClient()
+
+    copy_tables(client, [CopySpec(['example.com:project.source.prices$20190101', 'source.volumes'],
+                                  'dataset.prices$20190101')])
+
+    job, = client.jobs
+    assert [(source.project, source.dataset_id, source.table_id) for source in job.sources] == [
+        ('example.com:project', 'source', 'prices$20190101'), ('benchmark', 'source', 'volumes')]
+    assert (job.destination.project, job.destination.dataset_id, job.destination.table_id) == (
+        'benchmark', 'dataset', 'prices$20190101')
+
+
+@pytest.mark.parametrize('table_path, expected', [
+    ('dataset.table', ('benchmark', 'dataset', 'table')),
+    ('project.dataset.table$20190101', ('project', 'dataset', 'table$20190101')),
+    ('example.com:project.dataset.table', ('example.com:project', 'dataset', 'table')),
+    ('project:dataset.table', ('project', 'dataset', 'table')),
+    ('example.com:project:dataset.table$20190101', ('example.com:project', 'dataset', 'table$20190101')),
+])
+def test_get_table_reference_from_path(table_path, expected):
+    table_ref = get_table_reference_from_path(MockBigQueryClient(), table_path)
+
+    assert (table_ref.project, table_ref.dataset_id, table_ref.table_id) == expected
+
+
+@pytest.mark.parametrize('table_path', ['table', 'project:table', ':dataset.table', 'project:.table'])
+def test_get_table_reference_from_invalid_path(table_path):
+    with pytest.raises(ValueError, match='Not a table path'):
+        get_table_reference_from_path(MockBigQueryClient(), table_path)
+
+
+def test_empty_iterable_empties_truncated_table():
+    client = MockBigQueryClient()
+
+    results = upload_dict_iterable_to_bigquery(client, iter([]), 'dataset', 'table', [])
+
+    job, = client.jobs
+    assert job.input_file_bytes == 0
+    assert [(result.job_id, result.row_count, result.write_disposition) for result in results] == [
+        (job.job_id, 0, bigquery.WriteDisposition.WRITE_TRUNCATE)]
+
+
+def test_empty_chunks_append_nothing():
+    client = MockBigQueryClient()
+
+    results = load_chunks_to_bigquery(
+        client, [], 'dataset', 'table', lambda write_disposition: _json_load_job_config([], write_disposition),
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+
+    assert results == []
+    assert client.jobs == []
+
+
+def run_query_twice(client: QueryBigQueryClient, sql: str) -> list:
+    return [load_query_to_bigquery_table(client, sql, 'dataset', 'result', skip_if_unchanged=True)
+            for _ in range(2)]
+
+
+@pytest.fixture
+def query_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr(database, 'QUERY_RESULT_CACHE', DiskCache(str(tmpdir.join('cache')), 1024 * 1024))
+
+
+def test_unchanged_query_is_skipped(query_cache):
+    client = QueryBigQueryClient({'prices': 'TABLE'})
+
+    assert run_query_twice(client, 'SELECT * FROM source.prices') == ['query_0', 'query_0']
+    client.tables[client.dataset('source').table('prices').path].modified = datetime.now(timezone.utc)
+    assert load_query_to_bigquery_table(client, 'SELECT * FROM source.prices', 'dataset', 'result',
+                                        skip_if_unchanged=True) == 'query_1'
+
+
+@pytest.mark.parametrize('sql, table_types', [
+    ('SELECT * FROM source.prices', {'prices': 'VIEW'}),
+    ('SELECT * FROM source.prices', {'prices': 'EXTERNAL'}),
+    ('SELECT * FROM `benchmark.source.prices_*`', {'prices_2019': 'TABLE'}),
+    ('SELECT *, CURRENT_DATE() AS date FROM source.prices', {'prices': 'TABLE'}),
+    ('SELECT * FROM source.prices WHERE RAND() < 0.1', {'prices': 'TABLE'}),
+])
+def test_query_with_untracked_inputs_is_rerun(query_cache, sql, table_types):
+    client = QueryBigQueryClient(table_types)
+
+    assert run_query_twice(client, sql) == ['query_0', 'query_1']
@@ -0,0 +1,37 @@
+import pytest
+
+from spider.util import file
+from spider.util.file import compile_sql_template, render_sql_template
+
+QUERY = 'SELECT * FROM `{dwh_schema}.{table}` WHERE date >= {start_date!r}'
+
+
+@pytest.fixture(autouse=True)
+def default_query_parameters(monkeypatch):
+    monkeypatch.setattr(file, 'get_default_query_parameters', lambda: {'dwh_schema': 'dwh'})
+
+
+def test_render_sql_template_uses_defaults():
+    template = compile_sql_template(QUERY)
+
+    assert render_sql_template(template, {'table': 'prices', 'start_date': '2019-01-01'}) == \
+        "SELECT * FROM `dwh.prices` WHERE date >= '2019-01-01'"
+
+
+def test_render_sql_template_overrides_defaults():
+    template = compile_sql_template(QUERY)
+
+    assert render_sql_template(template, {'dwh_schema': 'test', 'table': 'prices', 'start_date': '2019-01-01'},
+                               strict=True) == "SELECT * FROM `test.prices` WHERE date >= '2019-01-01'"
+
+
+def test_render_sql_template_with_nested_format_spec_overrides_defaults():
+    template = compile_sql_template('SELECT {value:>{width}} FROM `{dwh_schema}.t`')
+
+    assert render_sql_template(template, {'dwh_schema': 'test', 'value': 1, 'width': 3}) == \
+        'SELECT   1 FROM `test.t`'
+
+
+def test_render_sql_template_raises_on_missing_parameters():
+    with pytest.raises(KeyError):
+        render_sql_template(compile_sql_template(QUERY), {'table': 'prices'})
@@ -0,0 +1,16 @@
+from spider.util.incremental import _rows_above_watermark_sql
+
+
+def test_rows_above_watermark_sql_quotes_column_and_drops_semicolon():
+    sql = _rows_above_watermark_sql('SELECT * FROM `project.dataset.orders`;\n', 'updated-at', 'TIMESTAMP')
+
+    assert ';' not in sql
+    assert 'WHERE `updated-at` > CAST(@watermark AS TIMESTAMP)' in sql
+
+
+def test_rows_above_watermark_sql_ends_trailing_comment():
+    sql = _rows_above_watermark_sql('SELECT * FROM orders -- all of them', 'updated_at', 'TIMESTAMP')
+
+    comment_line = next(line for line in sql.splitlines() if '--' in line)
+    assert comment_line.strip() == 'SELECT * FROM orders -- all of them'
+    assert 'WHERE `updated_at`' in sql
@@ -0,0 +1,34 @@
+import json
+
+from spider.util.instrument import NdjsonMetricsSink, aggregate_job_metrics
+
+
+def make_record(operation: str, **metrics) -> dict:
+    return dict({'operation': operation, 'dag_id': 'dag', 'execution_date': '2019-01-01'}, **metrics)
+
+
+def test_metrics_file_is_rotated(tmpdir):
+    filepath = str(tmpdir.join('metrics', 'job_metrics.ndjson'))
+    record = make_record('load', output_rows=10)
+    sink = NdjsonMetricsSink(filepath, max_size=len(json.dumps(record)) * 2)
+
+    for _ in range(5):
+        sink(record)
+
+    assert len(tmpdir.join('metrics').listdir()) == 2
+    assert len(tmpdir.join('metrics', 'job_metrics.ndjson').readlines()) == 1
+    # Only the current and the previous file are kept.
+    assert aggregate_job_metrics('dag', filepath=filepath)['load']['calls'] == 3
+
+
+def test_splits_are_counted_apart_from_errors(tmpdir):
+    filepath = str(tmpdir.join('job_metrics.ndjson'))
+    sink = NdjsonMetricsSink(filepath)
+    sink(make_record('load', splits=1))
+    sink(make_record('load', output_rows=10))
+    sink(make_record('query', error="NotFound('table')"))
+
+    aggregates = aggregate_job_metrics('dag', '2019-01-01', filepath)
+
+    assert (aggregates['load']['splits'], aggregates['load']['errors']) == (1, 0)
+    assert (aggregates['total']['splits'], aggregates['total']['errors'], aggregates['total']['calls']) == (1, 1, 3)
@@ -0,0 +1,44 @@
+import numpy
+import pandas
+import pytest
+
+from spider.util.iterator import iter_dataframe_chunks, split_dataframe_by_chunk
+
+
+def test_dataframe_chunks_are_positional_slices():
+    dataframe = pandas.DataFrame({'close': numpy.arange(10, dtype='float64')}, index=numpy.arange(10)[::-1])
+
+    chunks = list(iter_dataframe_chunks(dataframe, chunk_size=4))
+
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    pandas.testing.assert_frame_equal(pandas.concat(chunks), dataframe)
+
+
+def test_array_chunks_share_memory():
+    array = numpy.arange(100, dtype='int64')
+
+    chunks = list(iter_dataframe_chunks(array, chunk_bytes=8 * 30))
+
+    assert [len(chunk) for chunk in chunks] == [30, 30, 30, 10]
+    assert all(numpy.shares_memory(chunk, array) for chunk in chunks)
+
+
+def test_chunks_are_yielded_lazily():
+    chunks = iter_dataframe_chunks(pandas.Series(range(10)), chunk_size=3)
+
+    assert next(chunks).tolist() == [0, 1, 2]
+    assert [chunk.tolist() for chunk in chunks] == [[3, 4, 5], [6, 7, 8], [9]]
+
+
+def test_chunk_size_or_bytes_is_required():
+    with pytest.raises(ValueError):
+        next(iter_dataframe_chunks(numpy.arange(10)))
+    with pytest.raises(ValueError):
+        next(iter_dataframe_chunks(numpy.arange(10), chunk_size=1, chunk_bytes=8))
+
+
+def test_split_dataframe_by_chunk():
+    dataframe = pandas.DataFrame({'ticker': ['A', 'B', 'C']})
+
+    assert [chunk['ticker'].tolist() for chunk in split_dataframe_by_chunk(dataframe, 2)] == [['A', 'B'], ['C']]
+    assert split_dataframe_by_chunk(dataframe.iloc[:0], 2) == []
@@ -0,0 +1,90 @@
+import time
+
+import pandas
+
+from spider.util.market_data import MarketDataCache, RateLimiter, get_market_data, get_missing_ranges, \
+    merge_ranges
+
+DAY = 24 * 60 * 60
+
+
+def day(value: str) -> pandas.Timestamp:
+    return pandas.Timestamp(value)
+
+
+class FakeDataSource:
+    """
+    Returns the day of the month as the value of every field, on weekdays.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, ticker, fields, freq, start, end) -> pandas.DataFrame:
+        self.requests.append((ticker, start, end))
+        index = pandas.bdate_range(start, end)
+        return pandas.DataFrame({field: index.day.astype(float) for field in fields}, index=index)
+
+
+def test_merge_ranges_joins_adjacent_days():
+    ranges = [(day('2019-01-05'), day('2019-01-06')), (day('2019-01-01'), day('2019-01-03')),
+              (day('2019-01-04'), day('2019-01-04')), (day('2019-01-10'), day('2019-01-11'))]
+
+    assert merge_ranges(ranges, DAY) == [(day('2019-01-01'), day('2019-01-06')),
+                                         (day('2019-01-10'), day('2019-01-11'))]
+    assert merge_ranges(ranges) == [(day('2019-01-01'), day('2019-01-03')), (day('2019-01-04'), day('2019-01-04')),
+                                    (day('2019-01-05'), day('2019-01-06')), (day('2019-01-10'), day('2019-01-11'))]
+
+
+def test_missing_ranges_are_the_gaps_between_covered_days():
+    covered = [(day('2019-01-03'), day('2019-01-04')), (day('2019-01-08'), day('2019-01-09'))]
+
+    assert get_missing_ranges(covered, day('2019-01-01'), day('2019-01-10'), DAY) == [
+        (day('2019-01-01'), day('2019-01-02')), (day('2019-01-05'), day('2019-01-07')),
+        (day('2019-01-10'), day('2019-01-10'))]
+    assert get_missing_ranges(covered, day('2019-01-03'), day('2019-01-04'), DAY) == []
+    assert get_missing_ranges([], day('2019-01-01'), day('2019-01-02'), DAY) == [
+        (day('2019-01-01'), day('2019-01-02'))]
+
+
+def test_cache_round_trip(tmpdir):
+    cache = MarketDataCache(str(tmpdir))
+    series = pandas.Series([1.0, 2.0, 3.0], index=pandas.date_range('2019-01-01', periods=3))
+
+    cache.write('EURUSD', 'close', 'daily', series, '2019-01-01', '2019-01-05')
+    cache.write('EURUSD', 'close', 'daily', pandas.Series([4.0], index=[day('2019-01-03')]),
+                '2019-01-03', '2019-01-03')
+
+    assert cache.read('EURUSD', 'close', 'daily').tolist() == [1.0, 2.0, 4.0]
+    assert cache.read('EURUSD', 'close', 'daily', '2019-01-02', '2019-01-02').tolist() == [2.0]
+    assert cache.get_covered_ranges('EURUSD', 'close', 'daily') == [(day('2019-01-01'), day('2019-01-05'))]
+    assert cache.get_missing_ranges('EURUSD', 'close', 'daily', '2019-01-01', '2019-01-07') == [
+        (day('2019-01-06'), day('2019-01-07'))]
+
+
+def test_only_missing_ranges_are_downloaded(tmpdir):
+    cache = MarketDataCache(str(tmpdir))
+    data_source = FakeDataSource()
+
+    first = get_market_data(['EURUSD', 'USDJPY'], ['close'], '2019-01-01', '2019-01-10', data_source=data_source,
+                            cache=cache)
+    second = get_market_data(['EURUSD'], ['close'], '2019-01-05', '2019-01-15', data_source=data_source,
+                             cache=cache)
+
+    assert list(first.columns) == ['EURUSD.close', 'USDJPY.close']
+    assert first['EURUSD.close'].tolist() == [1.0, 2.0, 3.0, 4.0, 7.0, 8.0, 9.0, 10.0]
+    assert sorted(data_source.requests) == [('EURUSD', day('2019-01-01'), day('2019-01-10')),
+                                            ('EURUSD', day('2019-01-11'), day('2019-01-15')),
+                                            ('USDJPY', day('2019-01-01'), day('2019-01-10'))]
+    assert second['EURUSD.close'].tolist() == [7.0, 8.0, 9.0, 10.0, 11.0, 14.0, 15.0]
+
+
+def test_rate_limiter_blocks_calls_over_the_limit():
+    rate_limiter = RateLimiter(max_calls=2, period=0.2)
+
+    start = time.monotonic()
+    for _ in range(3):
+        with rate_limiter:
+            pass
+
+    assert time.monotonic() - start >= 0.2
@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+import pytest
+
+from spider.util import pool
+from spider.util.pool import PoolStats, resize_pools
+
+
+class MockMetadataSession:
+    """
+    Stands in for the session of the Airflow metadata database, with the
+    stats of the task instances and the slots of the pools.
+    """
+
+    def __init__(self, stats: dict, slots: dict):
+        self.stats = stats
+        self.slots = slots
+        self.created = []
+
+
+@pytest.fixture(autouse=True)
+def metadata(monkeypatch):
+    def create_pool(name: str, slots: int, description: str, session: MockMetadataSession) -> None:
+        session.slots[name] = slots
+        session.created.append(name)
+
+    monkeypatch.setattr(pool, 'get_pool_stats', lambda name, since, session: session.stats[name])
+    monkeypatch.setattr(pool, '_get_pool_slots', lambda name, session: session.slots.get(name))
+    monkeypatch.setattr(pool, '_emit_sizing', lambda sizing: None)
+    monkeypatch.setattr(pool, 'create_pool', create_pool)
+    monkeypatch.setattr(pool, 'CPU_POOL_MAX_SLOTS', 8)
+
+
+def test_cpu_pool_is_capped_by_configured_capacity():
+    session = MockMetadataSession({
+        pool.IO_POOL: PoolStats(finished=3600, mean_duration=10, running=5, queued=2),
+        pool.CPU_POOL: PoolStats(finished=3600, mean_duration=30, running=8, queued=20),
+    }, {pool.IO_POOL: 4})
+
+    sizings = resize_pools(window=timedelta(hours=1), headroom=1, session=session)
+
+    assert [(sizing.pool, sizing.previous_slots, sizing.slots) for sizing in sizings] == [
+        (pool.IO_POOL, 4, 12), (pool.CPU_POOL, None, 8)]
+    assert session.slots == {pool.IO_POOL: 12, pool.CPU_POOL: 8}
+    assert session.created == [pool.IO_POOL, pool.CPU_POOL]
+
+
+def test_pools_are_only_written_when_resized():
+    session = MockMetadataSession({
+        pool.IO_POOL: PoolStats(finished=0, mean_duration=0, running=0, queued=0),
+        pool.CPU_POOL: PoolStats(finished=0, mean_duration=0, running=3, queued=0),
+    }, {pool.IO_POOL: 4, pool.CPU_POOL: 2})
+
+    assert [sizing.slots for sizing in resize_pools(session=session, dry_run=True)] == [4, 3]
+    assert session.created == []
+
+    resize_pools(session=session)
+    assert session.created == [pool.CPU_POOL]
+    assert session.slots == {pool.IO_POOL: 4, pool.CPU_POOL: 3}
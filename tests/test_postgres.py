@@ -0,0 +1,165 @@
+import csv
+import datetime
+import decimal
+import gzip
+import io
+import threading
+
+import pytest
+
+from benchmark.mock_bigquery import MockBigQueryClient
+from spider.util.database import _ChunkSizer, split_csv_buffer
+from spider.util.postgres import PostgresColumn, PostgresTable, iter_postgres_csv_chunks, iter_postgres_rows, \
+    replicate_postgres_table
+
+COLUMNS = [PostgresColumn('id', 'int4', False), PostgresColumn('description', 'text', True)]
+ROWS = [(i, f'line {i}\nline "{i}", continued' if i % 2 else f'value {i}') for i in range(20)]
+
+
+def to_csv_row(values) -> bytes:
+    file = io.StringIO()
+    csv.writer(file, lineterminator='\n').writerow(values)
+    return file.getvalue().encode('utf-8')
+
+
+def parse_csv(data: bytes) -> list:
+    return list(csv.reader(io.StringIO(data.decode('utf-8'))))
+
+
+class MockCursor:
+    """
+    Stands in for a psycopg2 cursor. Like psycopg2, `copy_expert` writes
+    every CSV row, quoted line breaks included, in one call.
+    """
+
+    def __init__(self, connection: 'MockConnection'):
+        self.connection = connection
+        self.rows = []
+        self.itersize = None
+
+    def __enter__(self) -> 'MockCursor':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, sql: str, parameters=None) -> None:
+        self.connection.statements.append(sql)
+        if 'information_schema.columns' in sql:
+            self.rows = [tuple(column) for column in self.connection.columns]
+        elif 'information_schema.table_constraints' in sql:
+            self.rows = [('id',)]
+        else:
+            self.rows = self.connection.rows
+
+    def fetchall(self) -> list:
+        return list(self.rows)
+
+    def mogrify(self, sql: str, parameters: dict) -> bytes:
+        return (sql % {name: repr(value) for name, value in parameters.items()}).encode('utf-8')
+
+    def copy_expert(self, sql: str, file) -> None:
+        self.connection.statements.append(sql)
+        file.write(to_csv_row([column.name for column in self.connection.columns]))
+        for row in self.connection.rows:
+            file.write(to_csv_row(row))
+
+
+class MockConnection:
+    def __init__(self, columns=COLUMNS, rows=ROWS):
+        self.columns = columns
+        self.rows = rows
+        self.statements = []
+        self.closed = False
+
+    def cursor(self, name=None) -> MockCursor:
+        return MockCursor(self)
+
+    def set_session(self, **kwargs) -> None:
+        pass
+
+    def commit(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_copy_chunks_keep_multiline_values():
+    chunks = list(iter_postgres_csv_chunks(MockConnection(), 'SELECT 1', chunk_sizer=_ChunkSizer(100, 1)))
+
+    assert len(chunks) > 1
+    rows = []
+    for chunk in chunks:
+        header, *chunk_rows = parse_csv(gzip.decompress(chunk.read()))
+        assert header == ['id', 'description']
+        rows += chunk_rows
+    assert rows == [[str(i), description] for i, description in ROWS]
+
+
+def test_copy_is_cancelled_when_consumer_stops():
+    threads = threading.active_count()
+    chunks = iter_postgres_csv_chunks(MockConnection(), 'SELECT 1', chunk_sizer=_ChunkSizer(10, 1))
+    next(chunks).close()
+    chunks.close()
+
+    assert threading.active_count() == threads
+
+
+def test_copy_raises_errors_of_the_copy():
+    class FailingCursor(MockCursor):
+        def copy_expert(self, sql: str, file) -> None:
+            raise RuntimeError('connection lost')
+
+    connection = MockConnection()
+    connection.cursor = lambda name=None: FailingCursor(connection)
+
+    with pytest.raises(RuntimeError, match='connection lost'):
+        list(iter_postgres_csv_chunks(connection, 'SELECT 1'))
+
+
+def test_split_csv_buffer_keeps_quoted_line_breaks():
+    data = b''.join(to_csv_row(row) for row in [('id', 'description')] + ROWS[:3])
+    buffer = io.BytesIO(gzip.compress(data))
+
+    halves = split_csv_buffer(buffer)
+
+    assert [parse_csv(gzip.decompress(half.read())) for half in halves] == [
+        [['id', 'description'], ['0', 'value 0']],
+        [['id', 'description'], ['1', 'line 1\nline "1", continued'], ['2', 'value 2']],
+    ]
+    assert split_csv_buffer(io.BytesIO(to_csv_row(('id',)) + to_csv_row(ROWS[1]))) is None
+
+
+def test_replicate_table_with_copy_allows_quoted_newlines():
+    bigquery_client = MockBigQueryClient()
+    connection = MockConnection()
+
+    replicate_postgres_table(bigquery_client, PostgresTable('videos'), 'backend', lambda: connection,
+                             method='copy', chunk_bytes=200)
+
+    assert len(bigquery_client.jobs) > 1
+    assert all(job.job_config.allow_quoted_newlines for job in bigquery_client.jobs)
+    assert [job.job_config.write_disposition for job in bigquery_client.jobs[:2]] == ['WRITE_TRUNCATE', 'WRITE_APPEND']
+    assert connection.closed
+
+
+def test_iter_postgres_rows_converts_values():
+    columns = [PostgresColumn('created_at', 'timestamptz', False), PostgresColumn('price', 'numeric', True),
+               PostgresColumn('metadata', 'jsonb', True), PostgresColumn('tags', '_text', True),
+               PostgresColumn('thumbnail', 'bytea', True)]
+    created_at = datetime.datetime(2019, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    connection = MockConnection(columns, [(created_at, decimal.Decimal('9.99'), {'a': 1}, ['x'], b'\x00'),
+                                          (created_at, None, None, None, None)])
+
+    rows = list(iter_postgres_rows(connection, 'SELECT 1', None, columns))
+
+    assert rows == [
+        {'created_at': '2019-01-01 12:00:00+00:00', 'price': '9.99', 'metadata': '{"a": 1}', 'tags': ['x'],
+         'thumbnail': 'AA=='},
+        {'created_at': '2019-01-01 12:00:00+00:00', 'price': None, 'metadata': None, 'tags': None,
+         'thumbnail': None},
+    ]
@@ -0,0 +1,74 @@
+import requests
+import requests_mock
+from google.cloud import bigquery
+
+from benchmark.mock_bigquery import MockBigQueryClient
+from spider.util.salesforce import SalesforceField, SalesforceObject, extract_salesforce_object, \
+    iter_salesforce_records
+
+BULK_URL = 'https://salesforce.test/services/async/47.0/'
+FIELDS = [SalesforceField('Id', 'id', False), SalesforceField('CreatedDate', 'datetime', True)]
+
+
+class MockSalesforceType:
+    def describe(self) -> dict:
+        return {'fields': [{'name': field.name, 'type': field.type, 'nillable': field.nillable}
+                           for field in FIELDS]}
+
+
+class MockSalesforce:
+    def __init__(self):
+        self.session = requests.Session()
+        self.session_id = 'session'
+        self.bulk_url = BULK_URL
+        self.Account = MockSalesforceType()
+
+
+def batch_info(*states: str) -> dict:
+    return {'json': {'batchInfo': [{'id': f'batch{i}', 'state': state} for i, state in enumerate(states)]}}
+
+
+def test_records_are_yielded_while_other_batches_run():
+    with requests_mock.Mocker() as mocker:
+        mocker.post(f'{BULK_URL}job', json={'id': 'job'})
+        mocker.post(f'{BULK_URL}job/job/batch', json={})
+        mocker.post(f'{BULK_URL}job/job', json={})
+        batches = mocker.get(f'{BULK_URL}job/job/batch', [
+            batch_info('NotProcessed', 'Completed', 'InProgress'),
+            batch_info('NotProcessed', 'Completed', 'Completed'),
+        ])
+        for batch_id in ['batch1', 'batch2']:
+            mocker.get(f'{BULK_URL}job/job/batch/{batch_id}/result', json=[f'{batch_id}-result'])
+            mocker.get(f'{BULK_URL}job/job/batch/{batch_id}/result/{batch_id}-result', json=[
+                {'attributes': {'type': 'Account'}, 'Id': batch_id, 'CreatedDate': 0}])
+
+        records = iter_salesforce_records(MockSalesforce(), 'Account', 'SELECT Id FROM Account', FIELDS,
+                                          poll_interval=60)
+        assert next(records) == {'Id': 'batch1', 'CreatedDate': '1970-01-01 00:00:00.000'}
+        # The first batch was downloaded without waiting for the next poll.
+        assert batches.call_count == 1
+        records.close()
+
+        records = iter_salesforce_records(MockSalesforce(), 'Account', 'SELECT Id FROM Account', FIELDS,
+                                          poll_interval=0)
+        assert sorted(record['Id'] for record in records) == ['batch1', 'batch2']
+        assert mocker.last_request.json() == {'state': 'Closed'}
+
+
+def test_object_without_records_empties_the_table():
+    client = MockBigQueryClient()
+    with requests_mock.Mocker() as mocker:
+        mocker.post(f'{BULK_URL}job', json={'id': 'job'})
+        mocker.post(f'{BULK_URL}job/job/batch', json={})
+        mocker.post(f'{BULK_URL}job/job', json={})
+        mocker.get(f'{BULK_URL}job/job/batch', **batch_info('NotProcessed', 'Completed'))
+        mocker.get(f'{BULK_URL}job/job/batch/batch1/result', json=['batch1-result'])
+        mocker.get(f'{BULK_URL}job/job/batch/batch1/result/batch1-result', json=[])
+
+        result = extract_salesforce_object(client, MockSalesforce(), SalesforceObject('Account', incremental=False),
+                                           'salesforce', poll_interval=0)
+
+    assert result.row_count == 0
+    job, = client.jobs
+    assert job.output_rows == 0
+    assert job.job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
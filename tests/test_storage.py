@@ -0,0 +1,77 @@
+import fnmatch
+import gzip
+import io
+
+from google.cloud import bigquery
+
+from benchmark.mock_bigquery import MockBigQueryClient, MockLoadJob
+from spider.util.storage import FilesystemStorageClient, download_file_from_gcs, parse_gcs_uri, \
+    upload_dict_iterable_to_bigquery_via_gcs, upload_dict_iterable_to_gcs
+
+ROWS = [{'id': i, 'name': f'row {i}'} for i in range(25)]
+
+
+class GcsBigQueryClient(MockBigQueryClient):
+    """
+    Loads the wildcard URIs from the blobs of a `FilesystemStorageClient`.
+    """
+
+    def __init__(self, storage_client: FilesystemStorageClient):
+        super().__init__()
+        self.storage_client = storage_client
+
+    def load_table_from_uri(self, source_uris: list, destination, job_config=None, **kwargs) -> MockLoadJob:
+        data = b''
+        for source_uri in source_uris:
+            bucket_name, pattern = parse_gcs_uri(source_uri)
+            for blob in self.storage_client.bucket(bucket_name).list_blobs():
+                if fnmatch.fnmatch(blob.name, pattern):
+                    with open(blob.path, 'rb') as file:
+                        content = file.read()
+                    data += gzip.decompress(content) if blob.name.endswith('.gz') else content
+        job = MockLoadJob(f'load_{next(self._job_ids)}', data, destination, job_config)
+        self.jobs.append(job)
+        return job
+
+
+def read_shard(storage_client: FilesystemStorageClient, gcs_uri: str) -> bytes:
+    return gzip.decompress(download_file_from_gcs(storage_client, gcs_uri, io.BytesIO()).read())
+
+
+def test_rows_are_uploaded_in_shards(tmpdir):
+    storage_client = FilesystemStorageClient(str(tmpdir))
+
+    gcs_uris = upload_dict_iterable_to_gcs(storage_client, iter(ROWS), 'gs://bucket/staging/', chunk_size=10,
+                                           max_workers=2)
+
+    assert gcs_uris == [f'gs://bucket/staging/shard-{index:06d}.json.gz' for index in range(3)]
+    assert [read_shard(storage_client, gcs_uri).count(b'\n') for gcs_uri in gcs_uris] == [10, 10, 5]
+
+
+def test_shards_are_loaded_with_one_job_and_deleted(tmpdir):
+    storage_client = FilesystemStorageClient(str(tmpdir))
+    bigquery_client = GcsBigQueryClient(storage_client)
+
+    job_id = upload_dict_iterable_to_bigquery_via_gcs(
+        bigquery_client, storage_client, iter(ROWS), 'gs://bucket/staging', 'dataset', 'table', [], chunk_size=10)
+
+    job, = bigquery_client.jobs
+    assert (job.job_id, job.output_rows) == (job_id, 25)
+    assert job.job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+    assert list(storage_client.bucket('bucket').list_blobs()) == []
+
+
+def test_empty_iterable_empties_truncated_table(tmpdir):
+    storage_client = FilesystemStorageClient(str(tmpdir))
+    bigquery_client = GcsBigQueryClient(storage_client)
+
+    upload_dict_iterable_to_bigquery_via_gcs(
+        bigquery_client, storage_client, iter([]), 'gs://bucket/staging', 'dataset', 'table', [])
+    assert upload_dict_iterable_to_bigquery_via_gcs(
+        bigquery_client, storage_client, iter([]), 'gs://bucket/staging', 'dataset', 'table', [],
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND) is None
+
+    job, = bigquery_client.jobs
+    assert job.output_rows == 0
+    assert job.job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+    assert list(storage_client.bucket('bucket').list_blobs()) == []